@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.schedules import crontab
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ProjectKoncowy.settings')
 
@@ -10,4 +11,29 @@ celery_app.config_from_object('django.conf:settings', namespace='CELERY')
 
 celery_app.autodiscover_tasks()
 
+# NBP publikuje tabelę A w dni robocze około 12:00 czasu polskiego
+celery_app.conf.timezone = 'Europe/Warsaw'
+celery_app.conf.beat_schedule = {
+    'update-exchange-rates': {
+        'task': 'wallet.tasks.update_exchange_rates',
+        'schedule': crontab(minute='*/30', hour='11-16', day_of_week='mon-fri'),
+    },
+    'update-exchange-rates-daily': {
+        'task': 'wallet.tasks.update_exchange_rates',
+        'schedule': crontab(minute=0, hour=7),
+    },
+    'record-net-worth': {
+        'task': 'wallet.tasks.record_net_worth_snapshots',
+        'schedule': crontab(minute=55, hour=23),
+    },
+    'purge-idempotency-keys': {
+        'task': 'wallet.tasks.purge_expired_idempotency_keys',
+        'schedule': crontab(minute=15),
+    },
+    'delete-hidden-categories': {
+        'task': 'wallet.tasks.delete_hidden_categories',
+        'schedule': crontab(minute=45),
+    },
+}
+
 
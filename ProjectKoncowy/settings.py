@@ -87,6 +87,17 @@ DATABASES = {
     }
 }
 
+# cache wspólny dla procesów WWW i workerów celery: wersje danych i rejestru walut, blokady i postęp zadań
+# zapisane w jednym procesie muszą być widoczne w pozostałych.
+# Serwer Redis musi działać z maxmemory i maxmemory-policy allkeys-lru: zapisane strony nie są usuwane
+# przy zmianie wersji, tylko wypadają jako najdawniej używane; wersja, która wypadła, jest zakładana od nowa
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -33,9 +33,15 @@ urlpatterns = [
     path('expense-delete/<int:expense_id>/', views.ExpenseDeleteView.as_view(), name='expense_delete'),
     path('income-add/', views.IncomeAddView.as_view(), name='income_add'),
     path('expense-add/', views.ExpenseAddView.as_view(), name='expense_add'),
+    path('statement-import/', views.StatementImportView.as_view(), name='statement_import'),
+    path('reports/', views.ReportView.as_view(), name='report'),
+    path('net-worth/', views.NetWorthView.as_view(), name='net_worth'),
+    path('export/<str:kind>/', views.ExportView.as_view(), name='export'),
     path('category/', views.CategoryView.as_view(), name='category'),
     path('category-add/', views.CategoryAddView.as_view(), name='category_add'),
     path('category/delete/<int:category_id>/', views.CategoryDeleteView.as_view(), name='category_delete'),
+    path('category/delete/<int:category_id>/status/', views.CategoryDeletionStatusView.as_view(),
+         name='category_delete_status'),
     path('savings/', views.SavingsView.as_view(), name='savings'),
     path('savings-add/', views.SavingsAddView.as_view(), name='savings_add'),
     path('savings-edit/<int:saving_id>/', views.SavingsEditView.as_view(), name='saving_edit'),
@@ -53,5 +59,6 @@ urlpatterns = [
     path('account-details/<int:account_id>/for-expense-add/', views.ForExpenseView.as_view(), name='for_expense_add'),
     path('account-details/<int:account_id>/for-income-add/', views.ForIncomeView.as_view(), name='for_income_add'),
     path('account-details/<int:account_id>/change_to_PLN/', views.ChangeToPLNView.as_view(), name='change_to_PLN'),
+    path('account-details/<int:account_id>/transfer/', views.AccountTransferView.as_view(), name='account_transfer'),
 
 ]
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MywalletConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'wallet'
+
+    def ready(self):
+        # odbiorniki sygnałów unieważniających cache stron
+        from wallet import pagecache  # noqa: F401
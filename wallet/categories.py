@@ -0,0 +1,62 @@
+from collections import defaultdict
+
+from django.core.cache import cache
+
+from wallet.models import Category
+from wallet.pagecache import CATEGORY_VERSION_KEY, data_versions
+
+CATALOGUE_KEY = 'wallet:categories:{}:{}.{}'
+CATALOGUE_TIMEOUT = 24 * 60 * 60
+
+
+# kategorie dostępne dla użytkownika (wbudowane i własne) z gotową listą wyboru do formularzy
+class CategoryCatalogue:
+    def __init__(self, categories):
+        ordered = tree_order(categories)
+        self.categories = [category for category, _ in ordered]
+        self._by_id = {category.id: category for category in self.categories}
+        # podkategorie pod swoim rodzicem, wcięte według poziomu
+        self.choices = [(category.id, '\u2014 ' * level + str(category)) for category, level in ordered]
+
+    def get(self, category_id):
+        # id jako liczba, tekst z formularza albo obiekt Category; None, gdy kategoria jest niedostępna
+        try:
+            return self._by_id.get(int(getattr(category_id, 'pk', category_id)))
+        except (TypeError, ValueError):
+            return None
+
+    def __contains__(self, category_id):
+        return self.get(category_id) is not None
+
+    def __iter__(self):
+        return iter(self.categories)
+
+    def __len__(self):
+        return len(self.categories)
+
+
+# katalog z cache, unieważniany przy dodaniu, zmianie i usunięciu kategorii (sygnały w wallet.pagecache)
+def category_catalogue(user):
+    key = CATALOGUE_KEY.format(user.pk, *data_versions(user.pk, CATEGORY_VERSION_KEY))
+    catalogue = cache.get(key)
+    if catalogue is None:
+        catalogue = CategoryCatalogue(Category.objects.available_to(user).order_by('id'))
+        cache.set(key, catalogue, CATALOGUE_TIMEOUT)
+    return catalogue
+
+
+# kategorie w kolejności drzewa (rodzic przed podkategoriami) razem z poziomem zagnieżdżenia;
+# kategoria, której rodzica nie ma na liście, jest traktowana jak główna
+def tree_order(categories):
+    categories = list(categories)
+    ids = {category.id for category in categories}
+    children = defaultdict(list)
+    for category in categories:
+        children[category.parent_id if category.parent_id in ids else None].append(category)
+    ordered = []
+    stack = [(category, 0) for category in reversed(children[None])]
+    while stack:
+        category, level = stack.pop()
+        ordered.append((category, level))
+        stack.extend((child, level + 1) for child in reversed(children[category.id]))
+    return ordered
@@ -1,11 +1,23 @@
+import json
+import threading
 from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
 from django.contrib.auth.models import User
+from django.core.cache import cache
 
 from wallet.models import Income, Category, Expense, Currency, Savings, Account, Transaction
 
 
+@pytest.fixture(autouse=True)
+def clear_cache(settings):
+    # testy nie potrzebują serwera Redis; baza jest wycofywana po każdym teście,
+    # więc zapisane w cache strony i wersje danych też
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+
+
 @pytest.fixture
 def user():
     return User.objects.create(username="test_user")
@@ -182,3 +194,50 @@ def transactions(user, foreign_currency, category):
                                    currency=foreign_currency[0])
     ]
     return transactions
+
+
+class NBPStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        etag = '"%s"' % server.table['effectiveDate']
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps([server.table]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if server.send_etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def nbp_server(settings):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), NBPStubHandler)
+    server.requests = []
+    server.send_etag = True
+    server.table = {
+        'table': 'A',
+        'no': '036/A/NBP/2024',
+        'effectiveDate': '2024-02-21',
+        'rates': [
+            {'currency': 'dolar amerykański', 'code': 'USD', 'mid': 4.0123},
+            {'currency': 'euro', 'code': 'EUR', 'mid': 4.3210},
+            {'currency': 'funt szterling', 'code': 'GBP', 'mid': 5.0512},
+        ],
+    }
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    settings.NBP_RATES_URL = 'http://127.0.0.1:%d/api/exchangerates/tables/A/' % server.server_address[1]
+    cache.clear()
+    yield server
+    server.shutdown()
+    server.server_close()
+    cache.clear()
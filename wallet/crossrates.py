@@ -0,0 +1,93 @@
+import threading
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+
+from wallet.currencies import currency_registry
+from wallet.rates import get_rate_history
+
+
+class RateUnavailable(ValueError):
+    pass
+
+
+# macierz kursów krzyżowych N x N: matrix[i, j] to liczba jednostek waluty j za jednostkę waluty i;
+# waluta bez kursu (brak albo zero) ma w swoim wierszu i kolumnie NaN
+class CrossRates:
+    def __init__(self, currencies, in_pln=None):
+        currencies = list(currencies)
+        self.codes = [currency.code for currency in currencies]
+        self._index = {}
+        for i, currency in enumerate(currencies):
+            self._index[currency.id] = i
+            self._index[currency.code] = i
+        if in_pln is None:
+            in_pln = [float(currency.exchange_rate) for currency in currencies]
+        in_pln = np.asarray(in_pln, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            in_pln = np.where(in_pln > 0, in_pln, np.nan)
+            self.matrix = np.outer(in_pln, 1.0 / in_pln)
+
+    def index(self, currency):
+        # waluta jako obiekt Currency, id albo kod
+        key = getattr(currency, 'id', currency)
+        try:
+            return self._index[key]
+        except KeyError:
+            raise KeyError(f'Unknown currency {currency!r}') from None
+
+    def indexes(self, currencies):
+        return np.fromiter((self.index(currency) for currency in currencies), dtype=np.int64)
+
+    def available(self, currency):
+        i = self._index.get(getattr(currency, 'id', currency))
+        return i is not None and bool(np.isfinite(self.matrix[i, i]))
+
+    def _code(self, currency):
+        i = self._index.get(getattr(currency, 'id', currency))
+        return str(currency) if i is None else self.codes[i]
+
+    # RateUnavailable, gdy którakolwiek z walut nie ma kursu (także nieznana waluta)
+    def check(self, currencies):
+        missing = sorted({self._code(currency) for currency in currencies if not self.available(currency)})
+        if missing:
+            raise RateUnavailable(f'Brak kursu walut: {", ".join(missing)}.')
+
+    def rate(self, source, target):
+        self.check([source, target])
+        return Decimal(str(self.matrix[self.index(source), self.index(target)]))
+
+    def convert(self, amounts, source, target):
+        # kwoty i waluty mogą być pojedynczymi wartościami albo listami tej samej długości
+        amounts = np.asarray(amounts, dtype=np.float64)
+        source = self.indexes(source) if isinstance(source, (list, tuple, np.ndarray)) else self.index(source)
+        target = self.indexes(target) if isinstance(target, (list, tuple, np.ndarray)) else self.index(target)
+        return amounts * self.matrix[source, target]
+
+    def convert_amount(self, amount, source, target):
+        self.check([source, target])
+        return Decimal(str(self.convert(float(amount), source, target))).quantize(Decimal('0.01'))
+
+
+_lock = threading.Lock()
+_cross_rates = None
+_cross_rates_version = None
+
+
+# macierz budowana raz na każde odświeżenie kursów (zmiana wersji rejestru walut) z najnowszych średnich
+# kursów NBP (6 miejsc po przecinku; Currency.exchange_rate ma 2 i np. dla CLP, IDR czy KRW wynosi 0.00)
+def get_cross_rates():
+    global _cross_rates, _cross_rates_version
+    version = currency_registry.version
+    if _cross_rates is None or _cross_rates_version != version:
+        currencies = currency_registry.all()
+        days = np.full(len(currencies), np.datetime64(date.today(), 'D'))
+        in_pln = get_rate_history().rates([currency.id for currency in currencies], days)
+        # bez historii (np. PLN) zostaje kurs z Currency
+        for i in np.flatnonzero(np.isnan(in_pln)):
+            in_pln[i] = float(currencies[i].exchange_rate)
+        cross_rates = CrossRates(currencies, in_pln)
+        with _lock:
+            _cross_rates, _cross_rates_version = cross_rates, version
+    return _cross_rates
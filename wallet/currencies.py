@@ -0,0 +1,79 @@
+import threading
+import time
+
+from django.core.cache import cache
+
+from wallet.models import Currency
+
+DEFAULT_CURRENCY_CODE = 'PLN'
+VERSION_KEY = 'wallet:currency-registry:version'
+# jak często (w sekundach) proces sprawdza w cache, czy kursy się zmieniły
+VERSION_CHECK_INTERVAL = 1.0
+
+
+# waluty trzymane w pamięci procesu; przeładowywane, gdy zmieni się numer wersji w cache Django
+class CurrencyRegistry:
+    def __init__(self, check_interval=VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self._by_code = {}
+        self._by_id = {}
+
+    def _load(self, version):
+        currencies = list(Currency.objects.all())
+        with self._lock:
+            self._by_code = {currency.code: currency for currency in currencies}
+            self._by_id = {currency.id: currency for currency in currencies}
+            self._version = version
+            self._checked_at = time.monotonic()
+
+    def _refresh(self):
+        if self._version is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+            version = cache.get(VERSION_KEY)
+        if version != self._version:
+            self._load(version)
+        else:
+            self._checked_at = time.monotonic()
+
+    def _lookup(self, index_name, key):
+        self._refresh()
+        currency = getattr(self, index_name).get(key)
+        if currency is None:
+            # waluta mogła dojść w innym procesie przed podbiciem wersji
+            self._load(self._version)
+            currency = getattr(self, index_name).get(key)
+            if currency is None:
+                raise Currency.DoesNotExist(f'Currency {key!r} does not exist')
+        return currency
+
+    def get(self, code):
+        return self._lookup('_by_code', code)
+
+    def get_by_id(self, currency_id):
+        return self._lookup('_by_id', currency_id)
+
+    def default(self):
+        return self.get(DEFAULT_CURRENCY_CODE)
+
+    @property
+    def version(self):
+        self._refresh()
+        return self._version
+
+    def all(self):
+        self._refresh()
+        return sorted(self._by_code.values(), key=lambda currency: currency.code)
+
+    # wersją jest czas ostatniej zmiany kursów, więc służy też jako Last-Modified stron zależnych od kursów
+    def invalidate(self):
+        self._version = None
+        cache.set(VERSION_KEY, time.time_ns(), timeout=None)
+
+
+currency_registry = CurrencyRegistry()
@@ -0,0 +1,67 @@
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.db.models import DecimalField, OuterRef, Q, Subquery, Sum
+
+from wallet.models import Income, Expense, Transaction, Account, default_currency_id
+from wallet.rates import get_rate_history
+
+EXCHANGE_CATEGORY_NAME = 'wymiana'
+LAST_EXCHANGES = 10
+
+
+def _sum_subquery(queryset, **extra):
+    # suma pola 'amount' jako podzapytanie skorelowane z użytkownikiem
+    total = queryset.filter(user=OuterRef('pk')).order_by().values('user').annotate(
+        total=Sum('amount', **extra)).values('total')
+    return Subquery(total, output_field=DecimalField(max_digits=100, decimal_places=2))
+
+
+# dane strony głównej w stałej liczbie zapytań, niezależnie od liczby rekordów
+def load_dashboard(user, days=30):
+    today = date.today()
+    date30days = today - timedelta(days=days)
+
+    # obie sumy w jednym zapytaniu; wpływy z wymiany walut są pomijane warunkowo w agregacji
+    sums = User.objects.filter(pk=user.pk).annotate(
+        sum_expenses=_sum_subquery(Expense.objects.filter(date__gte=date30days)),
+        sum_income=_sum_subquery(Income.objects.filter(date__gte=date30days),
+                                 filter=~Q(category__name=EXCHANGE_CATEGORY_NAME)),
+    ).values('sum_expenses', 'sum_income').get()
+    sum_expenses = sums['sum_expenses']
+    sum_income = sums['sum_income']
+
+    sum_expenses_round = 0
+    if sum_expenses is not None:
+        sum_expenses_round = round(sum_expenses, 0)
+    sum_income_round = 0
+    if sum_income is not None:
+        sum_income_round = round(sum_income, 0)
+
+    if sum_income is not None and sum_expenses is not None:
+        together = round(sum_income - sum_expenses, 2)
+    else:
+        together = None
+
+    account = list(Account.objects.filter(user=user).select_related('currency'))
+
+    transactions = Transaction.objects.filter(user=user, date__gte=date30days).select_related(
+        'currency').order_by('-date')
+    pln_currency_id = default_currency_id()
+    transactionsPLN = []
+    transactionsFOR = []
+    transactionsEXC = []
+    for transaction in transactions:
+        if transaction.currency_id == pln_currency_id:
+            transactionsPLN.append(transaction)
+        else:
+            transactionsFOR.append(transaction)
+        if transaction.transaction_type == 'Exchange' and len(transactionsEXC) < LAST_EXCHANGES:
+            transactionsEXC.append(transaction)
+    # wymiana przeliczana po kursie z dnia transakcji, a nie po dzisiejszym
+    get_rate_history().convert_transactions(transactionsEXC)
+
+    return {'sum_expenses': sum_expenses, 'sum_income': sum_income, 'together': together,
+            'transactionsPLN': transactionsPLN, 'transactionsFOR': transactionsFOR, 'account': account,
+            'sum_expenses_round': sum_expenses_round, 'sum_income_round': sum_income_round,
+            'transactionsEXC': transactionsEXC, 'date30days': date30days, 'today': today}
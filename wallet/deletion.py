@@ -0,0 +1,144 @@
+from abc import ABC, abstractmethod
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.transaction import atomic
+
+from wallet.models import Account, Category, CategoryClosure, DailyRollup, Expense, IdempotencyKey, Income, \
+    NetWorthSnapshot, Savings, Transaction
+from wallet.pagecache import CATEGORY_VERSION_KEY, bump_data_version
+
+DELETE_CHUNK_SIZE = 500
+PROGRESS_KEY = 'wallet:deletion:{}:{}'
+PROGRESS_TIMEOUT = 24 * 60 * 60
+LOCK_KEY = 'wallet:deletion-lock:{}:{}'
+LOCK_TIMEOUT = 60 * 60
+
+
+def deletion_progress(kind, pk):
+    return cache.get(PROGRESS_KEY.format(kind, pk))
+
+
+def _report(kind, pk, deleted, total, done=False):
+    cache.set(PROGRESS_KEY.format(kind, pk), {'deleted': deleted, 'total': total, 'done': done}, PROGRESS_TIMEOUT)
+
+
+# zapisywane przy zleceniu zadania, żeby postęp był dostępny, zanim worker zacznie usuwać
+def report_queued(kind, pk, total):
+    _report(kind, pk, 0, total)
+
+
+# usuwa wiersze partiami po chunk_size, każda partia w osobnej, krótkiej transakcji;
+# kolektor Django ładuje tylko bieżącą partię i jej zależności, a nie całe drzewo naraz
+def delete_in_chunks(queryset, chunk_size=DELETE_CHUNK_SIZE, progress=None):
+    model = queryset.model
+    deleted = 0
+    while True:
+        ids = list(queryset.order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        with atomic():
+            model.objects.filter(pk__in=ids).delete()
+        deleted += len(ids)
+        if progress is not None:
+            progress(len(ids))
+
+
+class ChunkedDeletion(ABC):
+    kind = None
+
+    def __init__(self, pk, chunk_size=DELETE_CHUNK_SIZE):
+        self.pk = pk
+        self.chunk_size = chunk_size
+        self.deleted = 0
+        self.total = 0
+
+    # zależne wiersze w kolejności usuwania; obiekt nadrzędny na końcu
+    @abstractmethod
+    def steps(self):
+        pass
+
+    @abstractmethod
+    def delete_parent(self):
+        pass
+
+    def advance(self, count):
+        self.deleted += count
+        _report(self.kind, self.pk, self.deleted, self.total)
+
+    # None, gdy ten sam obiekt jest już usuwany w innym procesie
+    def run(self):
+        lock = LOCK_KEY.format(self.kind, self.pk)
+        if not cache.add(lock, True, LOCK_TIMEOUT):
+            return None
+        try:
+            steps = self.steps()
+            self.total = sum(step.count() for step in steps)
+            _report(self.kind, self.pk, 0, self.total)
+            for queryset in steps:
+                delete_in_chunks(queryset, self.chunk_size, self.advance)
+            with atomic():
+                self.delete_parent()
+        finally:
+            cache.delete(lock)
+        # część wierszy znika kaskadowo razem z wcześniejszymi partiami, więc na końcu postęp jest pełny
+        _report(self.kind, self.pk, self.total, self.total, done=True)
+        return self.total
+
+
+# kategoria z podkategoriami: najpierw sumy dzienne (znikną w całości, więc raporty od razu ich nie liczą),
+# potem transakcje razem z ich wpisami Income/Expense (kaskada) i wpisy bez transakcji
+class CategoryDeletion(ChunkedDeletion):
+    kind = 'category'
+
+    def subtree(self):
+        return CategoryClosure.objects.filter(ancestor_id=self.pk).values('descendant_id')
+
+    def steps(self):
+        subtree = self.subtree()
+        return [DailyRollup.objects.filter(category__in=subtree),
+                Transaction.objects.filter(category__in=subtree),
+                Expense.objects.filter(category__in=subtree, transaction__isnull=True),
+                Income.objects.filter(category__in=subtree, transaction__isnull=True)]
+
+    def delete_parent(self):
+        Category.objects.filter(pk=self.pk).delete()
+
+
+# wszystkie dane użytkownika, model po modelu; konto użytkownika na końcu
+class UserDeletion(ChunkedDeletion):
+    kind = 'user'
+
+    def steps(self):
+        user_id = self.pk
+        return [DailyRollup.objects.filter(user_id=user_id),
+                Transaction.objects.filter(user_id=user_id),
+                Expense.objects.filter(user_id=user_id, transaction__isnull=True),
+                Income.objects.filter(user_id=user_id, transaction__isnull=True),
+                NetWorthSnapshot.objects.filter(user_id=user_id),
+                IdempotencyKey.objects.filter(user_id=user_id),
+                Savings.objects.filter(user_id=user_id),
+                Account.objects.filter(user_id=user_id),
+                Category.objects.filter(user_id=user_id)]
+
+    def delete_parent(self):
+        User.objects.filter(pk=self.pk).delete()
+
+
+# liczba wierszy do usunięcia razem z kategorią; małe drzewa można usunąć od razu, w jednej transakcji
+def category_dependants(category):
+    return sum(step.count() for step in CategoryDeletion(category.pk).steps())
+
+
+# ukrycie od razu, w jednym UPDATE: kategoria i jej podkategorie znikają z list i formularzy przed usunięciem
+def hide_category(category):
+    subtree = CategoryClosure.objects.filter(ancestor=category).values('descendant_id')
+    Category.objects.filter(pk__in=subtree).update(hidden=True)
+    # UPDATE na querysecie nie wysyła sygnałów zapisu
+    owner = None if category.is_built else category.user_id
+    bump_data_version(owner)
+    bump_data_version(owner, CATEGORY_VERSION_KEY)
+
+
+def hide_user(user):
+    User.objects.filter(pk=user.pk).update(is_active=False)
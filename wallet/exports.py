@@ -0,0 +1,73 @@
+import csv
+import json
+
+from wallet.models import Expense, Income, Transaction
+
+EXPORT_CHUNK_SIZE = 2000
+
+# rodzaj eksportu: (model, kolumny)
+EXPORTS = {
+    'transactions': (Transaction, ('id', 'date', 'transaction_type', 'amount', 'currency', 'category', 'description')),
+    'incomes': (Income, ('id', 'date', 'amount', 'category', 'description')),
+    'expenses': (Expense, ('id', 'date', 'amount', 'category', 'description')),
+}
+
+
+class Echo:
+    # csv.writer zapisuje do "pliku", który od razu oddaje linię zamiast ją buforować
+    def write(self, value):
+        return value
+
+
+def export_queryset(kind, user, date_from=None, date_to=None, category=None):
+    model, columns = EXPORTS[kind]
+    queryset = model.objects.filter(user=user).select_related(
+        *(name for name in ('category', 'currency') if name in columns))
+    if date_from:
+        queryset = queryset.filter(date__gte=date_from)
+    if date_to:
+        queryset = queryset.filter(date__lte=date_to)
+    if category:
+        queryset = queryset.filter(category=category)
+    return queryset.order_by('date', 'id')
+
+
+def export_rows(kind, queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    _, columns = EXPORTS[kind]
+    for obj in queryset.iterator(chunk_size=chunk_size):
+        row = []
+        for column in columns:
+            value = getattr(obj, column)
+            if column == 'category':
+                value = value.name if value else ''
+            elif column == 'currency':
+                value = value.code
+            elif column == 'description':
+                value = value or ''
+            elif column in ('date', 'amount'):
+                value = str(value)
+            row.append(value)
+        yield row
+
+
+def stream_csv(kind, rows):
+    writer = csv.writer(Echo(), delimiter=';')
+    # BOM, żeby Excel rozpoznał UTF-8
+    yield '\ufeff' + writer.writerow(EXPORTS[kind][1])
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_json(kind, rows):
+    columns = EXPORTS[kind][1]
+    separator = '[\n'
+    for row in rows:
+        yield separator + json.dumps(dict(zip(columns, row)), ensure_ascii=False)
+        separator = ',\n'
+    yield '[]\n' if separator == '[\n' else '\n]\n'
+
+
+EXPORT_FORMATS = {
+    'csv': (stream_csv, 'text/csv; charset=utf-8'),
+    'json': (stream_json, 'application/json'),
+}
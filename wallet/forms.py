@@ -1,5 +1,6 @@
 from django import forms
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from wallet.models import Category, Income, Savings, Account, Transaction, Currency
 
 
@@ -37,16 +38,49 @@ class RegisterForm(forms.ModelForm):
         return password2
 
 
+# z katalogiem kategorii (wallet.categories) lista wyboru i walidacja id nie wykonują zapytań do bazy
+class CategoryChoiceField(forms.ModelChoiceField):
+    catalogue = None
+
+    def set_catalogue(self, catalogue):
+        self.catalogue = catalogue
+        self.widget.choices = self.choices
+
+    def _get_choices(self):
+        if self.catalogue is None:
+            return super()._get_choices()
+        empty = [('', self.empty_label)] if self.empty_label is not None else []
+        return empty + self.catalogue.choices
+
+    choices = property(_get_choices, forms.ChoiceField.choices.fset)
+
+    def to_python(self, value):
+        if self.catalogue is None or value in self.empty_values:
+            return super().to_python(value)
+        category = self.catalogue.get(value)
+        if category is None:
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice',
+                                  params={'value': value})
+        return category
+
+
+def _limit_categories(field, categories=None, catalogue=None):
+    if catalogue is not None:
+        field.set_catalogue(catalogue)
+    elif categories:
+        field.queryset = categories
+
+
 class IncomeExpenseFilterForm(forms.Form):
     date_from = forms.DateField(label='Data od', widget=forms.TextInput(attrs={'type': 'date', 'class': 'form-control'}), required=False)
     date_to = forms.DateField(label='Data do', widget=forms.TextInput(attrs={'type': 'date', 'class': 'form-control'}), required=False)
-    category = forms.ModelChoiceField(queryset=Category.objects.all(), label='Kategoria', empty_label='--wszystkie--', widget=forms.Select(attrs={'class': 'form-control'}),required=False)
+    category = CategoryChoiceField(queryset=Category.objects.all(), label='Kategoria', empty_label='--wszystkie--', widget=forms.Select(attrs={'class': 'form-control'}),required=False)
 
     def __init__(self, *args, **kwargs):
         categories = kwargs.pop('categories', None)
+        catalogue = kwargs.pop('catalogue', None)
         super(IncomeExpenseFilterForm, self).__init__(*args, **kwargs)
-        if categories:
-            self.fields['category'].queryset = categories
+        _limit_categories(self.fields['category'], categories, catalogue)
 
 
 class IncomeExpenseAddForm(forms.ModelForm):
@@ -65,12 +99,13 @@ class IncomeExpenseAddForm(forms.ModelForm):
             'description': 'Opis',
             'category': 'Kategoria',
         }
+        field_classes = {'category': CategoryChoiceField}
 
     def __init__(self, *args, **kwargs):
         categories = kwargs.pop('categories', None)
+        catalogue = kwargs.pop('catalogue', None)
         super(IncomeExpenseAddForm, self).__init__(*args, **kwargs)
-        if categories:
-            self.fields['category'].queryset = categories
+        _limit_categories(self.fields['category'], categories, catalogue)
 
     def clean_amount(self):
         amount = self.cleaned_data.get('amount')
@@ -85,19 +120,25 @@ class IncomeExpenseAddForm(forms.ModelForm):
 class CategoryAddForm(forms.ModelForm):
     class Meta:
         model = Category
-        fields = ['name', 'description', 'is_built']
+        fields = ['name', 'description', 'parent', 'is_built']
         labels = {
             'name': 'Nazwa',
-            'description': 'Opis'
+            'description': 'Opis',
+            'parent': 'Kategoria nadrzędna',
         }
         widgets = {
             'name': forms.TextInput(attrs={'class': 'form-control'}),
             'description': forms.Textarea(attrs={'class': 'form-control', 'rows': 3}),
+            'parent': forms.Select(attrs={'class': 'form-control'}),
         }
+        field_classes = {'parent': CategoryChoiceField}
+
     # ustawiam niewidoczne pole żeby zawsze zapisywało is_built i ustawia user na podanego uzytkownika
-    def __init__(self, *args, user=None, **kwargs):
+    # kategorią nadrzędną może być tylko kategoria z katalogu użytkownika
+    def __init__(self, *args, user=None, catalogue=None, **kwargs):
         super(CategoryAddForm, self).__init__(*args, **kwargs)
         self.fields['is_built'].widget = forms.HiddenInput()
+        _limit_categories(self.fields['parent'], catalogue=catalogue)
         if user is not None:
             self.instance.user = user
 
@@ -163,12 +204,13 @@ class ForIncomeExpenseAddForm(forms.ModelForm):
             'date': 'Data',
             'category': 'Kategoria'
         }
+        field_classes = {'category': CategoryChoiceField}
 
     def __init__(self, *args, **kwargs):
         categories = kwargs.pop('categories', None)
+        catalogue = kwargs.pop('catalogue', None)
         super(ForIncomeExpenseAddForm, self).__init__(*args, **kwargs)
-        if categories:
-            self.fields['category'].queryset = categories
+        _limit_categories(self.fields['category'], categories, catalogue)
 
 
     def clean_amount(self):
@@ -178,6 +220,36 @@ class ForIncomeExpenseAddForm(forms.ModelForm):
         return amount
 
 
+class AccountTransferForm(forms.Form):
+    target = forms.ModelChoiceField(queryset=Account.objects.none(), label='Na konto', empty_label=None,
+                                    widget=forms.Select(attrs={'class': 'form-control'}))
+    amount = forms.DecimalField(max_digits=100, decimal_places=2, label='Kwota',
+                                widget=forms.NumberInput(attrs={'class': 'form-control', 'step': '0.01'}))
+
+    # konta docelowe to pozostałe konta tego samego użytkownika
+    def __init__(self, *args, account=None, **kwargs):
+        super(AccountTransferForm, self).__init__(*args, **kwargs)
+        if account is not None:
+            self.fields['target'].queryset = Account.objects.filter(user_id=account.user_id).exclude(
+                id=account.id).select_related('currency')
+
+    def clean_amount(self):
+        amount = self.cleaned_data.get('amount')
+        if amount <= 0:
+            raise forms.ValidationError('Kwota musi być większa niż zero.')
+        return amount
+
+
+class StatementImportForm(forms.Form):
+    ENCODINGS = [('utf-8-sig', 'UTF-8'), ('cp1250', 'Windows-1250')]
+    FORMATS = [('', 'Rozpoznaj po rozszerzeniu'), ('csv', 'CSV'), ('camt053', 'camt.053 (XML)'), ('mt940', 'MT940')]
+    file = forms.FileField(label='Wyciąg (CSV, camt.053, MT940)')
+    format = forms.ChoiceField(choices=FORMATS, required=False, label='Format',
+                               widget=forms.Select(attrs={'class': 'form-control'}))
+    encoding = forms.ChoiceField(choices=ENCODINGS, initial='utf-8-sig', label='Kodowanie',
+                                 widget=forms.Select(attrs={'class': 'form-control'}))
+
+
 class CurrencySearchform(forms.ModelForm):
     class Meta:
         model = Currency
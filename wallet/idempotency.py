@@ -0,0 +1,69 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.transaction import atomic
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedirect
+from django.utils import timezone
+
+from wallet.models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+IDEMPOTENCY_FIELD = 'idempotency_key'
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+REPLAY_HEADER = 'Idempotent-Replayed'
+
+
+def idempotency_key_ttl():
+    return getattr(settings, 'IDEMPOTENCY_KEY_TTL', IDEMPOTENCY_KEY_TTL)
+
+
+def purge_idempotency_keys():
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=timezone.now() - idempotency_key_ttl()).delete()
+    return deleted
+
+
+# POST z nagłówkiem Idempotency-Key (albo polem idempotency_key) wykonuje zapis najwyżej raz.
+# Klucz jest rezerwowany wstawieniem wiersza w tej samej transakcji co zapis - unikalny indeks (user, key)
+# jest jedynym sprawdzeniem, a równoległe powtórzenie czeka na zakończenie pierwszego zapytania.
+# Zapamiętywane są tylko odpowiedzi oznaczone przez widok jako udany zapis (succeeded); błąd zgłoszony
+# komunikatem i przekierowaniem albo formularz z błędami można wysłać ponownie tym samym kluczem.
+# Klucz użyty dla innego adresu jest odrzucany zamiast odtwarzać cudzą odpowiedź.
+class IdempotentMixin:
+    def dispatch(self, request, *args, **kwargs):
+        if request.method != 'POST' or not request.user.is_authenticated:
+            return super().dispatch(request, *args, **kwargs)
+        key = request.META.get(IDEMPOTENCY_HEADER) or request.POST.get(IDEMPOTENCY_FIELD)
+        if not key:
+            return super().dispatch(request, *args, **kwargs)
+        if len(key) > IdempotencyKey._meta.get_field('key').max_length:
+            return HttpResponseBadRequest('Idempotency-Key jest za długi.')
+
+        path = request.path[:IdempotencyKey._meta.get_field('path').max_length]
+        with atomic():
+            try:
+                with atomic():
+                    record = IdempotencyKey.objects.create(user=request.user, key=key, path=path)
+            except IntegrityError:
+                return self.replay(IdempotencyKey.objects.filter(user=request.user, key=key).first(), path)
+            response = super().dispatch(request, *args, **kwargs)
+            if getattr(response, 'idempotent_success', False):
+                IdempotencyKey.objects.filter(id=record.id).update(
+                    status_code=response.status_code, location=response['Location'][:255])
+            else:
+                record.delete()
+            return response
+
+    # widok oznacza tak przekierowanie po udanym zapisie; tylko ono jest odtwarzane przy powtórzeniu
+    def succeeded(self, response):
+        response.idempotent_success = True
+        return response
+
+    def replay(self, record, path):
+        if record is not None and record.path != path:
+            return HttpResponse('Klucz Idempotency-Key został użyty dla innego zapytania.', status=422)
+        if record is None or not record.status_code:
+            return HttpResponse('Zapytanie z tym kluczem jest w trakcie realizacji.', status=409)
+        response = HttpResponseRedirect(record.location, status=record.status_code)
+        response[REPLAY_HEADER] = 'true'
+        return response
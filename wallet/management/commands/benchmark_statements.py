@@ -0,0 +1,74 @@
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from wallet.statements import STATEMENT_FORMATS
+
+FIRST_DAY = date(2020, 1, 1)
+
+
+def write_csv(path, count):
+    with open(path, 'w', encoding='utf-8') as stream:
+        stream.write('Data;Kwota;Opis;Kategoria\n')
+        for i in range(count):
+            stream.write(f'{FIRST_DAY + timedelta(days=i % 1500)};-{i % 500 + 1},{i % 100:02d};Operacja {i};Jedzenie\n')
+
+
+def write_camt053(path, count):
+    with open(path, 'w', encoding='utf-8') as stream:
+        stream.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                     '<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02"><BkToCstmrStmt><Stmt>\n')
+        for i in range(count):
+            stream.write(f'<Ntry><Amt Ccy="PLN">{i % 500 + 1}.{i % 100:02d}</Amt>'
+                         f'<CdtDbtInd>{"CRDT" if i % 4 == 0 else "DBIT"}</CdtDbtInd><Sts>BOOK</Sts>'
+                         f'<BookgDt><Dt>{FIRST_DAY + timedelta(days=i % 1500)}</Dt></BookgDt>'
+                         f'<NtryDtls><TxDtls><RmtInf><Ustrd>Operacja {i}</Ustrd></RmtInf></TxDtls></NtryDtls>'
+                         f'</Ntry>\n')
+        stream.write('</Stmt></BkToCstmrStmt></Document>\n')
+
+
+def write_mt940(path, count):
+    with open(path, 'w', encoding='utf-8') as stream:
+        stream.write(':20:BENCHMARK\n:25:/PL61109010140000071219812874\n:28C:1\n:60F:C200101PLN0,00\n')
+        for i in range(count):
+            day = (FIRST_DAY + timedelta(days=i % 1500)).strftime('%y%m%d')
+            stream.write(f':61:{day}{"C" if i % 4 == 0 else "D"}N{i % 500 + 1},{i % 100:02d}NTRFNONREF\n'
+                         f':86:020?00PRZELEW?20Operacja {i}\n?32KONTRAHENT\n')
+        stream.write(':62F:C201231PLN0,00\n-\n')
+
+
+WRITERS = {'csv': write_csv, 'camt053': write_camt053, 'mt940': write_mt940}
+
+
+class Command(BaseCommand):
+    help = 'Mierzy przepustowość i zużycie pamięci parserów wyciągów na wygenerowanych plikach (bez zapisu do bazy).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--format', choices=sorted(WRITERS), action='append')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory:
+            for statement_format in options['format'] or sorted(WRITERS):
+                path = Path(directory) / f'statement.{statement_format}'
+                WRITERS[statement_format](path, options['rows'])
+                parser, binary = STATEMENT_FORMATS[statement_format]
+                started = time.perf_counter()
+                parsed = self.parse(parser, binary, path)
+                elapsed = time.perf_counter() - started
+                # pamięć mierzona w osobnym przebiegu - tracemalloc wielokrotnie spowalnia parsowanie
+                tracemalloc.start()
+                self.parse(parser, binary, path)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self.stdout.write(f'{statement_format:8} {parsed} operacji, {path.stat().st_size / 2 ** 20:.1f} MB, '
+                                  f'{elapsed:.2f} s ({parsed / elapsed:,.0f}/s), '
+                                  f'szczyt pamięci {peak / 2 ** 20:.1f} MB')
+
+    def parse(self, parser, binary, path):
+        with open(path, 'rb') if binary else open(path, encoding='utf-8', newline='') as stream:
+            return sum(1 for _ in parser(stream))
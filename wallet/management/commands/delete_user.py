@@ -0,0 +1,32 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.transaction import atomic
+
+from wallet.deletion import DELETE_CHUNK_SIZE, UserDeletion, hide_user
+from wallet.tasks import delete_user, request_deletion
+
+
+class Command(BaseCommand):
+    help = 'Usuwa użytkownika i wszystkie jego dane partiami; konto jest od razu dezaktywowane.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--now', action='store_true', help='usuń w tym procesie zamiast zlecać zadanie celery')
+        parser.add_argument('--chunk-size', type=int, default=DELETE_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f'Nie ma użytkownika {options["username"]}')
+        with atomic():
+            hide_user(user)
+            if not options['now']:
+                request_deletion(delete_user, user.pk)
+        if not options['now']:
+            self.stdout.write(self.style.SUCCESS(f'Zlecono usunięcie użytkownika {user.username}'))
+            return
+        deleted = UserDeletion(user.pk, chunk_size=options['chunk_size']).run()
+        if deleted is None:
+            raise CommandError(f'Użytkownik {user.username} jest już usuwany')
+        self.stdout.write(self.style.SUCCESS(f'Usunięto użytkownika {user.username} i {deleted} powiązanych wierszy'))
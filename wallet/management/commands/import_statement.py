@@ -0,0 +1,52 @@
+from xml.etree.ElementTree import ParseError
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from wallet.statements import IMPORT_BATCH_SIZE, STATEMENT_FORMATS, StatementError, StatementImporter, \
+    detect_format, iter_csv_statement
+
+
+class Command(BaseCommand):
+    help = 'Importuje wyciąg bankowy (CSV, camt.053 albo MT940) jako wpływy i wydatki użytkownika, ' \
+           'partiami przez bulk_create.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=sorted(STATEMENT_FORMATS),
+                            help='format pliku; domyślnie rozpoznawany po rozszerzeniu')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+        parser.add_argument('--encoding', default='utf-8-sig')
+        parser.add_argument('--delimiter', help='separator kolumn CSV; domyślnie wykrywany z nagłówka')
+        parser.add_argument('--bloom', action='store_true',
+                            help='sprawdzaj duplikaty filtrem Blooma ze skrótów użytkownika wczytanych raz na import')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f'Nie ma użytkownika {options["username"]}')
+        statement_format = options['format'] or detect_format(options['path'])
+        parser, binary = STATEMENT_FORMATS[statement_format]
+        errors = []
+        importer = StatementImporter(user, batch_size=options['batch_size'], use_bloom_filter=options['bloom'])
+        if binary:
+            stream = open(options['path'], 'rb')
+        else:
+            stream = open(options['path'], encoding=options['encoding'], newline='')
+        with stream:
+            if parser is iter_csv_statement:
+                rows = parser(stream, errors, options['delimiter'])
+            else:
+                rows = parser(stream, errors)
+            try:
+                created = importer.run(rows, errors)
+            except (StatementError, ParseError) as exc:
+                raise CommandError(str(exc))
+        for line, message in errors:
+            self.stderr.write(f'Linia {line}: {message}')
+        for line, description in importer.duplicates:
+            self.stderr.write(f'Linia {line}: duplikat {description or ""}')
+        self.stdout.write(self.style.SUCCESS(f'Zaimportowano {created} operacji, pominięto {len(errors)} wierszy '
+                                             f'i {len(importer.duplicates)} duplikatów'))
@@ -0,0 +1,38 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wallet.rate_archives import iter_csv_rates, iter_json_rates, load_rate_records, ARCHIVE_BATCH_SIZE
+
+PARSERS = {'.json': (iter_json_rates, 'utf-8-sig'), '.csv': (iter_csv_rates, 'cp1250')}
+
+
+class Command(BaseCommand):
+    help = 'Wczytuje historyczne kursy NBP (tabele A/B, JSON lub CSV) z plików archiwum, bez dostępu do sieci.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='pliki archiwum albo katalogi z plikami .json/.csv')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE)
+        parser.add_argument('--encoding', help='kodowanie plików; domyślnie utf-8 dla JSON i cp1250 dla CSV')
+
+    def iter_files(self, paths):
+        for path in map(Path, paths):
+            if path.is_dir():
+                yield from sorted(file for file in path.rglob('*') if file.suffix.lower() in PARSERS)
+            elif path.suffix.lower() in PARSERS:
+                yield path
+            else:
+                raise CommandError(f'Nieobsługiwany plik: {path}')
+
+    def iter_records(self, files, encoding):
+        for file in files:
+            parser, default_encoding = PARSERS[file.suffix.lower()]
+            self.stdout.write(f'Wczytywanie {file}')
+            with open(file, encoding=encoding or default_encoding, newline='') as stream:
+                yield from parser(stream)
+
+    def handle(self, *args, **options):
+        files = list(self.iter_files(options['paths']))
+        records = self.iter_records(files, options['encoding'])
+        created, skipped = load_rate_records(records, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Dodano {created} kursów, pominięto {skipped} już wczytanych'))
@@ -0,0 +1,22 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from wallet.rollups import rebuild_rollups, ROLLUP_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Przelicza od zera tabelę DailyRollup na podstawie transakcji.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='nazwa użytkownika; domyślnie wszyscy')
+        parser.add_argument('--batch-size', type=int, default=ROLLUP_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"Użytkownik {options['user']} nie istnieje")
+        created = rebuild_rollups(user=user, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Utworzono {created} wierszy DailyRollup'))
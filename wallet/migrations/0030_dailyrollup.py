@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+from wallet.migrations._ledger import build_daily_rollups
+
+
+# sumy dzienne istniejących transakcji; brakujące transakcje wpisów Income/Expense dochodzą w 0037,
+# która potem liczy sumy od nowa
+def backfill_daily_rollups(apps, schema_editor):
+    build_daily_rollups(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0029_alter_currency_exchange_rate'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('transaction_type', models.CharField(choices=[('Expense', 'Expense'), ('Income', 'Income'), ('Savings', 'Savings'), ('Exchange', 'Exchange')], max_length=8)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=100)),
+                ('count', models.IntegerField(default=0)),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='wallet.category')),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wallet.currency')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'day', 'category', 'currency', 'transaction_type'), name='unique_daily_rollup')],
+            },
+        ),
+        migrations.RunPython(backfill_daily_rollups, migrations.RunPython.noop),
+    ]
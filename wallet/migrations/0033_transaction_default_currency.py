@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:07
+
+import django.db.models.deletion
+import wallet.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0032_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transaction',
+            name='currency',
+            field=models.ForeignKey(default=wallet.models.default_currency_id, on_delete=django.db.models.deletion.CASCADE, to='wallet.currency'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0033_transaction_default_currency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrencyRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('effective_date', models.DateField()),
+                ('mid', models.DecimalField(decimal_places=6, max_digits=16)),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rates', to='wallet.currency')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('currency', 'effective_date'), name='unique_currency_rate')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+from wallet.migrations._ledger import build_daily_rollups, link_ledger_transactions
+
+
+# Expense.save dawniej tworzyło nową Transaction przy każdym zapisie (także edycji) i nigdy jej nie podpinało.
+# Wpisy bez transakcji dostają najnowszą pasującą transakcję PLN albo nową, pozostałe identyczne kopie
+# wydatków są usuwane (szczegóły w wallet.migrations._ledger), a sumy dzienne liczone od nowa.
+def link_entries(apps, schema_editor):
+    link_ledger_transactions(apps)
+    build_daily_rollups(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0036_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.RunPython(link_entries, migrations.RunPython.noop),
+    ]
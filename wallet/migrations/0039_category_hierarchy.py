@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+# istniejące kategorie nie mają rodziców: każda dostaje tylko wiersz (ona sama, ona sama, 0)
+def link_existing_categories(apps, schema_editor):
+    Category = apps.get_model('wallet', 'Category')
+    CategoryClosure = apps.get_model('wallet', 'CategoryClosure')
+    CategoryClosure.objects.bulk_create(
+        (CategoryClosure(ancestor_id=category_id, descendant_id=category_id, depth=0)
+         for category_id in Category.objects.values_list('id', flat=True).iterator()),
+        batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0038_transaction_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='wallet.category'),
+        ),
+        migrations.CreateModel(
+            name='CategoryClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='wallet.category')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='wallet.category')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['descendant', 'ancestor'], name='category_closure_desc_idx')],
+                'constraints': [models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_category_closure')],
+            },
+        ),
+        migrations.RunPython(link_existing_categories, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0039_category_hierarchy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='hidden',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
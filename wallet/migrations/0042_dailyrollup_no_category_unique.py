@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:19
+
+from django.conf import settings
+from django.db import migrations, models
+
+from wallet.migrations._ledger import build_daily_rollups
+
+
+# równoległe zapisy mogły już utworzyć zdublowane wiersze bez kategorii; sumy liczone od nowa je scalają
+def merge_duplicate_rollups(apps, schema_editor):
+    build_daily_rollups(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0041_idempotencykey_path'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_rollups, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='dailyrollup',
+            constraint=models.UniqueConstraint(condition=models.Q(('category__isnull', True)), fields=('user', 'day', 'currency', 'transaction_type'), name='unique_daily_rollup_no_category'),
+        ),
+    ]
@@ -0,0 +1,84 @@
+from collections import defaultdict
+
+from django.db.models import Count, Q, Sum
+
+BATCH_SIZE = 1000
+ENTRY_FIELDS = ('user_id', 'amount', 'date', 'category_id', 'description')
+
+
+# Kroki migracji danych na modelach historycznych z apps.
+# Każdy wpis Income/Expense dostaje swoją transakcję PLN: najnowszą pasującą transakcję bez wpisu,
+# a gdy takiej nie ma (stare wpisy sprzed księgowania) - nową. Expense.save dawniej tworzyło nową
+# Transaction przy każdym zapisie i nigdy jej nie podpinało, więc pozostałe identyczne kopie wydatków
+# są usuwane, podobnie jak kopie po edycjach i usunięciach, których nie da się pomylić z wydatkiem z konta.
+# Transakcji przychodów nie usuwamy: Income.save zawsze podpinało swoją, a pasująca kopia jest osobnym
+# zapisem (np. wpłatą na konto PLN).
+def link_ledger_transactions(apps):
+    Transaction = apps.get_model('wallet', 'Transaction')
+    Currency = apps.get_model('wallet', 'Currency')
+    pln = Currency.objects.filter(code='PLN').values_list('id', flat=True).first()
+    if pln is None:
+        return
+
+    for model_name, remove_duplicates in (('Expense', True), ('Income', False)):
+        model = apps.get_model('wallet', model_name)
+        candidates = defaultdict(list)
+        for transaction_id, *key in Transaction.objects.filter(
+                transaction_type=model_name, currency_id=pln, **{f'{model_name.lower()}__isnull': True}
+        ).order_by('id').values_list('id', *ENTRY_FIELDS).iterator():
+            candidates[tuple(key)].append(transaction_id)
+
+        linked, missing = [], []
+        for entry in model.objects.filter(transaction__isnull=True).order_by('id').iterator():
+            found = candidates.get(tuple(getattr(entry, field) for field in ENTRY_FIELDS))
+            if found:
+                entry.transaction_id = found.pop()
+                linked.append(entry)
+            else:
+                missing.append(entry)
+
+        for start in range(0, len(missing), BATCH_SIZE):
+            batch = missing[start:start + BATCH_SIZE]
+            transactions = Transaction.objects.bulk_create([
+                Transaction(user_id=entry.user_id, amount=entry.amount, date=entry.date,
+                            category_id=entry.category_id, description=entry.description,
+                            transaction_type=model_name, currency_id=pln)
+                for entry in batch
+            ])
+            for entry, transaction in zip(batch, transactions):
+                entry.transaction_id = transaction.id
+            linked.extend(batch)
+        model.objects.bulk_update(linked, ['transaction'], batch_size=BATCH_SIZE)
+
+        if not remove_duplicates:
+            continue
+        duplicates = []
+        for key in model.objects.values_list(*ENTRY_FIELDS).distinct().iterator():
+            duplicates.extend(candidates.pop(tuple(key), []))
+        for start in range(0, len(duplicates), BATCH_SIZE):
+            Transaction.objects.filter(id__in=duplicates[start:start + BATCH_SIZE]).delete()
+
+        # wydatek z konta (ForExpenseView) nie ma opisu, a użytkownik bez konta w PLN nie ma wydatków z konta PLN
+        Account = apps.get_model('wallet', 'Account')
+        pln_account_users = Account.objects.filter(currency_id=pln).values('user_id')
+        Transaction.objects.filter(transaction_type=model_name, currency_id=pln, expense__isnull=True).filter(
+            Q(description__gt='') | ~Q(user_id__in=pln_account_users)).delete()
+
+
+# DailyRollup od zera z tabeli Transaction
+def build_daily_rollups(apps):
+    Transaction = apps.get_model('wallet', 'Transaction')
+    DailyRollup = apps.get_model('wallet', 'DailyRollup')
+    DailyRollup.objects.all().delete()
+    grouped = Transaction.objects.order_by().values(
+        'user_id', 'date', 'category_id', 'currency_id', 'transaction_type'
+    ).annotate(total=Sum('amount'), count=Count('id'))
+    batch = []
+    for row in grouped.iterator(chunk_size=BATCH_SIZE):
+        batch.append(DailyRollup(user_id=row['user_id'], day=row['date'], category_id=row['category_id'],
+                                 currency_id=row['currency_id'], transaction_type=row['transaction_type'],
+                                 total=row['total'], count=row['count']))
+        if len(batch) >= BATCH_SIZE:
+            DailyRollup.objects.bulk_create(batch)
+            batch = []
+    DailyRollup.objects.bulk_create(batch)
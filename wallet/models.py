@@ -1,94 +1,223 @@
 from datetime import date
+from decimal import Decimal
 
 from dateutil.relativedelta import relativedelta
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models
+from django.db.models import F, Q
+from django.db.transaction import atomic, on_commit
 from django.utils import timezone
 
 
+class CategoryQuerySet(models.QuerySet):
+    # 'is_built IN (true)' zamiast samej kolumny, żeby baza mogła użyć indeksu (is_built, user);
+    # kategorie ukryte czekają na usunięcie w tle
+    def built_in(self):
+        return self.filter(is_built__in=[True], hidden=False)
+
+    def owned_by(self, user):
+        return self.filter(user=user, is_built=False, hidden=False)
+
+    def available_to(self, user):
+        return self.filter(Q(is_built__in=[True]) | Q(user=user, is_built=False), hidden=False)
+
+
 class Category(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     name = models.CharField(max_length=64)
     description = models.TextField()
     is_built = models.BooleanField(default=False)
+    parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
+    hidden = models.BooleanField(default=False, editable=False)
+
+    objects = CategoryQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_built', 'user'], name='category_built_user_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    # zapamiętuje rodzica z bazy, żeby przy przeniesieniu poprawić CategoryClosure
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'parent_id' in field_names:
+            instance._loaded_parent_id = instance.parent_id
+        return instance
 
-class Expense(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    amount = models.DecimalField(max_digits=100, decimal_places=2)
-    date = models.DateField()
-    description = models.TextField(null=True, blank=True)
-    category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True, blank=True)
-    transaction = models.OneToOneField('Transaction', on_delete=models.CASCADE, related_name='expense', null=True, blank=True)
+    def clean(self):
+        if self.pk is not None and self.parent_id is not None and CategoryClosure.objects.filter(
+                ancestor_id=self.pk, descendant_id=self.parent_id).exists():
+            raise ValidationError({'parent': 'Kategoria nie może być podkategorią samej siebie.'})
 
     def save(self, *args, **kwargs):
+        with atomic():
+            adding = self._state.adding
+            if not adding:
+                previous = getattr(self, '_loaded_parent_id', None)
+                if not hasattr(self, '_loaded_parent_id'):
+                    previous = Category.objects.filter(pk=self.pk).values_list('parent_id', flat=True).first()
+            super().save(*args, **kwargs)
+            if adding:
+                CategoryClosure.link(self)
+            elif previous != self.parent_id:
+                CategoryClosure.move(self)
+            self._loaded_parent_id = self.parent_id
 
-        default_currency = Currency.objects.get(code='PLN')
-        transaction = Transaction.objects.create(
-            user=self.user,
-            amount=self.amount,
-            date=self.date,
-            description=self.description,
-            category=self.category,
-            transaction_type='Expense',
-            currency=default_currency
-        )
 
-        super(Expense, self).save(*args, **kwargs)
+# tabela domknięcia hierarchii kategorii: wiersz dla każdej pary (przodek, potomek), także (kategoria, ona sama);
+# suma kategorii razem z podkategoriami to jedno złączenie zamiast przechodzenia drzewa
+class CategoryClosure(models.Model):
+    ancestor = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveSmallIntegerField()
 
-    def delete(self, *args, **kwargs):
-        if self.transaction:
-            self.transaction.delete()
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='unique_category_closure'),
+        ]
+        indexes = [
+            models.Index(fields=['descendant', 'ancestor'], name='category_closure_desc_idx'),
+        ]
 
-        super(Expense, self).delete(*args, **kwargs)
+    @classmethod
+    def link(cls, category):
+        links = [cls(ancestor_id=category.pk, descendant_id=category.pk, depth=0)]
+        if category.parent_id is not None:
+            links.extend(cls(ancestor_id=ancestor_id, descendant_id=category.pk, depth=depth + 1)
+                         for ancestor_id, depth in cls.objects.filter(
+                             descendant_id=category.parent_id).values_list('ancestor_id', 'depth'))
+        cls.objects.bulk_create(links)
 
-    def transaction_type(self):
-        return 'Expense'
+    # przeniesienie poddrzewa: zrywa powiązania z dawnymi przodkami i dodaje iloczyn nowych przodków i poddrzewa
+    @classmethod
+    def move(cls, category):
+        subtree = list(cls.objects.filter(ancestor_id=category.pk).values_list('descendant_id', 'depth'))
+        subtree_ids = [descendant_id for descendant_id, _ in subtree]
+        if category.parent_id in subtree_ids:
+            raise ValueError('Category cannot be moved under its own descendant')
+        cls.objects.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+        if category.parent_id is not None:
+            ancestors = cls.objects.filter(descendant_id=category.parent_id).values_list('ancestor_id', 'depth')
+            cls.objects.bulk_create(
+                cls(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=ancestor_depth + depth + 1)
+                for ancestor_id, ancestor_depth in ancestors for descendant_id, depth in subtree)
 
 
-class Income(models.Model):
+class LedgerEntryQuerySet(models.QuerySet):
+    # wpisy z kategorii razem z jej podkategoriami
+    def in_category(self, category):
+        return self.filter(category__ancestor_links__ancestor=category)
+
+
+# wspólna ścieżka zapisu wydatków i wpływów: wpis i jego Transaction zapisywane razem, jedną transakcją bazy;
+# przy edycji aktualizowane są tylko zmienione kolumny, a bez zmian nie ma żadnego zapisu
+class LedgerEntry(models.Model):
+    TRANSACTION_TYPE = None
+    LEDGER_FIELDS = ('amount', 'date', 'description', 'category_id')
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=100, decimal_places=2)
     date = models.DateField()
     description = models.TextField(null=True, blank=True)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True, blank=True)
-    transaction = models.OneToOneField('Transaction', on_delete=models.CASCADE, related_name='income', null=True, blank=True)
 
-    def save(self, *args, **kwargs):
-        if not self.transaction:
-            default_currency = Currency.objects.get(code='PLN')
-            transaction = Transaction.objects.create(
-                user=self.user,
-                amount=self.amount,
-                date=self.date,
-                description=self.description,
-                category=self.category,
-                transaction_type='Income',
-                currency=default_currency
-            )
-            self.transaction = transaction
-        else:
-            self.transaction.amount = self.amount
-            self.transaction.date = self.date
-            self.transaction.description = self.description
-            self.transaction.category = self.category
-            self.transaction.save()
+    objects = LedgerEntryQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if set(cls.LEDGER_FIELDS) <= set(field_names):
+            instance._ledger_values = instance.ledger_values()
+        return instance
+
+    def ledger_values(self):
+        return {field: getattr(self, field) for field in self.LEDGER_FIELDS}
+
+    def changed_fields(self):
+        loaded = getattr(self, '_ledger_values', None)
+        current = self.ledger_values()
+        if loaded is None:
+            return list(current)
+        return [field for field, value in current.items() if loaded[field] != value]
 
-        super(Income, self).save(*args, **kwargs)
+    def save(self, *args, **kwargs):
+        adding = self._state.adding or self.transaction_id is None
+        changed = None if adding else self.changed_fields()
+        if changed == []:
+            return
+        with atomic():
+            if adding:
+                self.transaction = Transaction.objects.create(
+                    user_id=self.user_id,
+                    transaction_type=self.TRANSACTION_TYPE,
+                    currency_id=default_currency_id(),
+                    **self.ledger_values()
+                )
+                super().save(*args, **kwargs)
+            else:
+                transaction = self.transaction
+                for field in changed:
+                    setattr(transaction, field, getattr(self, field))
+                update_fields = [self._meta.get_field(field.removesuffix('_id')).name for field in changed]
+                transaction.save(update_fields=update_fields)
+                kwargs.setdefault('update_fields', update_fields)
+                super().save(*args, **kwargs)
+            self._ledger_values = self.ledger_values()
 
     def delete(self, *args, **kwargs):
-        if self.transaction:
-            self.transaction.delete()
+        with atomic():
+            result = super().delete(*args, **kwargs)
+            if self.transaction_id:
+                self.transaction.delete()
+        return result
+
+
+class Expense(LedgerEntry):
+    TRANSACTION_TYPE = 'Expense'
+
+    transaction = models.OneToOneField('Transaction', on_delete=models.CASCADE, related_name='expense', null=True, blank=True)
 
-        super(Income, self).delete(*args, **kwargs)
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-date', '-id'], name='expense_user_date_idx'),
+            models.Index(fields=['user', 'category', 'date'], name='expense_user_cat_date_idx'),
+        ]
+
+    def transaction_type(self):
+        return 'Expense'
+
+
+class Income(LedgerEntry):
+    TRANSACTION_TYPE = 'Income'
+
+    transaction = models.OneToOneField('Transaction', on_delete=models.CASCADE, related_name='income', null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-date', '-id'], name='income_user_date_idx'),
+            models.Index(fields=['user', 'category', 'date'], name='income_user_cat_date_idx'),
+        ]
 
     def transaction_type(self):
         return 'Income'
 
 
+# zmiany kwot jednym warunkowym UPDATE: sprawdzenie i zapis w bazie, bez wcześniejszego odczytu wiersza
+class SavingsQuerySet(models.QuerySet):
+    def deposit(self, amount):
+        return self.filter(remaining_amount__gte=amount).update(
+            current_amount=F('current_amount') + amount, remaining_amount=F('remaining_amount') - amount,
+            last_deposit_date=timezone.now().date())
+
+
 class Savings(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=64)
@@ -100,6 +229,8 @@ class Savings(models.Model):
     remaining_amount = models.DecimalField(max_digits=100, decimal_places=2, default=0)
     last_deposit_date = models.DateField(null=True, blank=True)
 
+    objects = SavingsQuerySet.as_manager()
+
     @property
     def today(self):
         return date.today()
@@ -127,6 +258,51 @@ class Currency(models.Model):
     def __str__(self):
         return self.code
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        invalidate_currency_registry()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        invalidate_currency_registry()
+        return result
+
+
+# historia średnich kursów NBP; Currency.exchange_rate trzyma tylko ostatni kurs
+class CurrencyRate(models.Model):
+    currency = models.ForeignKey(Currency, on_delete=models.CASCADE, related_name='rates')
+    effective_date = models.DateField()
+    mid = models.DecimalField(max_digits=16, decimal_places=6)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['currency', 'effective_date'], name='unique_currency_rate'),
+        ]
+
+
+def invalidate_currency_registry():
+    from wallet.currencies import currency_registry
+    # od razu dla bieżącego procesu i ponownie po commicie, żeby inne procesy nie wczytały starych danych
+    currency_registry.invalidate()
+    on_commit(currency_registry.invalidate)
+
+
+def default_currency_id():
+    from wallet.currencies import currency_registry
+    try:
+        return currency_registry.default().id
+    except Currency.DoesNotExist:
+        return None
+
+
+class AccountQuerySet(models.QuerySet):
+    def deposit(self, amount):
+        return self.update(balance=F('balance') + amount)
+
+    # zwraca 0, gdy saldo jest niewystarczające - nic nie zostaje zmienione
+    def withdraw(self, amount):
+        return self.filter(balance__gte=amount).update(balance=F('balance') - amount)
+
 
 class Account(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -134,6 +310,8 @@ class Account(models.Model):
     currency = models.ForeignKey(Currency, on_delete=models.CASCADE)
     balance = models.DecimalField(max_digits=100, decimal_places=2, default=0.0)
 
+    objects = AccountQuerySet.as_manager()
+
 
 class Transaction(models.Model):
     TRANSACTION_TYPES = [
@@ -148,4 +326,115 @@ class Transaction(models.Model):
     description = models.TextField(blank=True, null=True)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, blank=True, null=True)
     transaction_type = models.CharField(max_length=8, choices=TRANSACTION_TYPES)
-    currency = models.ForeignKey(Currency, on_delete=models.CASCADE, default=153)
+    currency = models.ForeignKey(Currency, on_delete=models.CASCADE, default=default_currency_id)
+    # skrót operacji z importu wyciągu; unikalny indeks chroni przed ponownym importem tych samych operacji
+    fingerprint = models.CharField(max_length=32, unique=True, null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-date'], name='transaction_user_date_idx'),
+            models.Index(fields=['user', 'currency', '-date', '-id'], name='transaction_user_cur_date_idx'),
+            models.Index(fields=['user', 'transaction_type', '-date'], name='transaction_user_type_date_idx'),
+        ]
+
+    ROLLUP_FIELDS = ('user_id', 'date', 'category_id', 'currency_id', 'transaction_type', 'amount')
+
+    # zapamiętuje stan z bazy, żeby przy edycji odjąć stare wartości z DailyRollup
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if set(cls.ROLLUP_FIELDS) <= set(field_names):
+            instance._rollup_key = instance.rollup_key()
+        return instance
+
+    def rollup_key(self):
+        return tuple(getattr(self, field) for field in self.ROLLUP_FIELDS)
+
+    def save(self, *args, **kwargs):
+        with atomic():
+            previous = None
+            if not self._state.adding:
+                previous = getattr(self, '_rollup_key', None)
+                if previous is None:
+                    previous = Transaction.objects.filter(pk=self.pk).values_list(*self.ROLLUP_FIELDS).first()
+            super(Transaction, self).save(*args, **kwargs)
+            current = self.rollup_key()
+            if previous != current:
+                if previous is not None:
+                    DailyRollup.add(*previous, sign=-1)
+                DailyRollup.add(*current)
+            self._rollup_key = current
+
+    def delete(self, *args, **kwargs):
+        with atomic():
+            key = getattr(self, '_rollup_key', None) or self.rollup_key()
+            result = super(Transaction, self).delete(*args, **kwargs)
+            DailyRollup.add(*key, sign=-1)
+        return result
+
+
+# dzienne sumy transakcji użytkownika, aktualizowane przy każdym zapisie Transaction
+class DailyRollup(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    day = models.DateField()
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, blank=True, null=True)
+    currency = models.ForeignKey(Currency, on_delete=models.CASCADE)
+    transaction_type = models.CharField(max_length=8, choices=Transaction.TRANSACTION_TYPES)
+    total = models.DecimalField(max_digits=100, decimal_places=2, default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day', 'category', 'currency', 'transaction_type'],
+                                    name='unique_daily_rollup'),
+            # NULL w unikalnym indeksie nie jest równy innemu NULL, więc wiersze bez kategorii
+            # (wymiany, przelewy) potrzebują osobnego indeksu, żeby równoległy pierwszy zapis trafił w IntegrityError
+            models.UniqueConstraint(fields=['user', 'day', 'currency', 'transaction_type'],
+                                    condition=Q(category__isnull=True), name='unique_daily_rollup_no_category'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'transaction_type', 'currency', 'day'], name='rollup_user_type_cur_day_idx'),
+        ]
+
+    @classmethod
+    def add(cls, user_id, day, category_id, currency_id, transaction_type, amount, sign=1):
+        amount = Decimal(str(amount)) * sign
+        key = {'user_id': user_id, 'day': day, 'category_id': category_id, 'currency_id': currency_id,
+               'transaction_type': transaction_type}
+        rows = cls.objects.filter(**key)
+        with atomic():
+            if rows.update(total=F('total') + amount, count=F('count') + sign):
+                return
+            try:
+                with atomic():
+                    cls.objects.create(total=amount, count=sign, **key)
+            except IntegrityError:
+                # inny zapis utworzył wiersz w międzyczasie
+                rows.update(total=F('total') + amount, count=F('count') + sign)
+
+
+# dzienny stan majątku użytkownika (suma sald wszystkich kont) w walucie domyślnej, zapisywany nocnym zadaniem
+class NetWorthSnapshot(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    day = models.DateField()
+    total = models.DecimalField(max_digits=100, decimal_places=2)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day'], name='unique_net_worth_snapshot'),
+        ]
+
+
+# klucz idempotencji zapytania POST i zapamiętana odpowiedź; powtórzenie zapytania dostaje tę samą odpowiedź
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    path = models.CharField(max_length=255, blank=True)
+    status_code = models.PositiveSmallIntegerField(default=0)
+    location = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key'),
+        ]
@@ -0,0 +1,72 @@
+from datetime import date, timedelta
+from decimal import Decimal
+
+import numpy as np
+
+from wallet.crossrates import get_cross_rates
+from wallet.models import Account, NetWorthSnapshot, default_currency_id
+from wallet.rates import get_rate_history
+
+SNAPSHOT_BATCH_SIZE = 1000
+
+
+def _to_decimal(value):
+    return Decimal(f'{value:.2f}')
+
+
+# salda wszystkich kont (albo kont wybranych użytkowników) przeliczone na walutę docelową w jednym kroku
+def net_worth_totals(target, users=None):
+    accounts = Account.objects.all() if users is None else Account.objects.filter(user__in=users)
+    rows = list(accounts.values_list('user_id', 'currency_id', 'balance'))
+    if not rows:
+        return {}
+    user_ids, currency_ids, balances = zip(*rows)
+    converted = get_cross_rates().convert([float(balance) for balance in balances], list(currency_ids), target)
+    unique_user_ids, positions = np.unique(np.asarray(user_ids, dtype=np.int64), return_inverse=True)
+    totals = np.bincount(positions, weights=converted, minlength=len(unique_user_ids))
+    # użytkownik z kontem w walucie bez kursu nie dostaje tego dnia zapisu zamiast zaniżonej sumy
+    return {user_id: _to_decimal(total) for user_id, total in zip(unique_user_ids.tolist(), totals)
+            if np.isfinite(total)}
+
+
+def net_worth(user, target):
+    cross_rates = get_cross_rates()
+    rows = list(Account.objects.filter(user=user).order_by('id').values_list('id', 'name', 'currency_id', 'balance'))
+    currency_ids = [currency_id for _, _, currency_id, _ in rows]
+    cross_rates.check([target, *currency_ids])
+    converted = cross_rates.convert([float(balance) for *_, balance in rows], currency_ids, target) \
+        if rows else np.zeros(0)
+    accounts = [{
+        'id': account_id,
+        'name': name,
+        'currency': cross_rates.codes[cross_rates.index(currency_id)],
+        'balance': balance,
+        'converted': _to_decimal(value),
+    } for (account_id, name, currency_id, balance), value in zip(rows, converted)]
+    return {
+        'currency': cross_rates.codes[cross_rates.index(target)],
+        'total': _to_decimal(converted.sum()),
+        'accounts': accounts,
+    }
+
+
+# historia z zapisanych stanów (w PLN), przeliczona na walutę docelową po kursie z danego dnia
+def net_worth_history(user, target_id, days=90):
+    rows = list(NetWorthSnapshot.objects.filter(user=user, day__gte=date.today() - timedelta(days=days))
+                .order_by('day').values_list('day', 'total'))
+    if not rows:
+        return []
+    snapshot_days, totals = zip(*rows)
+    rates = get_rate_history().convert(np.ones(len(rows)), [target_id] * len(rows),
+                                       np.array(snapshot_days, dtype='datetime64[D]'))
+    values = np.asarray([float(total) for total in totals]) / rates
+    return [(day, _to_decimal(value)) for day, value in zip(snapshot_days, values)]
+
+
+def record_net_worth(day=None):
+    day = day or date.today()
+    totals = net_worth_totals(default_currency_id())
+    NetWorthSnapshot.objects.bulk_create(
+        [NetWorthSnapshot(user_id=user_id, day=day, total=total) for user_id, total in totals.items()],
+        batch_size=SNAPSHOT_BATCH_SIZE, update_conflicts=True, unique_fields=['user', 'day'], update_fields=['total'])
+    return len(totals)
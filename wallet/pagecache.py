@@ -0,0 +1,133 @@
+import hashlib
+import time
+from datetime import date, datetime, timezone
+
+from django.contrib import messages
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.middleware.csrf import get_token
+from django.db.transaction import on_commit
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from wallet.currencies import currency_registry
+from wallet.models import Income, Expense, Transaction, Account, Savings, Category
+
+DATA_VERSION_KEY = 'wallet:data-version:{}'
+# osobna wersja samych kategorii: zapis wydatku nie unieważnia katalogu kategorii
+CATEGORY_VERSION_KEY = 'wallet:category-version:{}'
+# wersja wspólna dla wszystkich użytkowników: kategorie wbudowane
+SHARED_VERSION = 'shared'
+PAGE_KEY = 'wallet:page:{}:{}:{}:{}'
+PAGE_CACHE_TIMEOUT = 60 * 60
+TRACKED_MODELS = (Income, Expense, Transaction, Account, Savings, Category)
+
+
+def _version_key(user_id, key_format=DATA_VERSION_KEY):
+    return key_format.format(SHARED_VERSION if user_id is None else user_id)
+
+
+def _touch(key):
+    # wersją jest czas ostatniego zapisu: każda nowa wartość jest inna od poprzednich,
+    # a jednocześnie nadaje się na nagłówek Last-Modified
+    cache.set(key, time.time_ns(), timeout=None)
+
+
+# (wersja wspólna, wersja użytkownika); zmienia się przy każdym zapisie, więc stare strony nigdy nie są trafiane
+def data_versions(user_id, key_format=DATA_VERSION_KEY):
+    keys = [_version_key(None, key_format), _version_key(user_id, key_format)]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # brak wersji (np. wypadła z cache) traktujemy jak zmianę danych teraz
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key)
+    return versions[keys[0]], versions[keys[1]]
+
+
+def data_version(user_id):
+    return '{}.{}'.format(*data_versions(user_id))
+
+
+def last_modified(*versions):
+    return datetime.fromtimestamp(max(versions) / 1e9, tz=timezone.utc)
+
+
+# user_id=None unieważnia strony wszystkich użytkowników
+def bump_data_version(user_id=None, key_format=DATA_VERSION_KEY):
+    key = _version_key(user_id, key_format)
+    # od razu i ponownie po commicie: strona policzona w trakcie transakcji nie zostanie pod nową wersją
+    _touch(key)
+    on_commit(lambda: _touch(key))
+
+
+def page_cache_key(user_id, view_name, params=()):
+    digest = hashlib.blake2b(repr(params).encode(), digest_size=16).hexdigest()
+    return PAGE_KEY.format(user_id, view_name, data_version(user_id), digest)
+
+
+# kontekst strony z cache albo policzony przez build() i zapisany pod (użytkownik, widok, parametry, wersja)
+def cached_context(user, view_name, params, build, timeout=PAGE_CACHE_TIMEOUT):
+    key = page_cache_key(user.pk, view_name, params)
+    context = cache.get(key)
+    if context is None:
+        context = build()
+        cache.set(key, context, timeout)
+    return context
+
+
+# warunkowy GET: ETag i Last-Modified liczone z samych numerów wersji, a If-None-Match dostaje 304
+# bez uruchamiania widoku
+class ConditionalGetMixin:
+    # True, gdy treść strony zależy też od kursów walut
+    depends_on_rates = False
+
+    # jeden odczyt wersji na żądanie, wspólny dla ETag i Last-Modified (widok jest tworzony dla każdego żądania)
+    def page_versions(self, request):
+        if not hasattr(self, '_page_versions'):
+            versions = data_versions(request.user.pk)
+            if self.depends_on_rates:
+                versions += (currency_registry.version,)
+            self._page_versions = versions
+        return self._page_versions
+
+    # dodatkowe wartości, od których zależy treść strony
+    def page_etag_parts(self, request):
+        return ()
+
+    def page_etag(self, request, *args, **kwargs):
+        # ścieżka z parametrami i dzisiejsza data, bo strony pokazują m.in. ostatnie 30 dni;
+        # sekret CSRF, bo formularze strony zapisanej przed ponownym logowaniem miałyby nieważny token
+        get_token(request)
+        parts = (request.user.pk, request.get_full_path(), date.today(), request.META.get('CSRF_COOKIE'),
+                 self.page_versions(request), self.page_etag_parts(request))
+        return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+    def page_last_modified(self, request, *args, **kwargs):
+        # nie wcześniej niż początek dzisiejszego dnia: wczorajsza strona jest nieaktualna nawet bez zapisów
+        start_of_today = datetime.combine(date.today(), datetime.min.time()).astimezone(timezone.utc)
+        return max(last_modified(*self.page_versions(request)), start_of_today)
+
+    def dispatch(self, request, *args, **kwargs):
+        # komunikaty po przekierowaniu muszą zostać pokazane, więc taka strona zawsze jest renderowana
+        if request.method not in ('GET', 'HEAD') or len(messages.get_messages(request)):
+            return super().dispatch(request, *args, **kwargs)
+        view = condition(etag_func=self.page_etag, last_modified_func=self.page_last_modified)(super().dispatch)
+        response = view(request, *args, **kwargs)
+        # strona prywatna, a przeglądarka ma ją zawsze sprawdzić, zamiast zgadywać jej świeżość
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+# odbiornik podpięty tylko pod śledzone modele: odbiornik bez nadawcy wyłączyłby szybkie usuwanie
+# (DELETE bez wcześniejszego SELECT) dla wszystkich modeli
+def invalidate_user_pages(sender, instance, **kwargs):
+    user_id = None if sender is Category and instance.is_built else instance.user_id
+    bump_data_version(user_id)
+    if sender is Category:
+        bump_data_version(user_id, CATEGORY_VERSION_KEY)
+
+
+for model in TRACKED_MODELS:
+    post_save.connect(invalidate_user_pages, sender=model)
+    post_delete.connect(invalidate_user_pages, sender=model)
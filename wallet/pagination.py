@@ -0,0 +1,45 @@
+from datetime import date
+
+from django.db.models import Q
+
+PAGE_SIZE = 50
+CURSOR_PARAM = 'after'
+
+
+def encode_cursor(obj):
+    return f'{obj.date.isoformat()}.{obj.id}'
+
+
+def decode_cursor(cursor):
+    try:
+        day, pk = cursor.split('.')
+        return date.fromisoformat(day), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+# stronicowanie kursorem po (-date, -id): koszt strony nie zależy od tego, jak daleko jest w historii
+class KeysetPage:
+    def __init__(self, queryset, cursor=None, page_size=PAGE_SIZE):
+        queryset = queryset.order_by('-date', '-id')
+        position = decode_cursor(cursor)
+        if position is not None:
+            day, pk = position
+            queryset = queryset.filter(Q(date__lt=day) | Q(date=day, id__lt=pk))
+        rows = list(queryset[:page_size + 1])
+        self.object_list = rows[:page_size]
+        self.cursor = cursor if position is not None else None
+        self.next_cursor = encode_cursor(self.object_list[-1]) if len(rows) > page_size else None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
@@ -0,0 +1,127 @@
+import csv
+import json
+import re
+from datetime import date
+from decimal import Decimal
+
+from django.db.transaction import atomic
+
+from wallet.models import Currency, CurrencyRate, invalidate_currency_registry
+
+CHUNK_SIZE = 1 << 16
+ARCHIVE_BATCH_SIZE = 5000
+SKIPPED_CHARACTERS = ' \t\r\n,[]'
+CSV_COLUMN = re.compile(r'^(\d+)([A-Z]{3})$')
+CSV_DAY = re.compile(r'^\d{8}$')
+
+
+# kolejne obiekty JSON z pliku (lista tabel, pojedyncza tabela albo jedna tabela na linię),
+# czytane porcjami, bez wczytywania całego pliku
+def iter_json_objects(stream, chunk_size=CHUNK_SIZE):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position] in SKIPPED_CHARACTERS:
+            position += 1
+        if position < len(buffer):
+            try:
+                obj, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                pass
+            else:
+                yield obj
+                continue
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            if position < len(buffer):
+                raise ValueError(f'Niekompletny obiekt JSON na końcu pliku: {buffer[position:position + 50]!r}')
+            return
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+# rekordy (kod, nazwa, data, kurs) z tabel NBP w formacie API: tabele A/B albo serie jednej waluty
+def iter_json_rates(stream):
+    for obj in iter_json_objects(stream):
+        if 'effectiveDate' in obj:
+            effective_date = date.fromisoformat(obj['effectiveDate'])
+            for rate in obj['rates']:
+                yield rate['code'], rate['currency'], effective_date, Decimal(str(rate['mid']))
+        else:
+            for rate in obj['rates']:
+                yield obj['code'], obj['currency'], date.fromisoformat(rate['effectiveDate']), \
+                    Decimal(str(rate['mid']))
+
+
+# archiwum CSV NBP: 'data;1THB;1USD;100HUF;...', kursy z przecinkiem dziesiętnym, stopka z opisami
+def iter_csv_rates(stream):
+    reader = csv.reader(stream, delimiter=';')
+    header = next(reader, [])
+    columns = []
+    for index, title in enumerate(header):
+        match = CSV_COLUMN.match(title.strip())
+        if match:
+            columns.append((index, match.group(2), Decimal(match.group(1))))
+    names = {}
+    for row in reader:
+        if not row:
+            continue
+        day = row[0].strip()
+        if not CSV_DAY.match(day):
+            # wiersz z nazwami walut (jeśli archiwum go zawiera) albo stopka
+            if not names and columns and len(row) > columns[-1][0]:
+                row_names = {code: row[index].strip() for index, code, _ in columns if row[index].strip()}
+                if any(name != code for code, name in row_names.items()):
+                    names = row_names
+            continue
+        effective_date = date(int(day[:4]), int(day[4:6]), int(day[6:]))
+        for index, code, multiplier in columns:
+            value = row[index].strip().replace(',', '.') if index < len(row) else ''
+            if value:
+                yield code, names.get(code, code), effective_date, Decimal(value) / multiplier
+
+
+# wstawia kursy partiami, każda partia w osobnej transakcji: przerwany import można uruchomić ponownie,
+# a daty już wczytane są pomijane. Currency.exchange_rate dostaje na końcu najnowszy kurs z archiwum,
+# o ile w bazie nie było nowszego (waluty z tabeli B nie są odświeżane zadaniem)
+def load_rate_records(records, batch_size=ARCHIVE_BATCH_SIZE):
+    currency_ids = dict(Currency.objects.values_list('code', 'id'))
+    loaded = set(CurrencyRate.objects.values_list('currency_id', 'effective_date'))
+    newest = {}
+    for currency_id, effective_date in loaded:
+        newest[currency_id] = max(newest.get(currency_id, effective_date), effective_date)
+    latest = {}
+    created = skipped = 0
+    batch = []
+
+    def flush():
+        with atomic():
+            CurrencyRate.objects.bulk_create(batch, ignore_conflicts=True)
+        return len(batch)
+
+    for code, name, effective_date, mid in records:
+        if code not in currency_ids:
+            currency, _ = Currency.objects.get_or_create(code=code, defaults={'name': name[:64], 'exchange_rate': mid})
+            currency_ids[code] = currency.id
+        key = (currency_ids[code], effective_date)
+        if key[0] not in latest or latest[key[0]][0] < effective_date:
+            latest[key[0]] = (effective_date, mid)
+        if key in loaded:
+            skipped += 1
+            continue
+        loaded.add(key)
+        batch.append(CurrencyRate(currency_id=key[0], effective_date=effective_date, mid=mid))
+        if len(batch) >= batch_size:
+            created += flush()
+            batch = []
+    if batch:
+        created += flush()
+    updated = 0
+    for currency_id, (effective_date, mid) in latest.items():
+        if effective_date >= newest.get(currency_id, effective_date):
+            updated += Currency.objects.filter(id=currency_id).exclude(exchange_rate=round(mid, 2)).update(
+                exchange_rate=mid)
+    if created or updated:
+        invalidate_currency_registry()
+    return created, skipped
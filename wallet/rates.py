@@ -0,0 +1,94 @@
+import threading
+from decimal import Decimal
+
+import numpy as np
+
+from wallet.currencies import currency_registry
+from wallet.models import CurrencyRate
+
+FIRST_DAY = np.datetime64('1900-01-01', 'D')
+# klucz wyszukiwania to (pozycja waluty, dzień) upakowane w jedną liczbę
+KEY_SPAN = 1 << 20
+
+
+def _day_numbers(days):
+    return (np.asarray(days, dtype='datetime64[D]') - FIRST_DAY).astype(np.int64)
+
+
+# historia kursów w pamięci: jedna posortowana tablica, kurs na dzień D to wyszukiwanie binarne
+class RateHistory:
+    def __init__(self, currency_ids, days, mids):
+        currency_ids = np.asarray(currency_ids, dtype=np.int64)
+        self._positions = {currency_id: i for i, currency_id in enumerate(np.unique(currency_ids).tolist())}
+        self._entry_positions = np.fromiter((self._positions[currency_id] for currency_id in currency_ids.tolist()),
+                                            dtype=np.int64, count=len(currency_ids))
+        keys = self._entry_positions * KEY_SPAN + _day_numbers(days)
+        order = np.argsort(keys, kind='stable')
+        self._keys = keys[order]
+        self._entry_positions = self._entry_positions[order]
+        self._mids = np.asarray(mids, dtype=np.float64)[order]
+
+    @classmethod
+    def load(cls):
+        rows = list(CurrencyRate.objects.values_list('currency_id', 'effective_date', 'mid'))
+        if not rows:
+            return cls([], np.array([], dtype='datetime64[D]'), [])
+        currency_ids, days, mids = zip(*rows)
+        return cls(currency_ids, np.array(days, dtype='datetime64[D]'), [float(mid) for mid in mids])
+
+    def rates(self, currency_ids, days):
+        # kurs obowiązujący w danym dniu: ostatnia tabela z datą <= D; NaN, gdy brak historii
+        currency_ids = np.asarray(currency_ids, dtype=np.int64)
+        positions = np.fromiter((self._positions.get(currency_id, -1) for currency_id in currency_ids.tolist()),
+                                dtype=np.int64, count=len(currency_ids))
+        keys = positions * KEY_SPAN + _day_numbers(days)
+        found = np.searchsorted(self._keys, keys, side='right') - 1
+        valid = (positions >= 0) & (found >= 0)
+        valid[valid] &= self._entry_positions[found[valid]] == positions[valid]
+        result = np.full(len(currency_ids), np.nan)
+        result[valid] = self._mids[found[valid]]
+        return result
+
+    def rate(self, currency_id, day):
+        rate = self.rates([currency_id], [day])[0]
+        return None if np.isnan(rate) else Decimal(str(rate))
+
+    def convert(self, amounts, currency_ids, days):
+        # przelicza całą listę kwot na PLN naraz; bez historii używa bieżącego kursu z Currency
+        rates = self.rates(currency_ids, days)
+        missing = np.flatnonzero(np.isnan(rates))
+        if len(missing):
+            default_id = currency_registry.default().id
+            currency_ids = np.asarray(currency_ids, dtype=np.int64)
+            for i in missing:
+                currency_id = int(currency_ids[i])
+                rates[i] = 1.0 if currency_id == default_id else float(
+                    currency_registry.get_by_id(currency_id).exchange_rate)
+        return np.asarray([float(amount) for amount in amounts], dtype=np.float64) * rates
+
+    def convert_transactions(self, transactions, attribute='change_in_PLN'):
+        transactions = list(transactions)
+        if not transactions:
+            return transactions
+        converted = self.convert([transaction.amount for transaction in transactions],
+                                 [transaction.currency_id for transaction in transactions],
+                                 np.array([transaction.date for transaction in transactions], dtype='datetime64[D]'))
+        for transaction, value in zip(transactions, converted):
+            setattr(transaction, attribute, Decimal(f'{value:.2f}'))
+        return transactions
+
+
+_lock = threading.Lock()
+_history = None
+_history_version = None
+
+
+# historia budowana raz na proces i przeładowywana razem z rejestrem walut (po każdym odświeżeniu kursów)
+def get_rate_history():
+    global _history, _history_version
+    version = currency_registry.version
+    if _history is None or _history_version != version:
+        history = RateHistory.load()
+        with _lock:
+            _history, _history_version = history, version
+    return _history
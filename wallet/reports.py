@@ -0,0 +1,94 @@
+from decimal import Decimal
+
+import numpy as np
+
+from wallet.models import DailyRollup
+from wallet.pagecache import cached_context
+
+
+def _to_day(value):
+    return np.datetime64(value, 'D')
+
+
+# sumy narastające po dniach dla każdej kategorii: suma dowolnego zakresu to dwa odczyty i odejmowanie.
+# Źródłem są sumy dzienne wszystkich transakcji PLN danego typu, więc raport przychodów obejmuje też
+# wpłaty na konta PLN i przelewy na nie - w odróżnieniu od listy przychodów (IncomeView),
+# która sumuje same wpisy Income
+class PrefixSumReport:
+    def __init__(self, days, category_ids, daily):
+        # days: kolejne dni (bez przerw), daily: macierz kategorie x dni w groszach
+        self.days = days
+        self.category_ids = list(category_ids)
+        self._index = {category_id: i for i, category_id in enumerate(self.category_ids)}
+        self.cumulative = np.zeros((len(self.category_ids), len(days) + 1), dtype=np.int64)
+        np.cumsum(daily, axis=1, out=self.cumulative[:, 1:])
+        self.cumulative_all = self.cumulative.sum(axis=0)
+
+    @classmethod
+    def for_user(cls, user, transaction_type, currency_code='PLN'):
+        rows = list(DailyRollup.objects.filter(
+            user=user, transaction_type=transaction_type, currency__code=currency_code
+        ).exclude(count=0).values_list('day', 'category_id', 'total'))
+        if not rows:
+            return cls(np.array([], dtype='datetime64[D]'), [], np.zeros((0, 0), dtype=np.int64))
+
+        days, category_ids, totals = zip(*rows)
+        days = np.array(days, dtype='datetime64[D]')
+        first = days.min()
+        all_days = np.arange(first, days.max() + 1)
+        unique_ids = sorted(set(category_ids), key=lambda category_id: (category_id is None, category_id))
+        index = {category_id: i for i, category_id in enumerate(unique_ids)}
+
+        daily = np.zeros((len(unique_ids), len(all_days)), dtype=np.int64)
+        rows_idx = np.fromiter((index[category_id] for category_id in category_ids), dtype=np.int64,
+                               count=len(category_ids))
+        cents = np.fromiter((int(total * 100) for total in totals), dtype=np.int64, count=len(totals))
+        np.add.at(daily, (rows_idx, (days - first).astype(np.int64)), cents)
+        return cls(all_days, unique_ids, daily)
+
+    # zbudowany raport z cache, pod wersją danych użytkownika: macierz jest liczona od nowa dopiero po zapisie
+    @classmethod
+    def cached_for_user(cls, user, transaction_type, currency_code='PLN'):
+        return cached_context(user, 'prefix-sum-report', (transaction_type, currency_code),
+                              lambda: cls.for_user(user, transaction_type, currency_code))
+
+    def _bounds(self, date_from, date_to):
+        start = 0 if date_from is None else int(np.searchsorted(self.days, _to_day(date_from), 'left'))
+        end = len(self.days) if date_to is None else int(np.searchsorted(self.days, _to_day(date_to), 'right'))
+        return start, max(start, end)
+
+    def total(self, date_from=None, date_to=None, category=None):
+        start, end = self._bounds(date_from, date_to)
+        if category is None:
+            cents = self.cumulative_all[end] - self.cumulative_all[start]
+        else:
+            category_id = getattr(category, 'pk', category)
+            if category_id not in self._index:
+                return Decimal('0.00')
+            row = self.cumulative[self._index[category_id]]
+            cents = row[end] - row[start]
+        return Decimal(int(cents)) / 100
+
+    def monthly_pivot(self, date_from=None, date_to=None, category=None):
+        start, end = self._bounds(date_from, date_to)
+        if start == end:
+            return {}
+        category_ids = self.category_ids
+        cumulative = self.cumulative
+        if category is not None:
+            category_id = getattr(category, 'pk', category)
+            category_ids = [category_id] if category_id in self._index else []
+            cumulative = cumulative[[self._index[category_id] for category_id in category_ids]]
+
+        months = self.days[start:end].astype('datetime64[M]')
+        starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+        ends = np.r_[starts[1:], len(months)]
+        sums = cumulative[:, start + ends] - cumulative[:, start + starts]
+
+        pivot = {}
+        for month, column in zip(months[starts], sums.T):
+            pivot[str(month)] = {
+                category_id: Decimal(int(cents)) / 100
+                for category_id, cents in zip(category_ids, column) if cents
+            }
+        return pivot
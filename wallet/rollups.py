@@ -0,0 +1,51 @@
+from django.db.models import Count, Sum
+from django.db.transaction import atomic
+
+from wallet.models import DailyRollup, Transaction
+from wallet.pagecache import bump_data_version
+
+ROLLUP_BATCH_SIZE = 1000
+
+
+def rebuild_rollups(user=None, batch_size=ROLLUP_BATCH_SIZE):
+    transactions = Transaction.objects.all()
+    rollups = DailyRollup.objects.all()
+    if user is not None:
+        transactions = transactions.filter(user=user)
+        rollups = rollups.filter(user=user)
+
+    grouped = transactions.order_by().values(
+        'user_id', 'date', 'category_id', 'currency_id', 'transaction_type'
+    ).annotate(total=Sum('amount'), count=Count('id'))
+
+    created = 0
+    with atomic():
+        rollups.delete()
+        batch = []
+        for row in grouped.iterator(chunk_size=batch_size):
+            batch.append(DailyRollup(user_id=row['user_id'], day=row['date'], category_id=row['category_id'],
+                                     currency_id=row['currency_id'], transaction_type=row['transaction_type'],
+                                     total=row['total'], count=row['count']))
+            if len(batch) >= batch_size:
+                DailyRollup.objects.bulk_create(batch)
+                created += len(batch)
+                batch = []
+        DailyRollup.objects.bulk_create(batch)
+        created += len(batch)
+    # zapis przez bulk_create nie wysyła sygnałów, a raporty z sum dziennych są w cache
+    bump_data_version(user.pk if user is not None else None)
+    return created
+
+
+# suma z tabeli dziennej: koszt zależy od liczby dni, a nie liczby transakcji
+def rollup_total(user, transaction_type, date_from=None, date_to=None, category=None, currency=None):
+    rollups = DailyRollup.objects.filter(user=user, transaction_type=transaction_type)
+    if date_from:
+        rollups = rollups.filter(day__gte=date_from)
+    if date_to:
+        rollups = rollups.filter(day__lte=date_to)
+    if category:
+        rollups = rollups.filter(category=category)
+    if currency:
+        rollups = rollups.filter(currency=currency)
+    return rollups.aggregate(Sum('total'))['total__sum'] or 0
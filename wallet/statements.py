@@ -0,0 +1,395 @@
+import csv
+import hashlib
+import math
+import re
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.db.transaction import atomic
+from xml.etree.ElementTree import iterparse
+
+from wallet.currencies import currency_registry
+from wallet.models import Category, Currency, DailyRollup, Expense, Income, Transaction
+from wallet.pagecache import bump_data_version
+
+IMPORT_BATCH_SIZE = 2000
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y', '%d-%m-%Y', '%Y%m%d')
+# nagłówki kolumn rozpoznawane w wyciągach (małe litery, po polsku i po angielsku)
+COLUMNS = {
+    'date': ('date', 'data', 'data operacji', 'data księgowania'),
+    'amount': ('amount', 'kwota', 'kwota operacji'),
+    'description': ('description', 'opis', 'tytuł', 'tytul', 'opis operacji'),
+    'category': ('category', 'kategoria'),
+    'currency': ('currency', 'waluta'),
+}
+
+StatementRow = namedtuple('StatementRow', 'line date amount description category currency')
+
+
+class StatementError(ValueError):
+    pass
+
+
+def _parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise StatementError(f'Nieprawidłowa data: {value!r}')
+
+
+def _parse_amount(value):
+    value = value.replace('\xa0', '').replace(' ', '')
+    if ',' in value:
+        value = value.replace('.', '').replace(',', '.')
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise StatementError(f'Nieprawidłowa kwota: {value!r}') from None
+
+
+# wiersze wyciągu czytane po jednym; kwota ujemna to wydatek, dodatnia wpływ.
+# Błędne wiersze są pomijane i dopisywane do listy errors jako (numer linii, opis).
+def iter_csv_statement(stream, errors=None, delimiter=None):
+    header_line = stream.readline()
+    if delimiter is None:
+        delimiter = ';' if header_line.count(';') > header_line.count(',') else ','
+    header = next(csv.reader([header_line], delimiter=delimiter), [])
+    titles = [title.strip().lower() for title in header]
+    positions = {}
+    for column, names in COLUMNS.items():
+        for name in names:
+            if name in titles:
+                positions[column] = titles.index(name)
+                break
+    if 'date' not in positions or 'amount' not in positions:
+        raise StatementError('Wyciąg musi mieć kolumny z datą i kwotą.')
+
+    def cell(row, column):
+        index = positions.get(column)
+        return row[index].strip() if index is not None and index < len(row) else ''
+
+    for line, row in enumerate(csv.reader(stream, delimiter=delimiter), start=2):
+        if not any(value.strip() for value in row):
+            continue
+        try:
+            amount = _parse_amount(cell(row, 'amount'))
+            if not amount:
+                raise StatementError('Kwota równa zero.')
+            yield StatementRow(line, _parse_date(cell(row, 'date')), amount, cell(row, 'description') or None,
+                               cell(row, 'category'), cell(row, 'currency').upper())
+        except StatementError as exc:
+            if errors is None:
+                raise StatementError(f'Linia {line}: {exc}') from None
+            errors.append((line, str(exc)))
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _child(element, *path):
+    for name in path:
+        element = next((child for child in element if _local_name(child.tag) == name), None)
+        if element is None:
+            return None
+    return element
+
+
+def _child_text(element, *path):
+    element = _child(element, *path)
+    return element.text.strip() if element is not None and element.text else ''
+
+
+def _camt_entry(entry, line):
+    amount_element = _child(entry, 'Amt')
+    if amount_element is None:
+        raise StatementError('Brak kwoty.')
+    amount = _parse_amount(amount_element.text or '')
+    if _child_text(entry, 'CdtDbtInd') == 'DBIT':
+        amount = -amount
+    booked = _child_text(entry, 'BookgDt', 'Dt') or _child_text(entry, 'BookgDt', 'DtTm')[:10] \
+        or _child_text(entry, 'ValDt', 'Dt')
+    details = _child(entry, 'NtryDtls', 'TxDtls', 'RmtInf')
+    description = ' '.join(child.text.strip() for child in details if _local_name(child.tag) == 'Ustrd'
+                           and child.text) if details is not None else ''
+    return StatementRow(line, _parse_date(booked), amount, description or _child_text(entry, 'AddtlNtryInf') or None,
+                        '', amount_element.get('Ccy', '').upper())
+
+
+# camt.053 (ISO 20022) czytany przyrostowo: każdy element <Ntry> jest przetwarzany zaraz po wczytaniu
+# i odpinany od rodzica, więc zużycie pamięci nie zależy od wielkości pliku. Strumień binarny.
+def iter_camt053_statement(stream, errors=None):
+    parents = []
+    number = 0
+    for event, element in iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if _local_name(element.tag) != 'Ntry':
+            continue
+        number += 1
+        try:
+            yield _camt_entry(element, number)
+        except StatementError as exc:
+            if errors is None:
+                raise StatementError(f'Pozycja {number}: {exc}') from None
+            errors.append((number, str(exc)))
+        element.clear()
+        if parents:
+            parents[-1].remove(element)
+
+
+MT940_TAG = re.compile(r'^:(\d{2}[A-Z]?):(.*)$')
+MT940_BALANCE = re.compile(r'^[CD](\d{6})([A-Z]{3})')
+MT940_LINE = re.compile(r'^(\d{6})(\d{4})?(R?[CD])[A-Z]?(\d+,\d*)')
+MT940_SUBFIELD = re.compile(r'[?<](\d{2})')
+
+
+def _mt940_description(text):
+    # pole :86: w formacie strukturalnym (?20...?25 albo <20...) - opis z podpól 20-29
+    parts = MT940_SUBFIELD.split(text.replace('\n', ''))
+    if len(parts) == 1:
+        return ' '.join(text.split())
+    fields = zip(parts[1::2], parts[2::2])
+    return ''.join(value for code, value in fields if '20' <= code <= '29').strip() or ' '.join(text.split())
+
+
+def _mt940_line(value, line, currency):
+    match = MT940_LINE.match(value)
+    if not match:
+        raise StatementError(f'Nieprawidłowe pole :61: {value[:40]!r}')
+    amount = _parse_amount(match.group(4))
+    if match.group(3) in ('D', 'RC'):
+        amount = -amount
+    try:
+        day = datetime.strptime(match.group(1), '%y%m%d').date()
+    except ValueError:
+        raise StatementError(f'Nieprawidłowa data: {match.group(1)!r}') from None
+    return StatementRow(line, day, amount, None, '', currency)
+
+
+# kolejne pola (numer linii, znacznik, wartość); linie kontynuacji są doklejane do wartości pola
+def _mt940_fields(stream):
+    tag = value = None
+    start = 0
+    for number, line in enumerate(stream, start=1):
+        line = line.rstrip('\r\n')
+        match = MT940_TAG.match(line)
+        if match is None and tag is not None and line and line[0] not in '-{}':
+            value += '\n' + line
+            continue
+        if tag is not None:
+            yield start, tag, value
+            tag = None
+        if match is not None:
+            tag, value, start = match.group(1), match.group(2), number
+    if tag is not None:
+        yield start, tag, value
+
+
+# MT940 czytany linia po linii: automat zapamiętuje walutę z salda otwarcia, operację z pola :61:
+# i uzupełnia ją opisem z :86:; rekord jest oddawany, gdy zaczyna się następne pole
+def iter_mt940_statement(stream, errors=None):
+    currency = ''
+    pending = None
+    for line, tag, value in _mt940_fields(stream):
+        if tag == '86':
+            if pending is not None:
+                pending = pending._replace(description=_mt940_description(value) or None)
+            continue
+        if pending is not None:
+            yield pending
+            pending = None
+        if tag in ('60F', '60M'):
+            match = MT940_BALANCE.match(value)
+            currency = match.group(2) if match else currency
+        elif tag == '61':
+            try:
+                pending = _mt940_line(value, line, currency)
+            except StatementError as exc:
+                if errors is None:
+                    raise StatementError(f'Linia {line}: {exc}') from None
+                errors.append((line, str(exc)))
+    if pending is not None:
+        yield pending
+
+
+# format: (parser, czy parser czyta strumień binarny)
+STATEMENT_FORMATS = {
+    'csv': (iter_csv_statement, False),
+    'camt053': (iter_camt053_statement, True),
+    'mt940': (iter_mt940_statement, False),
+}
+FORMAT_SUFFIXES = {'.csv': 'csv', '.xml': 'camt053', '.sta': 'mt940', '.mt940': 'mt940', '.940': 'mt940'}
+
+
+def detect_format(filename):
+    suffix = '.' + filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return FORMAT_SUFFIXES.get(suffix, 'csv')
+
+
+# znormalizowany skrót operacji: ta sama operacja z dwóch nakładających się wyciągów daje ten sam skrót.
+# occurrence odróżnia identyczne operacje z jednego pliku (np. dwie takie same płatności kartą jednego dnia).
+def transaction_fingerprint(user_id, day, amount, currency_code, description, occurrence=0):
+    normalized = '|'.join((str(user_id), day.isoformat(), f'{Decimal(amount):.2f}', currency_code,
+                           ' '.join((description or '').lower().split()), str(occurrence)))
+    return hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+
+
+# filtr Blooma na skrótach: "na pewno nie ma" bez zapytania do bazy, "może jest" wymaga sprawdzenia
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, fingerprint):
+        first, second = int(fingerprint[:16], 16), int(fingerprint[16:], 16) | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, fingerprint):
+        for position in self._positions(fingerprint):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, fingerprint):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(fingerprint))
+
+
+# import partiami: transakcje i wpisy wstawiane przez bulk_create (bez save() dla każdego wiersza),
+# każda partia w osobnej transakcji bazy, DailyRollup aktualizowany sumami z całej partii
+class StatementImporter:
+    def __init__(self, user, batch_size=IMPORT_BATCH_SIZE, create_categories=True, use_bloom_filter=False):
+        self.user = user
+        self.batch_size = batch_size
+        self.create_categories = create_categories
+        self.categories = {category.name.lower(): category.id for category in Category.objects.available_to(user)}
+        default_currency = currency_registry.default()
+        self.default_currency_id, self.default_currency_code = default_currency.id, default_currency.code
+        self.currencies = {}
+        self.occurrences = defaultdict(int)
+        self.created = 0
+        self.duplicates = []
+        self.known = self.load_bloom_filter() if use_bloom_filter else None
+
+    # skróty operacji użytkownika wczytane raz na import; partie bez trafień w filtrze nie pytają bazy
+    def load_bloom_filter(self):
+        fingerprints = Transaction.objects.filter(user=self.user, fingerprint__isnull=False)
+        bloom = BloomFilter(fingerprints.count() + 100 * self.batch_size)
+        for fingerprint in fingerprints.values_list('fingerprint', flat=True).iterator():
+            bloom.add(fingerprint)
+        return bloom
+
+    def category_id(self, name):
+        if not name:
+            return None
+        key = name.lower()
+        if key not in self.categories:
+            self.categories[key] = Category.objects.create(
+                user=self.user, name=name[:64], description='Import').id if self.create_categories else None
+        return self.categories[key]
+
+    # None dla nieznanego kodu; brak też jest zapamiętany, bo każde nietrafienie przeładowuje rejestr walut
+    def currency_id(self, code):
+        if not code:
+            return self.default_currency_id
+        if code not in self.currencies:
+            try:
+                self.currencies[code] = currency_registry.get(code).id
+            except Currency.DoesNotExist:
+                self.currencies[code] = None
+        return self.currencies[code]
+
+    def run(self, rows, errors=None):
+        batch = []
+        for row in rows:
+            currency_id = self.currency_id(row.currency)
+            if currency_id is None:
+                if errors is None:
+                    raise StatementError(f'Linia {row.line}: nieznana waluta {row.currency!r}') from None
+                errors.append((row.line, f'Nieznana waluta: {row.currency!r}'))
+                continue
+            code = row.currency or self.default_currency_code
+            fingerprint = transaction_fingerprint(self.user.id, row.date, row.amount, code, row.description)
+            occurrence = self.occurrences[fingerprint]
+            self.occurrences[fingerprint] += 1
+            if occurrence:
+                fingerprint = transaction_fingerprint(self.user.id, row.date, row.amount, code, row.description,
+                                                      occurrence)
+            batch.append((row.line, Transaction(
+                user=self.user, amount=abs(row.amount), date=row.date, description=row.description,
+                category_id=self.category_id(row.category), currency_id=currency_id,
+                transaction_type='Income' if row.amount > 0 else 'Expense', fingerprint=fingerprint)))
+            if len(batch) >= self.batch_size:
+                self.flush(batch)
+                batch = []
+        if batch:
+            self.flush(batch)
+        return self.created
+
+    # całą partię sprawdza jedno zapytanie po unikalnym indeksie; z filtrem Blooma tylko "może istniejące" skróty
+    def existing_fingerprints(self, fingerprints):
+        if self.known is not None:
+            fingerprints = [fingerprint for fingerprint in fingerprints if fingerprint in self.known]
+        if not fingerprints:
+            return set()
+        return set(Transaction.objects.filter(fingerprint__in=fingerprints).values_list('fingerprint', flat=True))
+
+    def flush(self, batch):
+        existing = self.existing_fingerprints([transaction.fingerprint for _, transaction in batch])
+        transactions = []
+        for line, transaction in batch:
+            if transaction.fingerprint in existing:
+                self.duplicates.append((line, transaction.description))
+            else:
+                transactions.append(transaction)
+        if not transactions:
+            return
+        with atomic():
+            Transaction.objects.bulk_create(transactions)
+            entries = {Income: [], Expense: []}
+            for transaction in transactions:
+                # wpisy Income/Expense tylko w walucie domyślnej, jak przy dodawaniu przez formularz
+                if transaction.currency_id == self.default_currency_id:
+                    model = Income if transaction.transaction_type == 'Income' else Expense
+                    entries[model].append(model(
+                        user=self.user, amount=transaction.amount, date=transaction.date,
+                        description=transaction.description, category_id=transaction.category_id,
+                        transaction=transaction))
+            for model, objects in entries.items():
+                model.objects.bulk_create(objects)
+            self.add_rollups(transactions)
+            # bulk_create nie wysyła sygnałów zapisu
+            bump_data_version(self.user.id)
+        if self.known is not None:
+            for transaction in transactions:
+                self.known.add(transaction.fingerprint)
+        self.created += len(transactions)
+
+    def add_rollups(self, transactions):
+        totals = defaultdict(lambda: [Decimal(0), 0])
+        for transaction in transactions:
+            key = (transaction.user_id, transaction.date, transaction.category_id, transaction.currency_id,
+                   transaction.transaction_type)
+            totals[key][0] += transaction.amount
+            totals[key][1] += 1
+        # istniejące wiersze z dni partii czytane raz (z blokadą) i zastępowane nowymi sumami:
+        # jedno DELETE i jeden bulk_create zamiast UPDATE dla każdej grupy
+        existing = DailyRollup.objects.select_for_update().filter(
+            user=self.user, day__range=(min(key[1] for key in totals), max(key[1] for key in totals)))
+        replaced = []
+        for rollup_id, *key, total, count in existing.values_list(
+                'id', 'user_id', 'day', 'category_id', 'currency_id', 'transaction_type', 'total', 'count'):
+            key = tuple(key)
+            if key in totals:
+                totals[key][0] += total
+                totals[key][1] += count
+                replaced.append(rollup_id)
+        DailyRollup.objects.filter(id__in=replaced).delete()
+        DailyRollup.objects.bulk_create(
+            [DailyRollup(user_id=key[0], day=key[1], category_id=key[2], currency_id=key[3], transaction_type=key[4],
+                         total=total, count=count) for key, (total, count) in totals.items()])
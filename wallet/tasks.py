@@ -1,31 +1,175 @@
-from celery import shared_task
+import logging
+from datetime import timedelta
+from decimal import Decimal
+
 import requests
-from django.core.exceptions import ObjectDoesNotExist
-from .models import Currency
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db.transaction import atomic, on_commit
+from django.utils import timezone
+from kombu.exceptions import OperationalError
 
+from .deletion import CategoryDeletion, UserDeletion
+from .idempotency import purge_idempotency_keys
+from .models import Category, Currency, CurrencyRate, invalidate_currency_registry
+from .networth import record_net_worth
 
-@shared_task
+logger = logging.getLogger(__name__)
+
+NBP_RATES_URL = 'http://api.nbp.pl/api/exchangerates/tables/A/'
+NBP_TIMEOUT = (3.05, 10)
+
+ETAG_KEY = 'wallet:nbp:etag'
+LAST_MODIFIED_KEY = 'wallet:nbp:last-modified'
+EFFECTIVE_DATE_KEY = 'wallet:nbp:effective-date'
+LAST_REFRESH_KEY = 'wallet:nbp:last-refresh'
+REFRESH_LOCK_KEY = 'wallet:nbp:refresh-lock'
+
+# odświeżenie na żądanie najwyżej raz na tyle czasu; resztę robi harmonogram celery beat
+MIN_REFRESH_INTERVAL = timedelta(minutes=15)
+RATES_STALE_AFTER = timedelta(days=1)
+
+# jedna sesja na proces workera: połączenia HTTP są używane ponownie między uruchomieniami zadania
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        _session.headers['Accept'] = 'application/json'
+    return _session
+
+
+def fetch_rates_table(url=None, timeout=None):
+    headers = {}
+    etag = cache.get(ETAG_KEY)
+    last_modified = cache.get(LAST_MODIFIED_KEY)
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    response = get_session().get(url or getattr(settings, 'NBP_RATES_URL', NBP_RATES_URL), headers=headers,
+                                 timeout=timeout or getattr(settings, 'NBP_TIMEOUT', NBP_TIMEOUT))
+    if response.status_code == 304:
+        return None, response
+    response.raise_for_status()
+    return response.json()[0], response
+
+
+def save_rates_table(table):
+    currencies = [
+        Currency(code=rate['code'], name=rate['currency'], exchange_rate=Decimal(str(rate['mid'])))
+        for rate in table['rates']
+    ]
+    with atomic():
+        Currency.objects.bulk_create(currencies, update_conflicts=True, unique_fields=['code'],
+                                     update_fields=['name', 'exchange_rate'])
+        currency_ids = dict(Currency.objects.filter(
+            code__in=[currency.code for currency in currencies]).values_list('code', 'id'))
+        CurrencyRate.objects.bulk_create(
+            [CurrencyRate(currency_id=currency_ids[rate['code']], effective_date=table['effectiveDate'],
+                          mid=Decimal(str(rate['mid']))) for rate in table['rates']],
+            update_conflicts=True, unique_fields=['currency', 'effective_date'], update_fields=['mid'])
+        # bulk_create omija Currency.save, więc rejestr walut trzeba unieważnić ręcznie
+        invalidate_currency_registry()
+    return len(currencies)
+
+
+@shared_task(autoretry_for=(requests.RequestException,), retry_backoff=True, max_retries=3)
 def update_exchange_rates():
-    try:
-        response = requests.get('http://api.nbp.pl/api/exchangerates/tables/A/')
-        data = response.json()
+    table, response = fetch_rates_table()
+    if table is None:
+        logger.info('Exchange rates not modified since the last run')
+        cache.set(LAST_REFRESH_KEY, timezone.now(), timeout=None)
+        return 'not-modified'
 
-        currencies = data[0]['rates']
+    effective_date = table.get('effectiveDate')
+    if effective_date and effective_date == cache.get(EFFECTIVE_DATE_KEY):
+        logger.info('Exchange rates for %s are already stored', effective_date)
+        updated = 'unchanged'
+    else:
+        updated = save_rates_table(table)
+        cache.set(EFFECTIVE_DATE_KEY, effective_date, timeout=None)
+        logger.info('Updated %s exchange rates effective %s', updated, effective_date)
 
-        for currency in currencies:
-            code = currency['code']
-            name = currency['currency']
-            rate = currency['mid']
+    if response.headers.get('ETag'):
+        cache.set(ETAG_KEY, response.headers['ETag'], timeout=None)
+    if response.headers.get('Last-Modified'):
+        cache.set(LAST_MODIFIED_KEY, response.headers['Last-Modified'], timeout=None)
+    cache.set(LAST_REFRESH_KEY, timezone.now(), timeout=None)
+    return updated
 
-            try:
-                currency_object = Currency.objects.get(code=code)
-                currency_object.name = name
-                currency_object.exchange_rate = rate
-                currency_object.save()
-            except Currency.DoesNotExist:
-                Currency.objects.create(code=code, name=name, exchange_rate=rate)
 
-        print('Exchange rates updated successfully!')
-    except Exception as e:
-        print(f'Error updating exchange rates: {e}')
+@shared_task
+def record_net_worth_snapshots():
+    recorded = record_net_worth()
+    logger.info('Recorded net worth for %s users', recorded)
+    return recorded
 
+
+@shared_task
+def purge_expired_idempotency_keys():
+    deleted = purge_idempotency_keys()
+    logger.info('Purged %s expired idempotency keys', deleted)
+    return deleted
+
+
+@shared_task
+def delete_category(category_id):
+    deleted = CategoryDeletion(category_id).run()
+    logger.info('Deleted category %s with %s dependent rows', category_id, deleted)
+    return deleted
+
+
+@shared_task
+def delete_user(user_id):
+    deleted = UserDeletion(user_id).run()
+    logger.info('Deleted user %s with %s dependent rows', user_id, deleted)
+    return deleted
+
+
+# kategorie ukryte, których zadanie nie trafiło do kolejki albo zostało przerwane
+@shared_task
+def delete_hidden_categories():
+    deleted = 0
+    for category_id in Category.objects.filter(hidden=True).exclude(parent__hidden=True).values_list('id', flat=True):
+        deleted += CategoryDeletion(category_id).run() or 0
+    return deleted
+
+
+# zadanie trafia do kolejki dopiero po commicie, żeby worker widział obiekt już ukryty
+def request_deletion(task, pk):
+    def enqueue():
+        try:
+            task.delay(pk)
+        except OperationalError:
+            logger.exception('Could not queue %s for %s; it will be retried by the scheduled cleanup', task.name, pk)
+    on_commit(enqueue)
+
+
+def rates_status():
+    last_refresh = cache.get(LAST_REFRESH_KEY)
+    return {
+        'last_refresh': last_refresh,
+        'effective_date': cache.get(EFFECTIVE_DATE_KEY),
+        'is_stale': last_refresh is None or timezone.now() - last_refresh > RATES_STALE_AFTER,
+    }
+
+
+# single-flight: z wielu równoczesnych wyświetleń strony do kolejki trafia najwyżej jedno zadanie
+def request_rates_refresh():
+    last_refresh = cache.get(LAST_REFRESH_KEY)
+    if last_refresh is not None and timezone.now() - last_refresh < MIN_REFRESH_INTERVAL:
+        return False
+    if not cache.add(REFRESH_LOCK_KEY, timezone.now(), timeout=MIN_REFRESH_INTERVAL.total_seconds()):
+        return False
+    try:
+        update_exchange_rates.delay()
+    except OperationalError:
+        logger.exception('Could not queue exchange rate refresh')
+        cache.delete(REFRESH_LOCK_KEY)
+        return False
+    return True
@@ -1,12 +1,41 @@
-from datetime import datetime
+import json
+import re
+import threading
+from datetime import datetime, date, timedelta
+from io import StringIO
+from pathlib import Path
 from decimal import Decimal
 import pytest
+from django.db import IntegrityError, OperationalError, connection
+from django.db.transaction import atomic
 from django.test import Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth.models import User, AnonymousUser
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import ValidationError
+from django.db.models import Sum
+from django.utils import timezone
+from django.utils.http import http_date, parse_http_date
 from wallet.forms import IncomeExpenseAddForm, SavingsAddForm, LoginForm, RegisterForm, CategoryAddForm, \
     AccountAddForm, ForIncomeExpenseAddForm
-from wallet.models import Income, Category, Transaction, Expense, Savings, Account
+from wallet.categories import category_catalogue
+from wallet.crossrates import get_cross_rates
+from wallet.currencies import CurrencyRegistry, currency_registry
+from wallet.models import Income, Category, CategoryClosure, Transaction, Expense, Savings, Account, DailyRollup, Currency, \
+    CurrencyRate, NetWorthSnapshot, IdempotencyKey
+from wallet.pagecache import bump_data_version, data_version
+from wallet.pagination import KeysetPage, PAGE_SIZE
+from wallet.rate_archives import iter_json_objects
+from wallet.statements import BloomFilter, StatementError, StatementImporter, StatementRow, iter_camt053_statement, \
+    iter_csv_statement, iter_mt940_statement, transaction_fingerprint
+from wallet.rates import RateHistory, get_rate_history
+from wallet.reports import PrefixSumReport
+from wallet.deletion import CategoryDeletion
+from wallet.tasks import update_exchange_rates, record_net_worth_snapshots, purge_expired_idempotency_keys, \
+    delete_category, delete_hidden_categories
+from wallet.rollups import rebuild_rollups, rollup_total
 from wallet.views import CategoryView
 
 
@@ -22,9 +51,54 @@ def test_dashboard(user, expenses, incomes, transaction_pln, transaction_for, fo
     assert response.context['together'] == Decimal('-75')
     assert response.context['sum_expenses_round'] == 225
     assert response.context['sum_income_round'] == 150
-    assert response.context['transactionsPLN'].count() == 7
-    assert response.context['transactionsFOR'].count() == 1
-    assert response.context['account'].count() == 3
+    assert len(response.context['transactionsPLN']) == 7
+    assert len(response.context['transactionsFOR']) == 1
+    assert len(response.context['account']) == 3
+
+
+def _dashboard_query_count(user):
+    client = Client()
+    client.force_login(user)
+    # liczymy koszt przeliczenia strony, a nie odczytu z cache
+    bump_data_version(None)
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse('dashboard'))
+    assert response.status_code == 200
+    return len(queries), response
+
+
+@pytest.mark.django_db
+def test_dashboard_recent(user, zloty, foreign_accounts):
+    exchange = Category.objects.create(name='wymiana')
+    Expense.objects.create(amount=40, user=user, date=date.today())
+    Income.objects.create(amount=100, user=user, date=date.today())
+    Income.objects.create(amount=60, user=user, date=date.today(), category=exchange)
+    Transaction.objects.create(user=user, amount=2, date=date.today(), transaction_type='Exchange',
+                               currency=foreign_accounts[2].currency)
+    _, response = _dashboard_query_count(user)
+    assert response.context['sum_expenses'] == Decimal('40')
+    assert response.context['sum_income'] == Decimal('100')
+    assert response.context['together'] == Decimal('60')
+    assert len(response.context['transactionsEXC']) == 1
+    assert response.context['transactionsEXC'][0].change_in_PLN == Decimal('4')
+
+
+@pytest.mark.django_db
+def test_dashboard_query_count_constant(user, zloty, foreign_accounts):
+    Expense.objects.create(amount=1, user=user, date=date.today())
+    Transaction.objects.create(user=user, amount=1, date=date.today(), transaction_type='Exchange',
+                               currency=foreign_accounts[0].currency)
+    _dashboard_query_count(user)
+    few, _ = _dashboard_query_count(user)
+    for i in range(20):
+        Expense.objects.create(amount=1, user=user, date=date.today())
+        Income.objects.create(amount=1, user=user, date=date.today())
+        Transaction.objects.create(user=user, amount=1, date=date.today(), transaction_type='Exchange',
+                                   currency=foreign_accounts[i % 3].currency)
+        Account.objects.create(name='acc%d' % i, balance=1, currency=foreign_accounts[i % 3].currency, user=user)
+    many, response = _dashboard_query_count(user)
+    assert len(response.context['transactionsEXC']) == 10
+    assert many == few
 
 
 @pytest.mark.django_db
@@ -132,7 +206,7 @@ def test_income_get(incomes, user):
     url = reverse('income')
     response = client.get(url)
     assert response.status_code == 200
-    assert response.context['incomes'].count() == 3
+    assert len(response.context['incomes']) == 3
     expected_total_income = sum(income.amount for income in incomes)
     assert response.context['total_income'] == expected_total_income
 
@@ -149,6 +223,19 @@ def test_income_post(incomes, post_data, user):
     assert response.context['total_income'] == expected_total_income
 
 
+@pytest.mark.django_db
+def test_income_post_total_counts_listed_entries_only(user, zloty):
+    Income.objects.create(amount=10, user=user, date='2024-08-01')
+    # wpłata na konto PLN i stary wpis bez transakcji
+    Transaction.objects.create(user=user, amount=500, date='2024-08-01', transaction_type='Income', currency=zloty)
+    Income.objects.bulk_create([Income(amount=7, user=user, date='2024-08-02')])
+    client = Client()
+    client.force_login(user)
+    response = client.post(reverse('income'), {'date_from': '2024-08-01', 'date_to': '2024-08-02'})
+    assert response.context['incomes'].count() == 2
+    assert response.context['total_income'] == 17
+
+
 @pytest.mark.django_db
 def test_income_nolog():
     client = Client()
@@ -165,7 +252,7 @@ def test_expense_get(expenses, user):
     url = reverse('expense')
     response = client.get(url)
     assert response.status_code == 200
-    assert response.context['expenses'].count() == 3
+    assert len(response.context['expenses']) == 3
     expected_total_expense = sum(expense.amount for expense in expenses)
     assert response.context['total_expense'] == expected_total_expense
 
@@ -387,6 +474,18 @@ def test_category_delete_view_post_invalid(user):
     assert response.status_code == 404
 
 
+@pytest.mark.django_db
+def test_category_delete_other_users(user, main_category):
+    foreign = Category.objects.create(name='cudza', user=User.objects.create(username='other'))
+    client = Client()
+    client.force_login(user)
+    for category in (foreign, main_category):
+        url = reverse('category_delete', args=[category.id])
+        assert client.get(url).status_code == 404
+        assert client.post(url).status_code == 404
+        assert Category.objects.filter(id=category.id).exists()
+
+
 @pytest.mark.django_db
 def test_category_delete_nolog(category):
     client = Client()
@@ -648,7 +747,7 @@ def test_account_detail(user, foreign_accounts, transactions, foreign_currency):
     assert transactions[0].transaction_type == 'Income'
     assert foreign_accounts[0].name == 'AAA'
     assert len(transactions) == 1
-    assert response.context['transactions'].count() == 1
+    assert len(response.context['transactions']) == 1
 
 
 @pytest.mark.django_db
@@ -781,6 +880,16 @@ def test_changetopln(user, account, zloty):
                                    currency=account.currency, date=datetime.now())
 
 
+@pytest.mark.django_db
+def test_changetopln_fractional_amount(user, foreign_accounts, zloty):
+    client = Client()
+    client.force_login(user)
+    Category.objects.create(name='Wymiana', is_built=True)
+    client.post(reverse('change_to_PLN', args=[foreign_accounts[1].id]), {'amount': '1.50'})
+    assert Income.objects.get(user=user).amount == Decimal('0.75')
+    assert Account.objects.get(id=foreign_accounts[1].id).balance == Decimal('0.50')
+
+
 @pytest.mark.django_db
 def test_changetopln_invalid(user, foreign_accounts):
     client = Client()
@@ -803,3 +912,1093 @@ def test_changetopln_nolog(foreign_accounts):
     response = client.get(url)
     assert response.status_code == 302
     assert reverse('login') in response.url
+
+
+def _rollup_rows(user):
+    return set(DailyRollup.objects.filter(user=user).exclude(count=0).values_list(
+        'day', 'category_id', 'currency_id', 'transaction_type', 'total', 'count'))
+
+
+@pytest.mark.django_db
+def test_rollup_income_expense_lifecycle(user, zloty, category):
+    income = Income.objects.create(amount=100, user=user, date='2024-08-01', category=category)
+    Income.objects.create(amount=50, user=user, date='2024-08-01', category=category)
+    expense = Expense.objects.create(amount=30, user=user, date='2024-08-02')
+    rollup = DailyRollup.objects.get(user=user, day='2024-08-01', transaction_type='Income')
+    assert rollup.total == 150
+    assert rollup.count == 2
+
+    income.amount = 10
+    income.date = '2024-08-03'
+    income.save()
+    expense.amount = 40
+    expense.save()
+    assert Transaction.objects.filter(user=user, transaction_type='Expense').count() == 1
+    assert DailyRollup.objects.get(user=user, day='2024-08-01', transaction_type='Income').total == 50
+    assert DailyRollup.objects.get(user=user, day='2024-08-03', transaction_type='Income').total == 10
+    assert DailyRollup.objects.get(user=user, transaction_type='Expense').total == 40
+
+    expense.delete()
+    assert DailyRollup.objects.get(user=user, transaction_type='Expense').count == 0
+    assert rollup_total(user, 'Income', date_from='2024-08-01', date_to='2024-08-31') == 60
+
+
+@pytest.mark.django_db
+def test_rollup_without_category_is_unique(user, zloty):
+    key = dict(user=user, day=date(2024, 8, 1), category=None, currency=zloty, transaction_type='Exchange')
+    DailyRollup.objects.create(total=1, count=1, **key)
+    with pytest.raises(IntegrityError), atomic():
+        DailyRollup.objects.create(total=2, count=1, **key)
+    DailyRollup.add(user.id, date(2024, 8, 1), None, zloty.id, 'Exchange', 2)
+    assert list(DailyRollup.objects.filter(user=user).values_list('total', 'count')) == [(Decimal('3.00'), 2)]
+
+
+@pytest.mark.django_db
+def test_rollup_account_transactions(user, account, zloty):
+    client = Client()
+    client.force_login(user)
+    client.post(reverse('for_income_add', args=[account.id]), {'amount': 20, 'date': '2024-08-01'})
+    client.post(reverse('for_expense_add', args=[account.id]), {'amount': 5, 'date': '2024-08-01'})
+    Category.objects.create(name='Wymiana', is_built=True)
+    client.post(reverse('change_to_PLN', args=[account.id]), {'amount': 3})
+    assert rollup_total(user, 'Income', currency=account.currency) == 20
+    assert rollup_total(user, 'Expense', currency=account.currency) == 5
+    assert rollup_total(user, 'Exchange', currency=account.currency) == 3
+    assert rollup_total(user, 'Income', currency=zloty) == 3
+
+
+@pytest.mark.django_db
+def test_rebuild_rollups_command(user, zloty, category, transactions):
+    Income.objects.create(amount=100, user=user, date='2024-08-01', category=category)
+    Expense.objects.create(amount=30, user=user, date='2024-08-02')
+    expected = _rollup_rows(user)
+    DailyRollup.objects.all().delete()
+    call_command('rebuild_rollups', stdout=StringIO())
+    assert _rollup_rows(user) == expected
+
+
+@pytest.mark.django_db
+def test_prefix_sum_report(user, zloty, category):
+    Expense.objects.create(amount=10, user=user, date='2024-01-31', category=category)
+    Expense.objects.create(amount=20, user=user, date='2024-02-01', category=category)
+    Expense.objects.create(amount=5.5, user=user, date='2024-02-15')
+    Expense.objects.create(amount=7, user=user, date='2024-04-02', category=category)
+    report = PrefixSumReport.for_user(user, 'Expense')
+    assert report.total() == Decimal('42.50')
+    assert report.total('2024-02-01', '2024-02-29') == Decimal('25.50')
+    assert report.total('2024-02-01', None, category) == Decimal('27')
+    assert report.total('2024-03-01', '2024-03-31') == 0
+    assert report.total('2025-01-01', '2024-01-01') == 0
+    assert report.monthly_pivot() == {
+        '2024-01': {category.id: Decimal('10')},
+        '2024-02': {category.id: Decimal('20'), None: Decimal('5.5')},
+        '2024-03': {},
+        '2024-04': {category.id: Decimal('7')},
+    }
+    assert PrefixSumReport.for_user(user, 'Income').total() == 0
+
+
+@pytest.mark.django_db
+def test_report_json(user, zloty, category):
+    Income.objects.create(amount=100, user=user, date='2024-08-01', category=category)
+    Income.objects.create(amount=50, user=user, date='2024-09-01')
+    client = Client()
+    client.force_login(user)
+    response = client.get(reverse('report'), {'type': 'Income', 'date_from': '2024-08-01',
+                                              'category': category.id})
+    assert response.status_code == 200
+    data = response.json()
+    assert data['total'] == '100'
+    assert data['monthly'] == {'2024-08': {str(category.id): '100'}, '2024-09': {}}
+    assert client.get(reverse('report'), {'type': 'Savings'}).status_code == 400
+
+    # macierz z cache do następnego zapisu
+    with CaptureQueriesContext(connection) as queries:
+        client.get(reverse('report'), {'type': 'Income'})
+    assert not [query for query in queries.captured_queries if 'wallet_dailyrollup' in query['sql']]
+    Income.objects.create(amount=5, user=user, date='2024-09-02')
+    assert client.get(reverse('report'), {'type': 'Income'}).json()['total'] == '155'
+
+
+FULL_SCAN = re.compile(r'^SCAN (wallet_\w+)$')
+
+
+def _full_table_scans(client, method, url, data=None):
+    with CaptureQueriesContext(connection) as queries:
+        response = getattr(client, method)(url, data or {})
+    assert response.status_code == 200
+    scans = []
+    with connection.cursor() as cursor:
+        for query in queries.captured_queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT') or 'wallet_' not in sql:
+                continue
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            for row in cursor.fetchall():
+                if FULL_SCAN.match(row[3]):
+                    scans.append((row[3], sql))
+    return scans
+
+
+@pytest.mark.skipif(connection.vendor != 'sqlite', reason='EXPLAIN QUERY PLAN jest specyficzne dla SQLite')
+@pytest.mark.django_db
+@pytest.mark.parametrize('method, name, data', [
+    ('get', 'dashboard', None),
+    ('get', 'income', None),
+    ('post', 'income', {'date_from': '2024-08-01', 'date_to': '2024-08-31'}),
+    ('get', 'expense', None),
+    ('post', 'expense', {'date_from': '2024-08-01'}),
+    ('get', 'category', None),
+    ('get', 'accounts', None),
+    ('get', 'savings', None),
+    ('get', 'report', {'type': 'Expense'}),
+    ('get', 'account_details', None),
+])
+def test_hot_queries_use_indexes(method, name, data, user, zloty, foreign_accounts, main_category, user_category,
+                                 expenses, incomes, saving, transactions):
+    # historia kursów to celowy odczyt całej tabeli, wykonywany raz na proces
+    get_rate_history()
+    client = Client()
+    client.force_login(user)
+    args = [foreign_accounts[0].id] if name == 'account_details' else []
+    if data and 'date_from' in data:
+        data = dict(data, category=user_category.id)
+    assert _full_table_scans(client, method, reverse(name, args=args), data) == []
+
+
+@pytest.mark.django_db
+def test_category_stats_totals(user, zloty, main_category, user_category):
+    Expense.objects.create(amount=20, user=user, date=date.today(), category=user_category)
+    Expense.objects.create(amount=5, user=user, date=date.today(), category=user_category)
+    Income.objects.create(amount=7, user=user, date=date.today(), category=main_category)
+    Income.objects.create(amount=100, user=user, date='2020-01-01', category=main_category)
+    stats = CategoryView().get_category_stats(user, [main_category, user_category])
+    assert [(stat['total_expense'], stat['total_income']) for stat in stats] == [(0, 7), (25, 0)]
+
+
+def _category_page_queries(client):
+    bump_data_version(None)
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse('category'))
+    assert response.status_code == 200
+    return len(queries)
+
+
+@pytest.mark.django_db
+def test_category_view_queries_flat(user, zloty):
+    client = Client()
+    client.force_login(user)
+    Category.objects.create(name='built', is_built=True)
+    Category.objects.create(name='own', user=user)
+    few = _category_page_queries(client)
+    for i in range(40):
+        category = Category.objects.create(name='c%d' % i, user=user, is_built=i % 2 == 0)
+        Expense.objects.create(amount=1, user=user, date=date.today(), category=category)
+        Income.objects.create(amount=1, user=user, date=date.today(), category=category)
+    assert _category_page_queries(client) == few
+
+
+@pytest.mark.django_db
+def test_keyset_pagination(user, zloty):
+    for day in range(1, 8):
+        Expense.objects.create(amount=day, user=user, date='2024-08-0%d' % day)
+        Expense.objects.create(amount=10 + day, user=user, date='2024-08-0%d' % day)
+    expenses = Expense.objects.filter(user=user)
+    seen = []
+    cursor = None
+    while True:
+        page = KeysetPage(expenses, cursor, page_size=4)
+        seen.extend(page)
+        if not page.has_next:
+            break
+        cursor = page.next_cursor
+    assert len(seen) == 14
+    assert seen == list(expenses.order_by('-date', '-id'))
+    assert len(KeysetPage(expenses, 'nonsense', page_size=4)) == 4
+
+
+@pytest.mark.django_db
+def test_expense_get_pages(user, zloty):
+    for i in range(PAGE_SIZE + 1):
+        Expense.objects.create(amount=1, user=user, date='2024-08-01')
+    client = Client()
+    client.force_login(user)
+    response = client.get(reverse('expense'))
+    page = response.context['expenses']
+    assert len(page) == PAGE_SIZE
+    assert response.context['total_expense'] == PAGE_SIZE + 1
+    assert ('?after=%s' % page.next_cursor) in response.content.decode()
+    response = client.get(reverse('expense'), {'after': page.next_cursor})
+    assert len(response.context['expenses']) == 1
+    assert not response.context['expenses'].has_next
+
+
+@pytest.mark.django_db
+def test_currency_registry_lookups_without_queries(zloty, foreign_currency):
+    registry = CurrencyRegistry(check_interval=0)
+    registry.default()
+    with CaptureQueriesContext(connection) as queries:
+        assert registry.default() == zloty
+        assert registry.get('BBB') == foreign_currency[1]
+        assert registry.get_by_id(foreign_currency[2].id).code == 'CCC'
+    assert len(queries) == 0
+    with pytest.raises(Currency.DoesNotExist):
+        registry.get('XYZ')
+
+
+@pytest.mark.django_db
+def test_currency_registry_reloads_after_rate_update(zloty, foreign_currency):
+    registry = CurrencyRegistry(check_interval=0)
+    assert registry.get('BBB').exchange_rate == Decimal('0.5')
+    currency = Currency.objects.get(code='BBB')
+    currency.exchange_rate = Decimal('4.25')
+    currency.save()
+    assert registry.get('BBB').exchange_rate == Decimal('4.25')
+
+
+@pytest.mark.django_db
+def test_income_save_skips_currency_query(user, zloty):
+    currency_registry.default()
+    with CaptureQueriesContext(connection) as queries:
+        Income.objects.create(amount=10, user=user, date='2024-08-01')
+    assert not any('wallet_currency' in query['sql'] for query in queries.captured_queries)
+
+
+@pytest.mark.django_db
+def test_update_exchange_rates(nbp_server, zloty):
+    Currency.objects.create(code='USD', name='old', exchange_rate=1)
+    with CaptureQueriesContext(connection) as queries:
+        assert update_exchange_rates() == 3
+    writes = [query['sql'].split()[2] for query in queries.captured_queries if query['sql'].startswith('INSERT')]
+    assert writes == ['"wallet_currency"', '"wallet_currencyrate"']
+    assert Currency.objects.get(code='USD').name == 'dolar amerykański'
+    assert Currency.objects.get(code='EUR').exchange_rate == Decimal('4.32')
+    assert currency_registry.get('GBP').exchange_rate == Decimal('5.05')
+    assert Currency.objects.count() == 4
+
+
+@pytest.mark.django_db
+def test_update_exchange_rates_conditional(nbp_server):
+    assert update_exchange_rates() == 3
+    assert update_exchange_rates() == 'not-modified'
+    assert nbp_server.requests[1]['If-None-Match'] == '"2024-02-21"'
+
+    nbp_server.send_etag = False
+    cache.delete('wallet:nbp:etag')
+    with CaptureQueriesContext(connection) as queries:
+        assert update_exchange_rates() == 'unchanged'
+    assert len(queries) == 0
+
+    nbp_server.table['effectiveDate'] = '2024-02-22'
+    nbp_server.table['rates'][0]['mid'] = 3.9
+    assert update_exchange_rates() == 3
+    assert Currency.objects.get(code='USD').exchange_rate == Decimal('3.90')
+
+
+@pytest.fixture
+def queued_refreshes(monkeypatch):
+    queued = []
+    monkeypatch.setattr(update_exchange_rates, 'delay', lambda: queued.append(1))
+    cache.clear()
+    yield queued
+    cache.clear()
+
+
+@pytest.mark.django_db
+def test_currencies_view_single_flight(user, zloty, queued_refreshes):
+    client = Client()
+    client.force_login(user)
+    for i in range(5):
+        response = client.get(reverse('currencies'))
+        assert response.status_code == 200
+    assert len(queued_refreshes) == 1
+    assert response.context['rates']['is_stale']
+
+
+@pytest.mark.django_db
+def test_currencies_view_recent_refresh(user, zloty, queued_refreshes, nbp_server):
+    update_exchange_rates()
+    client = Client()
+    client.force_login(user)
+    response = client.get(reverse('currencies'))
+    assert queued_refreshes == []
+    assert not response.context['rates']['is_stale']
+    assert '2024-02-21' in response.content.decode()
+
+
+@pytest.mark.django_db
+def test_rate_history_point_in_time(zloty, foreign_currency):
+    aaa, bbb = foreign_currency[0], foreign_currency[1]
+    CurrencyRate.objects.bulk_create([
+        CurrencyRate(currency=aaa, effective_date='2024-01-02', mid=Decimal('4.0')),
+        CurrencyRate(currency=aaa, effective_date='2024-01-05', mid=Decimal('4.5')),
+        CurrencyRate(currency=bbb, effective_date='2024-01-03', mid=Decimal('3.0')),
+    ])
+    history = RateHistory.load()
+    assert history.rate(aaa.id, date(2024, 1, 4)) == Decimal('4.0')
+    assert history.rate(aaa.id, date(2024, 1, 5)) == Decimal('4.5')
+    assert history.rate(aaa.id, date(2030, 1, 1)) == Decimal('4.5')
+    assert history.rate(aaa.id, date(2024, 1, 1)) is None
+    assert history.rate(foreign_currency[2].id, date(2024, 1, 4)) is None
+
+    converted = history.convert([10, 10, 10, 10, 10],
+                                [aaa.id, bbb.id, bbb.id, foreign_currency[2].id, zloty.id],
+                                ['2024-01-06', '2024-01-03', '2024-01-02', '2024-01-06', '2024-01-06'])
+    assert converted.tolist() == [45.0, 30.0, 5.0, 20.0, 10.0]
+
+
+@pytest.mark.django_db
+def test_rate_history_appended_by_refresh(nbp_server, user):
+    update_exchange_rates()
+    nbp_server.table['effectiveDate'] = '2024-02-22'
+    nbp_server.table['rates'][0]['mid'] = 3.9
+    update_exchange_rates()
+    usd = Currency.objects.get(code='USD')
+    assert list(usd.rates.order_by('effective_date').values_list('mid', flat=True)) == [
+        Decimal('4.0123'), Decimal('3.9')]
+    history = get_rate_history()
+    exchanges = [Transaction(user=user, amount=10, currency=usd, date=date(2024, 2, 21), transaction_type='Exchange'),
+                 Transaction(user=user, amount=10, currency=usd, date=date(2024, 2, 23), transaction_type='Exchange')]
+    history.convert_transactions(exchanges)
+    assert [transaction.change_in_PLN for transaction in exchanges] == [Decimal('40.12'), Decimal('39.00')]
+
+
+NBP_ARCHIVE_CSV = '''data;1USD;1EUR;100HUF;nr tabeli;pełny numer tabeli
+;dolar amerykański;euro;forint (Węgry);;
+20200102;3,7977;4,2571;1,2867;1;001/A/NBP/2020
+20200103;3,8213;4,2682;;2;002/A/NBP/2020
+
+kod ISO;USD;EUR;HUF;;
+'''
+
+
+@pytest.mark.django_db
+def test_load_rate_archive(tmp_path, zloty):
+    tables = [{'table': 'A', 'no': '%03d/A/NBP/2021' % day, 'effectiveDate': '2021-01-%02d' % day,
+               'rates': [{'currency': 'dolar amerykański', 'code': 'USD', 'mid': 3.7 + day / 100},
+                         {'currency': 'euro', 'code': 'EUR', 'mid': 4.5}]} for day in range(4, 9)]
+    (tmp_path / 'a_2021.json').write_text(json.dumps(tables), encoding='utf-8')
+    series = {'table': 'B', 'currency': 'afgani (Afganistan)', 'code': 'AFN',
+              'rates': [{'no': '001/B/NBP/2021', 'effectiveDate': '2021-01-06', 'mid': 0.0491}]}
+    (tmp_path / 'b_afn.json').write_text(json.dumps(series), encoding='utf-8')
+    (tmp_path / 'a_2020.csv').write_text(NBP_ARCHIVE_CSV, encoding='cp1250')
+
+    output = StringIO()
+    call_command('load_rate_archive', str(tmp_path), '--batch-size', '3', stdout=output)
+    assert 'Dodano 16 kursów, pominięto 0' in output.getvalue()
+    assert Currency.objects.get(code='HUF').name == 'forint (Węgry)'
+    assert CurrencyRate.objects.get(currency__code='HUF').mid == Decimal('0.012867')
+    assert CurrencyRate.objects.get(currency__code='USD', effective_date='2021-01-08').mid == Decimal('3.78')
+    assert get_rate_history().rate(Currency.objects.get(code='AFN').id, date(2021, 1, 7)) == Decimal('0.0491')
+    # kurs waluty założonej z archiwum to najnowszy wczytany kurs, a nie pierwszy
+    assert Currency.objects.get(code='USD').exchange_rate == Decimal('3.78')
+    assert Currency.objects.get(code='HUF').exchange_rate == Decimal('0.01')
+
+    output = StringIO()
+    call_command('load_rate_archive', str(tmp_path / 'a_2021.json'), stdout=output)
+    assert 'Dodano 0 kursów, pominięto 10' in output.getvalue()
+
+
+def test_iter_json_objects_small_chunks():
+    stream = StringIO(json.dumps([{'a': 1, 'b': [1, 2, {'c': 'x]'}]}, {'a': 2}]))
+    assert list(iter_json_objects(stream, chunk_size=3)) == [{'a': 1, 'b': [1, 2, {'c': 'x]'}]}, {'a': 2}]
+
+
+@pytest.mark.django_db
+def test_cross_rates(zloty, foreign_currency):
+    cross_rates = get_cross_rates()
+    assert cross_rates.rate('BBB', 'CCC') == Decimal('0.25')
+    assert cross_rates.rate(foreign_currency[2], zloty) == Decimal('2.0')
+    assert cross_rates.convert_amount(Decimal('10'), 'PLN', 'BBB') == Decimal('20.00')
+    converted = cross_rates.convert([10, 10, 10], ['AAA', 'BBB', 'CCC'], ['CCC', 'CCC', 'BBB'])
+    assert converted.tolist() == [5.0, 2.5, 40.0]
+    assert get_cross_rates() is cross_rates
+    Currency.objects.filter(code='BBB').update(exchange_rate=4)
+    currency_registry.invalidate()
+    assert get_cross_rates().rate('BBB', 'CCC') == Decimal('2.0')
+
+
+@pytest.mark.django_db
+def test_cross_rates_use_latest_mid(user, zloty, account):
+    # dwa miejsca po przecinku w Currency zaokrąglają kurs CLP do zera
+    peso = Currency.objects.create(code='CLP', name='Peso chilijskie', exchange_rate=0)
+    CurrencyRate.objects.create(currency=peso, effective_date=date.today() - timedelta(days=1), mid='0.004300')
+    won = Currency.objects.create(code='KRW', name='Won', exchange_rate=0)
+    target = Account.objects.create(name='CLP', balance=0, currency=peso, user=user)
+    currency_registry.invalidate()
+    assert get_cross_rates().rate('AAA', 'CLP') == Decimal(str(1 / 0.0043))
+
+    client = Client()
+    client.force_login(user)
+    client.post(reverse('account_transfer', args=[account.id]), {'target': target.id, 'amount': '43'})
+    assert Account.objects.get(id=target.id).balance == Decimal('10000.00')
+    Category.objects.create(name='Wymiana', is_built=True)
+    client.post(reverse('change_to_PLN', args=[target.id]), {'amount': '1000'})
+    assert Income.objects.get(user=user, category__name='Wymiana').amount == Decimal('4.30')
+
+    Account.objects.create(name='KRW', balance=5, currency=won, user=user)
+    response = client.post(reverse('account_transfer', args=[account.id]),
+                           {'target': Account.objects.get(name='KRW').id, 'amount': '1'}, follow=True)
+    assert 'Brak kursu walut: KRW.' in response.content.decode()
+    response = client.post(reverse('change_to_PLN', args=[Account.objects.get(name='KRW').id]), {'amount': '1'},
+                           follow=True)
+    assert 'Brak kursu walut: KRW.' in response.content.decode()
+    assert Account.objects.get(name='KRW').balance == 5
+    assert Account.objects.get(id=account.id).balance == Decimal('57')
+    response = client.get(reverse('net_worth'))
+    assert response.status_code == 503
+    assert response.json() == {'errors': {'currency': ['Brak kursu walut: KRW.']}}
+    assert client.get(reverse('accounts')).context['net_worth'] is None
+
+
+@pytest.mark.django_db
+def test_account_transfer(user, foreign_accounts, account):
+    client = Client()
+    client.force_login(user)
+    response = client.get(reverse('account_details', args=[foreign_accounts[1].id]))
+    assert list(response.context['transfer_form'].fields['target'].queryset) == [
+        foreign_accounts[0], foreign_accounts[2], account]
+
+    url = reverse('account_transfer', args=[foreign_accounts[1].id])
+    response = client.post(url, {'target': foreign_accounts[2].id, 'amount': '2'})
+    assert response.status_code == 302
+    assert Account.objects.get(id=foreign_accounts[1].id).balance == Decimal('0')
+    assert Account.objects.get(id=foreign_accounts[2].id).balance == Decimal('3.5')
+    assert Transaction.objects.filter(currency=foreign_accounts[2].currency, amount=Decimal('0.5')).exists()
+
+    client.post(url, {'target': foreign_accounts[2].id, 'amount': '1'})
+    assert Account.objects.get(id=foreign_accounts[2].id).balance == Decimal('3.5')
+
+
+@pytest.mark.django_db
+def test_net_worth(user, zloty, foreign_accounts, account):
+    other = User.objects.create_user(username='other', password='x')
+    Account.objects.create(name='PLN', balance='7', currency=zloty, user=other)
+    # 101 AAA + 2 BBB + 3 CCC = 101 + 1 + 6 PLN
+    assert record_net_worth_snapshots() == 2
+    assert NetWorthSnapshot.objects.get(user=user).total == Decimal('108.00')
+    assert NetWorthSnapshot.objects.get(user=other).total == Decimal('7.00')
+    NetWorthSnapshot.objects.filter(user=user).update(day=date.today() - timedelta(days=1))
+    Account.objects.filter(id=account.id).update(balance=20)
+    record_net_worth_snapshots()
+    assert NetWorthSnapshot.objects.filter(user=user).count() == 2
+
+    client = Client()
+    client.force_login(user)
+    response = client.get(reverse('net_worth'), {'currency': 'ccc'})
+    assert response.status_code == 200
+    data = response.json()
+    assert data['currency'] == 'CCC'
+    assert data['total'] == '14.00'
+    assert [account['converted'] for account in data['accounts']] == ['0.50', '0.50', '3.00', '10.00']
+    assert [point['total'] for point in data['history']] == ['54.00', '14.00']
+    assert client.get(reverse('net_worth'), {'currency': 'XYZ'}).status_code == 400
+
+    response = client.get(reverse('accounts'))
+    assert response.context['net_worth']['total'] == Decimal('28.00')
+
+
+# testowa baza sqlite w pamięci zgłasza blokadę tabeli zamiast czekać jak plik albo PostgreSQL;
+# cała transakcja jest wtedy wycofana, więc można ją bezpiecznie powtórzyć
+def _retry_locked(operation):
+    while True:
+        try:
+            with atomic():
+                return operation()
+        except OperationalError as exc:
+            if 'locked' not in str(exc):
+                raise
+
+
+def _run_concurrently(target, threads=8):
+    barrier = threading.Barrier(threads)
+    errors = []
+
+    def worker():
+        try:
+            barrier.wait()
+            target()
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            connection.close()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    assert not errors
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_balance_updates(user, foreign_currency):
+    account = Account.objects.create(name='AAA', balance=100, currency=foreign_currency[0], user=user)
+    saving = Savings.objects.create(user=user, name='Cel', end_date='2030-12-31', goal_amount=150)
+    withdrawn = []
+
+    def update():
+        for _ in range(20):
+            _retry_locked(lambda: Account.objects.filter(id=account.id).deposit(Decimal('1.50')))
+            withdrawn.append(_retry_locked(lambda: Account.objects.filter(id=account.id).withdraw(Decimal('2'))))
+            _retry_locked(lambda: Savings.objects.filter(id=saving.id).deposit(Decimal('1')))
+
+    _run_concurrently(update)
+    account.refresh_from_db()
+    saving.refresh_from_db()
+    # 160 wpłat po 1.50 i tyle wypłat po 2, na ile pozwalało saldo - saldo nigdy nie spada poniżej zera
+    assert account.balance == 100 + Decimal('1.50') * 160 - 2 * sum(withdrawn)
+    assert account.balance >= 0
+    assert saving.current_amount == 150
+    assert saving.remaining_amount == 0
+
+
+@pytest.mark.django_db
+def test_idempotent_posts(user, foreign_accounts):
+    client = Client()
+    client.force_login(user)
+    url = reverse('for_income_add', args=[foreign_accounts[0].id])
+    data = {'amount': 10, 'date': '2024-08-01'}
+    first = client.post(url, data, HTTP_IDEMPOTENCY_KEY='abc')
+    with CaptureQueriesContext(connection) as queries:
+        replay = client.post(url, data, HTTP_IDEMPOTENCY_KEY='abc')
+    assert replay.status_code == first.status_code == 302
+    assert replay.url == first.url
+    assert replay['Idempotent-Replayed'] == 'true'
+    assert not any(query['sql'].startswith(('UPDATE', 'INSERT INTO "wallet_transaction"'))
+                   for query in queries.captured_queries)
+    assert Account.objects.get(id=foreign_accounts[0].id).balance == Decimal('11')
+    assert Transaction.objects.filter(user=user, transaction_type='Income').count() == 1
+
+    # inny klucz albo brak klucza - zwykły nowy zapis; klucze są osobne dla każdego użytkownika
+    client.post(url, data, HTTP_IDEMPOTENCY_KEY='def')
+    client.post(url, data)
+    assert Account.objects.get(id=foreign_accounts[0].id).balance == Decimal('31')
+
+    # nieudany formularz nie zużywa klucza
+    expense_url = reverse('for_expense_add', args=[foreign_accounts[1].id])
+    response = client.post(expense_url, {'amount': 100, 'date': '2024-08-01'}, HTTP_IDEMPOTENCY_KEY='xyz')
+    assert response.status_code == 200
+    assert not IdempotencyKey.objects.filter(key='xyz').exists()
+    response = client.post(expense_url, {'amount': 1, 'date': '2024-08-01', 'idempotency_key': 'xyz'})
+    assert response.status_code == 302
+    assert Account.objects.get(id=foreign_accounts[1].id).balance == Decimal('1')
+
+    # błąd zgłoszony komunikatem i przekierowaniem też nie zużywa klucza
+    exchange_url = reverse('change_to_PLN', args=[foreign_accounts[1].id])
+    client.post(exchange_url, {'amount': 5}, HTTP_IDEMPOTENCY_KEY='exc')
+    assert not IdempotencyKey.objects.filter(key='exc').exists()
+    transfer_url = reverse('account_transfer', args=[foreign_accounts[1].id])
+    client.post(transfer_url, {'target': '', 'amount': '1'}, HTTP_IDEMPOTENCY_KEY='trf')
+    assert not IdempotencyKey.objects.filter(key='trf').exists()
+    client.post(transfer_url, {'target': foreign_accounts[2].id, 'amount': '1'}, HTTP_IDEMPOTENCY_KEY='trf')
+    assert Account.objects.get(id=foreign_accounts[1].id).balance == Decimal('0')
+
+    # ten sam klucz dla innego adresu
+    response = client.post(expense_url, {'amount': 1, 'date': '2024-08-01'}, HTTP_IDEMPOTENCY_KEY='abc')
+    assert response.status_code == 422
+
+
+@pytest.mark.django_db
+def test_purge_idempotency_keys(user):
+    IdempotencyKey.objects.create(user=user, key='old', status_code=302, location='/')
+    IdempotencyKey.objects.create(user=user, key='new', status_code=302, location='/')
+    IdempotencyKey.objects.filter(key='old').update(created_at=timezone.now() - timedelta(days=2))
+    assert purge_expired_idempotency_keys() == 1
+    assert list(IdempotencyKey.objects.values_list('key', flat=True)) == ['new']
+
+
+@pytest.mark.django_db
+def test_ledger_entry_edit_updates_changed_fields(user, zloty, category):
+    expense = Expense.objects.create(user=user, amount=10, date=date(2024, 3, 1), category=category)
+    expense = Expense.objects.select_related('transaction').get(id=expense.id)
+    with CaptureQueriesContext(connection) as queries:
+        expense.save()
+    assert len(queries) == 0
+
+    expense.amount = Decimal('12.50')
+    with CaptureQueriesContext(connection) as queries:
+        expense.save()
+    updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE "wallet_')]
+    assert any(sql.startswith('UPDATE "wallet_transaction" SET "amount"') and '"date"' not in sql for sql in updates)
+    assert any(sql.startswith('UPDATE "wallet_expense" SET "amount"') and '"date"' not in sql for sql in updates)
+    assert Transaction.objects.filter(user=user).count() == 1
+    assert Transaction.objects.get(user=user).amount == Decimal('12.50')
+    assert rollup_total(user, 'Expense') == Decimal('12.50')
+
+    expense.delete()
+    assert not Transaction.objects.filter(user=user).exists()
+    assert rollup_total(user, 'Expense') == 0
+
+
+@pytest.mark.django_db
+def test_link_ledger_transactions_migration(user, zloty, category):
+    from importlib import import_module
+    from django.apps import apps
+    migration = import_module('wallet.migrations.0037_link_ledger_transactions')
+
+    # stan sprzed poprawki: wydatek bez transakcji i kopie z każdego zapisu, także po edycji
+    expense = Expense.objects.bulk_create([Expense(user=user, amount=5, date=date(2024, 3, 1), category=category)])[0]
+    old = dict(user=user, date=date(2024, 3, 1), category=category, transaction_type='Expense', currency=zloty)
+    for amount in (4, 5, 5, 5):
+        Transaction.objects.create(amount=amount, **old)
+    foreign = Transaction.objects.create(amount=5, **dict(old, currency=Currency.objects.create(code='EUR', name='Euro', exchange_rate=4)))
+    income = Income.objects.create(user=user, amount=7, date=date(2024, 3, 1))
+    # wpłata na konto PLN tego samego dnia i na tę samą kwotę co przychód nie jest kopią
+    deposit = Transaction.objects.create(amount=7, **dict(old, category=None, transaction_type='Income'))
+    legacy = Income.objects.bulk_create([Income(user=user, amount=3, date=date(2024, 3, 2))])[0]
+    # wydatek z konta PLN (bez opisu) zostaje, kopia z opisem nie
+    owner = User.objects.create(username='pln')
+    Account.objects.create(name='PLN', balance=0, currency=zloty, user=owner)
+    spent = Transaction.objects.create(amount=8, **dict(old, user=owner, category=None))
+    Transaction.objects.create(amount=9, description='stary wpis', **dict(old, user=owner))
+
+    migration.link_entries(apps, None)
+    assert list(Transaction.objects.filter(user=owner).values_list('id', flat=True)) == [spent.id]
+    expense.refresh_from_db()
+    assert expense.transaction.amount == 5
+    # kopia sprzed edycji (4) też znika; zostaje podpięta transakcja i transakcja w innej walucie
+    expenses = Transaction.objects.filter(user=user, transaction_type='Expense')
+    assert sorted(expenses.values_list('amount', flat=True)) == [5, 5]
+    assert Transaction.objects.filter(id=foreign.id).exists()
+    assert Income.objects.get(id=income.id).transaction_id == income.transaction_id
+    assert Transaction.objects.filter(id=deposit.id).exists()
+    legacy.refresh_from_db()
+    assert legacy.transaction.amount == 3 and legacy.transaction.currency == zloty
+    assert rollup_total(user, 'Expense', currency=zloty) == Decimal('5')
+    assert rollup_total(user, 'Income', currency=zloty) == Decimal('17')
+
+
+STATEMENT_CSV = """Data operacji;Kwota;Opis;Kategoria;Waluta
+2024-05-01;-12,50;Sklep;Jedzenie;
+02.05.2024;3 000,00;Pensja;;PLN
+2024-05-02;-20;Kantor;Jedzenie;AAA
+2024-05-03;abc;Błąd;;
+2024-05-04;-1;Nieznana;;XYZ
+"""
+
+
+@pytest.mark.django_db
+def test_statement_import_view(user, zloty, foreign_currency):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    client = Client()
+    client.force_login(user)
+    upload = SimpleUploadedFile('wyciag.csv', STATEMENT_CSV.encode('utf-8'), content_type='text/csv')
+    response = client.post(reverse('statement_import'), {'file': upload, 'encoding': 'utf-8-sig'})
+    assert response.status_code == 200
+    assert response.context['created'] == 3
+    assert [line for line, _ in response.context['errors']] == [5, 6]
+
+    food = Category.objects.get(user=user, name='Jedzenie')
+    expense = Expense.objects.select_related('transaction').get(user=user)
+    assert (expense.amount, expense.category, expense.transaction.currency) == (Decimal('12.50'), food, zloty)
+    assert Income.objects.get(user=user).amount == Decimal('3000')
+    assert Transaction.objects.get(user=user, currency=foreign_currency[0]).transaction_type == 'Expense'
+    imported = _rollup_rows(user)
+    rebuild_rollups(user)
+    assert _rollup_rows(user) == imported
+
+
+@pytest.mark.django_db
+def test_import_statement_command(tmp_path, user, zloty):
+    rows = ['date,amount,description'] + ['2024-01-%02d,%s,Operacja %d' % (i % 28 + 1, -i if i % 3 else i, i)
+                                          for i in range(1, 501)]
+    path = tmp_path / 'statement.csv'
+    path.write_text('\n'.join(rows), encoding='utf-8')
+    output = StringIO()
+    call_command('import_statement', user.username, str(path), '--batch-size', '64', stdout=output)
+    assert 'Zaimportowano 500 operacji, pominięto 0' in output.getvalue()
+    assert Income.objects.filter(user=user).count() == 166
+    assert Expense.objects.filter(user=user, transaction__isnull=False).count() == 334
+    assert rollup_total(user, 'Expense') == sum(i for i in range(1, 501) if i % 3)
+
+
+STATEMENT_FIXTURES = Path(__file__).parent / 'fixtures' / 'statements'
+
+
+def test_statement_parsers():
+    with open(STATEMENT_FIXTURES / 'camt053_sample.xml', 'rb') as stream:
+        camt = [(row.date, row.amount, row.description, row.currency) for row in iter_camt053_statement(stream)]
+    assert camt == [(date(2024, 5, 10), Decimal('4500.00'), 'Wynagrodzenie za maj 2024', 'PLN'),
+                    (date(2024, 5, 12), Decimal('-123.45'), 'Zakup kartą SKLEP SPOŻYWCZY', 'PLN'),
+                    (date(2024, 5, 20), Decimal('-20.00'), 'Subskrypcja', 'EUR')]
+
+    with open(STATEMENT_FIXTURES / 'mt940_sample.sta', encoding='utf-8') as stream:
+        mt940 = [(row.line, row.date, row.amount, row.description) for row in iter_mt940_statement(stream)]
+    assert mt940 == [(6, date(2024, 5, 10), Decimal('4500.00'), 'Wynagrodzenie za maj 2024'),
+                     (9, date(2024, 5, 12), Decimal('-123.45'), 'Zakup kartą SKLEP SPOŻYWCZY WARSZAWA'),
+                     (12, date(2024, 5, 15), Decimal('10.00'), 'Zwrot opłaty')]
+
+    errors = []
+    broken = StringIO(':60F:C240430PLN0,00\n:61:24AB10CN1,00\n:61:2405100510DN2,00NTRF\n:86:Opis\n')
+    assert [row.amount for row in iter_mt940_statement(broken, errors)] == [Decimal('-2.00')]
+    assert [line for line, _ in errors] == [2]
+
+
+@pytest.mark.django_db
+def test_import_statement_formats(user, zloty):
+    Currency.objects.create(code='EUR', name='euro', exchange_rate=4)
+    # ta sama pensja jest w obu wyciągach - drugi import ją pomija
+    for name, expected in (('camt053_sample.xml', '3 operacji, pominięto 0 wierszy i 0 duplikatów'),
+                           ('mt940_sample.sta', '2 operacji, pominięto 0 wierszy i 1 duplikatów')):
+        output = StringIO()
+        call_command('import_statement', user.username, str(STATEMENT_FIXTURES / name), stdout=output)
+        assert f'Zaimportowano {expected}' in output.getvalue()
+    assert Income.objects.filter(user=user, amount=4500).count() == 1
+    assert Expense.objects.filter(user=user).count() == 2
+    assert Transaction.objects.get(user=user, currency__code='EUR').amount == Decimal('20')
+
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    client = Client()
+    client.force_login(user)
+    upload = SimpleUploadedFile('maj.xml', (STATEMENT_FIXTURES / 'camt053_sample.xml').read_bytes())
+    response = client.post(reverse('statement_import'), {'file': upload, 'encoding': 'utf-8-sig'})
+    assert response.context['created'] == 0
+    assert response.context['duplicate_count'] == 3
+    upload = SimpleUploadedFile('zly.xml', b'<Document><Ntry>')
+    response = client.post(reverse('statement_import'), {'file': upload, 'encoding': 'utf-8-sig'})
+    assert response.context['form'].errors['file']
+
+
+def test_benchmark_statements():
+    output = StringIO()
+    call_command('benchmark_statements', '--rows', '200', stdout=output)
+    assert output.getvalue().count('200 operacji') == 3
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('use_bloom_filter', [False, True])
+def test_statement_reimport_skips_duplicates(user, zloty, use_bloom_filter):
+    first = 'data;kwota;opis\n2024-05-01;-10,00;Kawa\n2024-05-01;-10,00;Kawa\n2024-05-02;-5,00;Bułki\n'
+    # drugi wyciąg nachodzi na pierwszy: te same dwie kawy (inaczej zapisany opis) i jedna nowa operacja
+    second = 'data;kwota;opis\n2024-05-01;-10,00; KAWA \n2024-05-01;-10,00;kawa\n2024-05-03;-7,00;Obiad\n'
+    assert StatementImporter(user).run(iter_csv_statement(StringIO(first))) == 3
+
+    importer = StatementImporter(user, batch_size=2, use_bloom_filter=use_bloom_filter)
+    with CaptureQueriesContext(connection) as queries:
+        assert importer.run(iter_csv_statement(StringIO(second))) == 1
+    assert [line for line, _ in importer.duplicates] == [2, 3]
+    lookups = [query for query in queries.captured_queries if '"fingerprint" IN' in query['sql']]
+    assert len(lookups) == (1 if use_bloom_filter else 2)
+    assert Expense.objects.filter(user=user).count() == 4
+    assert rollup_total(user, 'Expense') == Decimal('32')
+
+    duplicate = Transaction(user=user, amount=5, date=date(2024, 5, 2), transaction_type='Expense', currency=zloty,
+                            fingerprint=transaction_fingerprint(user.id, date(2024, 5, 2), Decimal('-5'), 'PLN',
+                                                                'bułki'))
+    with pytest.raises(IntegrityError):
+        with atomic():
+            duplicate.save()
+
+
+@pytest.mark.django_db
+def test_statement_unknown_currency_looked_up_once(user, zloty):
+    rows = [StatementRow(line, date(2024, 5, 1), Decimal('-1'), f'Sklep {line}', '', 'XYZ') for line in range(1, 6)]
+    errors = []
+    importer = StatementImporter(user)
+    with CaptureQueriesContext(connection) as queries:
+        assert importer.run(rows, errors) == 0
+    assert len([query for query in queries.captured_queries if 'wallet_currency' in query['sql']]) == 1
+    assert errors == [(line, "Nieznana waluta: 'XYZ'") for line in range(1, 6)]
+    with pytest.raises(StatementError):
+        importer.run(rows)
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000)
+    fingerprints = [transaction_fingerprint(1, date(2024, 1, 1), i, 'PLN', '') for i in range(2000)]
+    for fingerprint in fingerprints[:1000]:
+        bloom.add(fingerprint)
+    assert all(fingerprint in bloom for fingerprint in fingerprints[:1000])
+    assert sum(fingerprint in bloom for fingerprint in fingerprints[1000:]) < 50
+
+
+@pytest.mark.django_db
+def test_export(user, zloty, category, foreign_currency):
+    for day in range(1, 6):
+        Expense.objects.create(user=user, amount=day, date=date(2024, 6, day), category=category,
+                               description=f'Zakupy; "{day}"')
+    Income.objects.create(user=user, amount=100, date=date(2024, 6, 2))
+    Transaction.objects.create(user=user, amount=3, date=date(2024, 6, 3), transaction_type='Exchange',
+                               currency=foreign_currency[1])
+    client = Client()
+    client.force_login(user)
+
+    response = client.get(reverse('export', args=['expenses']), {'date_from': '2024-06-02', 'date_to': '2024-06-04'})
+    assert response.streaming
+    assert response['Content-Disposition'] == 'attachment; filename="expenses.csv"'
+    lines = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+    assert lines[0] == 'id;date;amount;category;description'
+    assert [line.split(';')[1:3] for line in lines[1:]] == [['2024-06-02', '2.00'], ['2024-06-03', '3.00'],
+                                                            ['2024-06-04', '4.00']]
+    assert lines[1].endswith(';Test Category;"Zakupy; ""2"""')
+
+    response = client.get(reverse('export', args=['transactions']), {'format': 'json', 'category': ''})
+    rows = json.loads(b''.join(response.streaming_content))
+    assert [(row['transaction_type'], row['currency']) for row in rows] == [
+        ('Expense', 'PLN'), ('Expense', 'PLN'), ('Income', 'PLN'), ('Expense', 'PLN'), ('Exchange', 'BBB'),
+        ('Expense', 'PLN'), ('Expense', 'PLN')]
+
+    response = client.get(reverse('export', args=['incomes']), {'format': 'json', 'date_from': '2025-01-01'})
+    assert json.loads(b''.join(response.streaming_content)) == []
+    assert client.get(reverse('export', args=['savings'])).status_code == 404
+    assert client.get(reverse('export', args=['incomes']), {'format': 'xml'}).status_code == 400
+
+
+def _aggregate_queries(queries):
+    return [query['sql'] for query in queries.captured_queries if 'SUM(' in query['sql'].upper()]
+
+
+@pytest.mark.django_db
+def test_page_cache_repeat_views(user, zloty):
+    Expense.objects.create(amount=10, user=user, date=date.today())
+    Income.objects.create(amount=30, user=user, date=date.today())
+    client = Client()
+    client.force_login(user)
+    for name in ('dashboard', 'category', 'income', 'expense'):
+        client.get(reverse(name))
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(reverse(name))
+        assert response.status_code == 200
+        assert _aggregate_queries(queries) == []
+
+    with CaptureQueriesContext(connection) as queries:
+        client.post(reverse('income'), {'date_from': '', 'date_to': ''})
+        response = client.post(reverse('income'), {'date_from': '', 'date_to': ''})
+    assert len(_aggregate_queries(queries)) == 1
+    assert response.context['total_income'] == Decimal('30.00')
+
+
+@pytest.mark.django_db
+def test_untracked_models_keep_fast_delete(user):
+    IdempotencyKey.objects.create(user=user, key='a')
+    IdempotencyKey.objects.create(user=user, key='b')
+    with CaptureQueriesContext(connection) as queries:
+        IdempotencyKey.objects.all().delete()
+    assert [query['sql'].split()[0] for query in queries.captured_queries] == ['DELETE']
+
+
+@pytest.mark.django_db
+def test_page_cache_invalidated_by_writes(user, zloty, saving):
+    client = Client()
+    client.force_login(user)
+    assert client.get(reverse('dashboard')).context['sum_expenses'] is None
+    expense = Expense.objects.create(amount=10, user=user, date=date.today())
+    assert client.get(reverse('dashboard')).context['sum_expenses'] == Decimal('10.00')
+    expense.amount = 25
+    expense.save()
+    assert client.get(reverse('expense')).context['total_expense'] == Decimal('25.00')
+    expense.delete()
+    assert client.get(reverse('expense')).context['total_expense'] == 0
+
+    # kategoria wbudowana zmienia strony wszystkich użytkowników
+    client.get(reverse('category'))
+    Category.objects.create(name='wspólna', is_built=True)
+    assert 'wspólna' in [stat['category'].name for stat in client.get(reverse('category')).context['main_stats']]
+
+    # zapisy omijające save(): UPDATE na querysecie i import partiami
+    version = data_version(user.id)
+    client.post(reverse('add_money_to_savings', args=[saving[0].id]), {'amount': '1'})
+    assert data_version(user.id) != version
+    version = data_version(user.id)
+    StatementImporter(user).run([StatementRow(1, date(2024, 5, 1), Decimal('-12.50'), 'Sklep', '', 'PLN')])
+    assert data_version(user.id) != version
+
+
+@pytest.mark.django_db
+def test_conditional_get(user, zloty, foreign_accounts, queued_refreshes):
+    client = Client()
+    client.force_login(user)
+    for name in ('dashboard', 'income', 'expense', 'accounts', 'savings', 'category', 'currencies'):
+        response = client.get(reverse(name))
+        assert response.status_code == 200
+        assert response['Last-Modified']
+        assert 'private' in response['Cache-Control'] and 'no-cache' in response['Cache-Control']
+        with CaptureQueriesContext(connection) as queries:
+            cached = client.get(reverse(name), HTTP_IF_NONE_MATCH=response['ETag'])
+        assert cached.status_code == 304
+        assert not [query for query in queries.captured_queries if 'wallet_' in query['sql']]
+
+    etag = client.get(reverse('expense'))['ETag']
+    assert client.get(reverse('expense'), {'after': '2024-01-01.1'}, HTTP_IF_NONE_MATCH=etag).status_code == 200
+    Expense.objects.create(amount=5, user=user, date=date.today())
+    response = client.get(reverse('expense'), HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+
+
+@pytest.mark.django_db
+def test_conditional_get_after_relogin(user, zloty):
+    client = Client()
+    client.force_login(user)
+    response = client.get(reverse('expense'))
+    start_of_today = datetime.combine(date.today(), datetime.min.time()).astimezone()
+    assert parse_http_date(response['Last-Modified']) >= int(start_of_today.timestamp())
+    yesterday = http_date(start_of_today.timestamp() - 60)
+    assert client.get(reverse('expense'), HTTP_IF_MODIFIED_SINCE=yesterday).status_code == 200
+
+    # nowe logowanie zmienia sekret CSRF, więc strona z formularzem musi zostać wysłana od nowa
+    user.set_password('haslo-testowe')
+    user.save()
+    client.get(reverse('logout'))
+    client.post(reverse('login'), {'username': user.username, 'password': 'haslo-testowe'})
+    assert client.get(reverse('expense'), HTTP_IF_NONE_MATCH=response['ETag']).status_code == 200
+
+
+@pytest.mark.django_db
+def test_conditional_get_keeps_messages(user, foreign_accounts):
+    client = Client()
+    client.force_login(user)
+    account = foreign_accounts[0]
+    url = reverse('account_details', args=[account.id])
+    etag = client.get(url)['ETag']
+    client.post(reverse('account_transfer', args=[account.id]), {'target': '', 'amount': '1'})
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert 'Nieprawidłowe dane przelewu' in response.content.decode()
+
+
+@pytest.mark.django_db
+def test_category_catalogue_forms(user, zloty, category, main_category):
+    other = Category.objects.create(name='cudza', user=User.objects.create(username='other'))
+    client = Client()
+    client.force_login(user)
+    client.get(reverse('expense_add'))
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse('expense_add'))
+    assert not [query for query in queries.captured_queries if 'wallet_category' in query['sql']]
+    choices = [value for value, label in response.context['form'].fields['category'].choices]
+    assert choices == ['', category.id, main_category.id]
+
+    data = {'amount': '5', 'date': '2024-05-01', 'description': 'x'}
+    response = client.post(reverse('expense_add'), {**data, 'category': other.id})
+    assert response.status_code == 200 and 'category' in response.context['form'].errors
+    with CaptureQueriesContext(connection) as queries:
+        client.post(reverse('expense_add'), {**data, 'category': category.id})
+    # jedynie sprawdzenie istnienia klucza obcego w walidacji modelu, bez wczytywania listy kategorii
+    assert [query['sql'][:12] for query in queries.captured_queries
+            if query['sql'].startswith('SELECT') and 'wallet_category' in query['sql']] == ['SELECT 1 AS ']
+    assert Expense.objects.get(user=user).category == category
+
+    client.post(reverse('category_add'), {'name': 'nowa', 'description': 'opis'})
+    new = Category.objects.get(name='nowa')
+    assert new.id in category_catalogue(user)
+    client.post(reverse('category_delete', args=[category.id]))
+    assert category.id not in category_catalogue(user)
+
+
+def _closure(category):
+    return sorted(CategoryClosure.objects.filter(descendant=category).values_list('ancestor__name', 'depth'))
+
+
+@pytest.mark.django_db
+def test_category_closure(user):
+    food = Category.objects.create(name='Jedzenie', is_built=True)
+    groceries = Category.objects.create(name='Zakupy', user=user, parent=food)
+    organic = Category.objects.create(name='Eko', user=user, parent=groceries)
+    home = Category.objects.create(name='Dom', user=user)
+    assert _closure(organic) == [('Eko', 0), ('Jedzenie', 2), ('Zakupy', 1)]
+
+    groceries.parent = home
+    groceries.save()
+    assert _closure(organic) == [('Dom', 2), ('Eko', 0), ('Zakupy', 1)]
+    assert _closure(groceries) == [('Dom', 1), ('Zakupy', 0)]
+    assert _closure(food) == [('Jedzenie', 0)]
+
+    home.parent = organic
+    with pytest.raises(ValidationError):
+        home.full_clean()
+    with pytest.raises(ValueError):
+        home.save()
+    groceries.delete()
+    assert not Category.objects.filter(name='Eko').exists()
+    assert CategoryClosure.objects.filter(ancestor=home).count() == 1
+
+
+@pytest.mark.django_db
+def test_category_subtree_totals(user, zloty):
+    food = Category.objects.create(name='Jedzenie', is_built=True)
+    groceries = Category.objects.create(name='Zakupy', user=user, parent=food)
+    organic = Category.objects.create(name='Eko', user=user, parent=groceries)
+    other = Category.objects.create(name='Inne', user=user)
+    for amount, category in ((10, food), (20, groceries), (40, organic), (80, other)):
+        Expense.objects.create(amount=amount, user=user, date=date.today(), category=category)
+    Expense.objects.create(amount=1000, user=User.objects.create(username='other'), date=date.today(),
+                           category=organic)
+    total = Expense.objects.filter(user=user).in_category(food).aggregate(total=Sum('amount'))['total']
+    assert total == Decimal('70.00')
+
+    client = Client()
+    client.force_login(user)
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse('category'))
+    assert len([query for query in queries.captured_queries if 'SUM(' in query['sql']]) == 2
+    main = [(stat['category'].name, stat['level'], stat['total_expense']) for stat in response.context['main_stats']]
+    own = [(stat['category'].name, stat['level'], stat['total_expense']) for stat in response.context['user_stats']]
+    assert main == [('Jedzenie', 0, Decimal('70.00'))]
+    assert own == [('Zakupy', 0, Decimal('60.00')), ('Eko', 1, Decimal('40.00')), ('Inne', 0, Decimal('80.00'))]
+
+    response = client.post(reverse('category_add'), {'name': 'Warzywa', 'description': 'x', 'parent': organic.id})
+    assert response.status_code == 302
+    assert _closure(Category.objects.get(name='Warzywa')) == [('Eko', 1), ('Jedzenie', 3), ('Warzywa', 0),
+                                                              ('Zakupy', 2)]
+    assert [label for value, label in category_catalogue(user).choices][:4] == [
+        'Jedzenie', '— Zakupy', '— — Eko', '— — — Warzywa']
+
+
+@pytest.mark.django_db
+def test_category_background_deletion(user, zloty, monkeypatch, django_capture_on_commit_callbacks):
+    queued = []
+    monkeypatch.setattr(delete_category, 'delay', queued.append)
+    monkeypatch.setattr('wallet.views.DELETE_CHUNK_SIZE', 3)
+    food = Category.objects.create(name='Jedzenie', user=user)
+    groceries = Category.objects.create(name='Zakupy', user=user, parent=food)
+    other = Category.objects.create(name='Inne', user=user)
+    for day in range(1, 6):
+        Expense.objects.create(amount=day, user=user, date=date(2024, 5, day), category=groceries)
+    Income.objects.create(amount=7, user=user, date=date(2024, 5, 1), category=food)
+    Expense.objects.create(amount=9, user=user, date=date(2024, 5, 1), category=other)
+    client = Client()
+    client.force_login(user)
+    client.get(reverse('category'))
+
+    with django_capture_on_commit_callbacks(execute=True):
+        response = client.post(reverse('category_delete', args=[food.id]))
+    assert response.status_code == 302
+    assert queued == [food.id]
+    assert client.get(reverse('category_delete_status', args=[food.id])).json() == {
+        'deleted': 0, 'total': 12, 'done': False}
+    assert set(Category.objects.filter(hidden=True).values_list('name', flat=True)) == {'Jedzenie', 'Zakupy'}
+    assert [stat['category'].name for stat in client.get(reverse('category')).context['user_stats']] == ['Inne']
+    assert food.id not in category_catalogue(user)
+    assert client.post(reverse('category_delete', args=[food.id])).status_code == 404
+
+    deleted = CategoryDeletion(food.id, chunk_size=2).run()
+    # 6 sum dziennych i 6 transakcji (razem z wpisami Income/Expense)
+    assert deleted == 12
+    assert client.get(reverse('category_delete_status', args=[food.id])).json() == {
+        'deleted': 12, 'total': 12, 'done': True}
+    assert list(Category.objects.filter(user=user).values_list('name', flat=True)) == ['Inne']
+    assert list(Transaction.objects.values_list('amount', flat=True)) == [Decimal('9.00')]
+    assert Expense.objects.count() == 1 and Income.objects.count() == 0
+    assert list(DailyRollup.objects.values_list('category__name', 'total')) == [('Inne', Decimal('9.00'))]
+
+    Category.objects.filter(id=other.id).update(hidden=True)
+    assert delete_hidden_categories() == 2
+    assert not Category.objects.filter(id=other.id).exists()
+
+
+@pytest.mark.django_db
+def test_delete_user_command(user, zloty, category, foreign_accounts, saving):
+    for day in range(1, 6):
+        Expense.objects.create(amount=day, user=user, date=date(2024, 5, day), category=category)
+    Category.objects.create(name='Pod', user=user, parent=category)
+    other = User.objects.create(username='other')
+    Income.objects.create(amount=3, user=other, date=date(2024, 5, 1))
+    out = StringIO()
+    call_command('delete_user', user.username, '--now', '--chunk-size', '2', stdout=out)
+    assert 'Usunięto użytkownika test_user' in out.getvalue()
+    assert not User.objects.filter(id=user.id).exists()
+    assert not Category.objects.filter(user_id=user.id).exists()
+    assert list(Transaction.objects.values_list('user__username', flat=True)) == ['other']
+    assert DailyRollup.objects.filter(user=other).count() == 1
@@ -1,17 +1,33 @@
+import io
 from datetime import date, timedelta, datetime
 from decimal import Decimal
+from xml.etree.ElementTree import ParseError
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
-from django.db.models import Sum
+from django.db.models import Case, Sum, Value, When
+from django.db.transaction import atomic
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.views import View
 from wallet.forms import LoginForm, RegisterForm, IncomeExpenseAddForm, CategoryAddForm, \
     SavingsAddForm, AccountAddForm, ForIncomeExpenseAddForm, CurrencySearchform, \
-    IncomeExpenseFilterForm
-from wallet.models import Income, Expense, Category, Savings, Transaction, Account, Currency
-from wallet.tasks import update_exchange_rates
+    IncomeExpenseFilterForm, AccountTransferForm, StatementImportForm
+from wallet.categories import category_catalogue, tree_order
+from wallet.models import Income, Expense, Category, Savings, Transaction, Account, Currency, default_currency_id
+from wallet.networth import net_worth, net_worth_history
+from wallet.crossrates import RateUnavailable, get_cross_rates
+from wallet.currencies import DEFAULT_CURRENCY_CODE, currency_registry
+from wallet.dashboard import load_dashboard
+from wallet.deletion import DELETE_CHUNK_SIZE, category_dependants, deletion_progress, hide_category, report_queued
+from wallet.exports import EXPORTS, EXPORT_FORMATS, export_queryset, export_rows
+from wallet.idempotency import IdempotentMixin
+from wallet.pagecache import ConditionalGetMixin, bump_data_version, cached_context
+from wallet.pagination import KeysetPage, CURSOR_PARAM
+from wallet.reports import PrefixSumReport
+from wallet.statements import STATEMENT_FORMATS, StatementError, StatementImporter, detect_format
+from wallet.tasks import delete_category, request_deletion, request_rates_refresh, rates_status
 from ProjectKoncowy import celery_app
 
 
@@ -20,52 +36,15 @@ class IndexView(View):
         return render(request, 'index.html')
 
 
-class DashboardView(LoginRequiredMixin, View):
-    def get(self, request):
-        date30days = date.today() - timedelta(days=30)
-        today = date.today()
-        expense30days = Expense.objects.filter(user=request.user, date__gte=date30days).order_by('-date')
-        # calkowita suma pola 'amount' dla obiektów Expense z ostatnich 30 dni:
-        sum_expenses = expense30days.aggregate(Sum('amount'))['amount__sum']
-        sum_expenses_round = 0
-        if sum_expenses is not None:
-            sum_expenses_round = round(sum_expenses, 0)
+class DashboardView(LoginRequiredMixin, ConditionalGetMixin, View):
+    depends_on_rates = True
 
-        try:
-            category = Category.objects.get(name='wymiana')
-        except Category.DoesNotExist:
-            category = None
-        income30days = Income.objects.filter(user=request.user, date__gte=date30days).exclude(
-            category=category).order_by('-date')
-        sum_income = income30days.aggregate(Sum('amount'))['amount__sum']
-
-        sum_income_round = 0
-        if sum_income is not None:
-            sum_income_round = round(sum_income, 0)
-
-        if sum_income is not None and sum_expenses is not None:
-            together = round(sum_income - sum_expenses, 2)
-        else:
-            together = None
-
-        account = Account.objects.filter(user=request.user)
-
-        transactionsPLN = Transaction.objects.filter(user=request.user, date__gte=date30days, currency=153).order_by(
-            '-date')
-        transactionsFOR = Transaction.objects.filter(user=request.user, date__gte=date30days).exclude(
-            currency=153).order_by('-date')
-        transactionsEXC = Transaction.objects.filter(user=request.user, date__gte=date30days,
-                                                     transaction_type='Exchange').order_by('-date')[:10]
-        for transaction in transactionsEXC:
-            exchange_rate = transaction.currency.exchange_rate
-            transaction.change_in_PLN = round(transaction.amount * exchange_rate, 2)
-
-
-        return render(request, 'dash.html',
-                      {'sum_expenses': sum_expenses, 'sum_income': sum_income, 'together': together,
-                       'transactionsPLN': transactionsPLN, 'transactionsFOR': transactionsFOR, 'account': account,
-                       'sum_expenses_round': sum_expenses_round, 'sum_income_round': sum_income_round,
-                       'transactionsEXC': transactionsEXC, 'date30days': date30days, 'today': today})
+    def get(self, request):
+        user = request.user
+        # kursy wpływają na przeliczenie wymian, więc wersja rejestru walut też jest częścią klucza
+        context = cached_context(user, 'dashboard', (date.today(), currency_registry.version),
+                                 lambda: load_dashboard(user))
+        return render(request, 'dash.html', context)
 
 
 class LoginView(View):
@@ -110,35 +89,31 @@ class RegisterView(View):
         return render(request, 'register.html', {'form': form})
 
 
-class IncomeView(LoginRequiredMixin, View):
+class IncomeView(LoginRequiredMixin, ConditionalGetMixin, View):
     def get(self, request):
         user = request.user
-        built_in_categories = Category.objects.filter(is_built=True)
-        user_categories = Category.objects.filter(user=user, is_built=False)
-        all_categories = built_in_categories | user_categories
-        form2 = IncomeExpenseFilterForm(categories=all_categories)
-        incomes = Income.objects.filter(user=user).order_by('-date')
+        form2 = IncomeExpenseFilterForm(catalogue=category_catalogue(user))
+        cursor = request.GET.get(CURSOR_PARAM)
 
-        total_income = 0
-        if incomes.exists():
-            total_income = round(incomes.aggregate(Sum('amount'))['amount__sum'], 2)
+        def build():
+            incomes = Income.objects.filter(user=user).select_related('category')
+            page = KeysetPage(incomes, cursor)
+            total_income = round(incomes.aggregate(Sum('amount'))['amount__sum'] or 0, 2)
+            return {'incomes': page, 'page': page, 'total_income': total_income}
 
-        return render(request, 'income.html',
-                      {'incomes': incomes, 'total_income': total_income, 'form2': form2})
+        context = cached_context(user, 'income', (cursor,), build)
+        return render(request, 'income.html', {**context, 'form2': form2})
 
     def post(self, request):
         user = request.user
-        built_in_categories = Category.objects.filter(is_built=True)
-        user_categories = Category.objects.filter(user=user, is_built=False)
-        all_categories = built_in_categories | user_categories
-        form2 = IncomeExpenseFilterForm(request.POST, categories=all_categories)
-        incomes = Income.objects.filter(user=user)
+        form2 = IncomeExpenseFilterForm(request.POST, catalogue=category_catalogue(user))
 
         if form2.is_valid():
             date_from = form2.cleaned_data['date_from']
             date_to = form2.cleaned_data['date_to']
             category = form2.cleaned_data['category']
 
+            incomes = Income.objects.filter(user=user)
             if date_from:
                 incomes = incomes.filter(date__gte=date_from)
             if date_to:
@@ -146,23 +121,23 @@ class IncomeView(LoginRequiredMixin, View):
             if category:
                 incomes = incomes.filter(category=category)
 
-            total_income = 0
-            if incomes.exists():
-                total_income = round(incomes.aggregate(Sum('amount'))['amount__sum'], 2)
+            def build():
+                return {'total_income': round(incomes.aggregate(total=Sum('amount'))['total'] or 0, 2)}
 
-            return render(request, 'income.html', {'incomes': incomes, 'total_income': total_income, 'form2': form2})
+            context = cached_context(user, 'income-filter', (date_from, date_to, category and category.pk), build)
+            return render(request, 'income.html', {**context, 'incomes': incomes, 'form2': form2})
         return render(request, 'add_form.html', {'form2': form2})
 
 class IncomeEditView(LoginRequiredMixin, View):
     def get(self, request, income_id):
         income = Income.objects.get(user=request.user, id=income_id)
-        form = IncomeExpenseAddForm(instance=income)
+        form = IncomeExpenseAddForm(instance=income, catalogue=category_catalogue(request.user))
         return render(request, 'add_form.html', {'form': form})
 
     def post(self, request, income_id):
         user = request.user
-        income = Income.objects.get(user=user, id=income_id)
-        form = IncomeExpenseAddForm(request.POST, instance=income)
+        income = Income.objects.select_related('transaction').get(user=user, id=income_id)
+        form = IncomeExpenseAddForm(request.POST, instance=income, catalogue=category_catalogue(request.user))
         if form.is_valid():
             form.save()
             return redirect('income')
@@ -171,21 +146,18 @@ class IncomeEditView(LoginRequiredMixin, View):
 
 class IncomeDeleteView(LoginRequiredMixin, View):
     def post(self, request, income_id):
-        income = Income.objects.get(id=income_id)
+        income = Income.objects.select_related('transaction').get(id=income_id, user=request.user)
         income.delete()
         return redirect('income')
 
-class IncomeAddView(LoginRequiredMixin, View):
+class IncomeAddView(LoginRequiredMixin, IdempotentMixin, View):
     def get(self, request):
         user = request.user
-        built_in_categories = Category.objects.filter(is_built=True)
-        user_categories = Category.objects.filter(user=user, is_built=False)
-        all_categories = built_in_categories | user_categories
-        form = IncomeExpenseAddForm(categories=all_categories)
+        form = IncomeExpenseAddForm(catalogue=category_catalogue(user))
         return render(request, 'add_form.html', {'form': form})
 
     def post(self, request):
-        form = IncomeExpenseAddForm(request.POST, categories=Category.objects.all())
+        form = IncomeExpenseAddForm(request.POST, catalogue=category_catalogue(request.user))
         if form.is_valid():
             user = request.user
             amount = form.cleaned_data['amount']
@@ -199,37 +171,34 @@ class IncomeAddView(LoginRequiredMixin, View):
                 description=description,
                 category=category,
             )
-            return redirect('income')
+            return self.succeeded(redirect('income'))
         return render(request, 'add_form.html', {'form': form})
 
 
-class ExpenseView(LoginRequiredMixin, View):
+class ExpenseView(LoginRequiredMixin, ConditionalGetMixin, View):
     def get(self, request):
         user = request.user
-        built_in_categories = Category.objects.filter(is_built=True)
-        user_categories = Category.objects.filter(user=user, is_built=False)
-        all_categories = built_in_categories | user_categories
-        form2 = IncomeExpenseFilterForm(categories=all_categories)
-        expenses = Expense.objects.filter(user=user).order_by('-date')
+        form2 = IncomeExpenseFilterForm(catalogue=category_catalogue(user))
+        cursor = request.GET.get(CURSOR_PARAM)
 
-        total_expense = 0
-        if expenses.exists():
-            total_expense = expenses.aggregate(Sum('amount'))['amount__sum']
+        def build():
+            expenses = Expense.objects.filter(user=user).select_related('category')
+            page = KeysetPage(expenses, cursor)
+            total_expense = expenses.aggregate(Sum('amount'))['amount__sum'] or 0
+            return {'expenses': page, 'page': page, 'total_expense': total_expense}
 
-        return render(request, 'expense.html', {'expenses': expenses, 'total_expense': total_expense, 'form2': form2})
+        context = cached_context(user, 'expense', (cursor,), build)
+        return render(request, 'expense.html', {**context, 'form2': form2})
 
     def post(self, request):
         user = request.user
-        built_in_categories = Category.objects.filter(is_built=True)
-        user_categories = Category.objects.filter(user=user, is_built=False)
-        all_categories = built_in_categories | user_categories
-        form2 = IncomeExpenseFilterForm(request.POST, categories=all_categories)
-        expenses = Expense.objects.filter(user=user)
+        form2 = IncomeExpenseFilterForm(request.POST, catalogue=category_catalogue(user))
         if form2.is_valid():
             date_from = form2.cleaned_data['date_from']
             date_to = form2.cleaned_data['date_to']
             category = form2.cleaned_data['category']
 
+            expenses = Expense.objects.filter(user=user)
             if date_from:
                 expenses = expenses.filter(date__gte=date_from)
 
@@ -238,25 +207,24 @@ class ExpenseView(LoginRequiredMixin, View):
             if category:
                 expenses = expenses.filter(category=category)
 
-            total_expense = 0
-            if expenses.exists():
-                total_expense = expenses.aggregate(Sum('amount'))['amount__sum']
+            def build():
+                return {'total_expense': expenses.aggregate(total=Sum('amount'))['total'] or 0}
 
-            return render(request, 'expense.html',
-                          {'expenses': expenses, 'total_expense': total_expense, 'form2': form2})
+            context = cached_context(user, 'expense-filter', (date_from, date_to, category and category.pk), build)
+            return render(request, 'expense.html', {**context, 'expenses': expenses, 'form2': form2})
         return render(request, 'add_form.html', {'form2': form2})
 
 
 class ExpenseEditView(LoginRequiredMixin, View):
     def get(self, request, expense_id):
         expense = Expense.objects.get(user=request.user, id=expense_id)
-        form = IncomeExpenseAddForm(instance=expense)
+        form = IncomeExpenseAddForm(instance=expense, catalogue=category_catalogue(request.user))
         return render(request, 'add_form.html', {'form': form})
 
     def post(self, request, expense_id):
         user = request.user
-        expense = Expense.objects.get(user=user, id=expense_id)
-        form = IncomeExpenseAddForm(request.POST, instance=expense)
+        expense = Expense.objects.select_related('transaction').get(user=user, id=expense_id)
+        form = IncomeExpenseAddForm(request.POST, instance=expense, catalogue=category_catalogue(request.user))
         if form.is_valid():
             form.save()
             return redirect('expense')
@@ -265,22 +233,19 @@ class ExpenseEditView(LoginRequiredMixin, View):
 
 class ExpenseDeleteView(LoginRequiredMixin, View):
     def post(self, request, expense_id):
-        expense = Expense.objects.get(id=expense_id)
+        expense = Expense.objects.select_related('transaction').get(id=expense_id, user=request.user)
         expense.delete()
         return redirect('expense')
 
 
-class ExpenseAddView(LoginRequiredMixin, View):
+class ExpenseAddView(LoginRequiredMixin, IdempotentMixin, View):
     def get(self, request):
         user = request.user
-        built_in_categories = Category.objects.filter(is_built=True)
-        user_categories = Category.objects.filter(user=user, is_built=False)
-        all_categories = built_in_categories | user_categories
-        form = IncomeExpenseAddForm(categories=all_categories)
+        form = IncomeExpenseAddForm(catalogue=category_catalogue(user))
         return render(request, 'add_form.html', {'form': form})
 
     def post(self, request):
-        form = IncomeExpenseAddForm(request.POST, categories=Category.objects.all())
+        form = IncomeExpenseAddForm(request.POST, catalogue=category_catalogue(request.user))
         if form.is_valid():
             user = request.user
             amount = form.cleaned_data['amount']
@@ -294,75 +259,147 @@ class ExpenseAddView(LoginRequiredMixin, View):
                 description=description,
                 category=category,
             )
-            return redirect('expense')
+            return self.succeeded(redirect('expense'))
         return render(request, 'add_form.html', {'form': form})
 
 
-class CategoryView(LoginRequiredMixin, View):
+class ReportView(LoginRequiredMixin, View):
+    transaction_types = ('Income', 'Expense')
+
+    def get(self, request):
+        user = request.user
+        transaction_type = request.GET.get('type', 'Expense')
+        if transaction_type not in self.transaction_types:
+            return JsonResponse({'errors': {'type': ['Nieprawidłowy typ transakcji.']}}, status=400)
+        form = IncomeExpenseFilterForm(request.GET, catalogue=category_catalogue(user))
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+
+        date_from = form.cleaned_data['date_from']
+        date_to = form.cleaned_data['date_to']
+        category = form.cleaned_data['category']
+        report = PrefixSumReport.cached_for_user(user, transaction_type)
+        pivot = report.monthly_pivot(date_from, date_to, category)
+        return JsonResponse({
+            'type': transaction_type,
+            'date_from': date_from,
+            'date_to': date_to,
+            'category': category.id if category else None,
+            'total': str(report.total(date_from, date_to, category)),
+            'monthly': {month: {str(category_id): str(total) for category_id, total in totals.items()}
+                        for month, totals in pivot.items()},
+        })
+
+
+class ExportView(LoginRequiredMixin, View):
+    def get(self, request, kind):
+        if kind not in EXPORTS:
+            raise Http404
+        export_format = request.GET.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return JsonResponse({'errors': {'format': ['Nieobsługiwany format eksportu.']}}, status=400)
+        form = IncomeExpenseFilterForm(request.GET, catalogue=category_catalogue(request.user))
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+
+        # wiersze są pobierane partiami i wysyłane od razu, bez budowania całego pliku w pamięci
+        queryset = export_queryset(kind, request.user, form.cleaned_data['date_from'], form.cleaned_data['date_to'],
+                                   form.cleaned_data['category'])
+        stream, content_type = EXPORT_FORMATS[export_format]
+        response = StreamingHttpResponse(stream(kind, export_rows(kind, queryset)), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{kind}.{export_format}"'
+        return response
+
+
+class CategoryView(LoginRequiredMixin, ConditionalGetMixin, View):
     def get(self, request):
         user = request.user
-        main_categories = Category.objects.filter(is_built=True)
-        user_categories = Category.objects.filter(is_built=False, user=user)
-        date30days = date.today() - timedelta(days=30)
         today = date.today()
-        main_stats = self.get_category_stats(user, main_categories)
-        user_stats = self.get_category_stats(user, user_categories)
-
-        return render(request, 'category.html', {'main_categories': main_categories, 'main_stats': main_stats,
-                                                 'user_categories': user_categories, 'user_stats': user_stats,
-                                                 'date30days': date30days, 'today': today})
-
-    def get_category_stats(self, user, categories):
+        return render(request, 'category.html',
+                      cached_context(user, 'category', (today,), lambda: self.get_context(user, today)))
+
+    def get_context(self, user, today):
+        main_categories = list(Category.objects.built_in())
+        user_categories = list(Category.objects.owned_by(user))
+        date30days = today - timedelta(days=30)
+        totals = self.get_category_totals(user, date30days)
+        main_stats = self.get_category_stats(user, main_categories, totals)
+        user_stats = self.get_category_stats(user, user_categories, totals)
+        return {'main_categories': main_categories, 'main_stats': main_stats,
+                'user_categories': user_categories, 'user_stats': user_stats,
+                'date30days': date30days, 'today': today}
+
+    # sumy wszystkich kategorii naraz, razem z podkategoriami: wpis liczy się do swojej kategorii i każdego
+    # jej przodka z CategoryClosure; jedno zapytanie grupujące na model, niezależnie od liczby kategorii
+    def get_category_totals(self, user, date_from, categories=None):
+        totals = {}
+        for key, model in (('total_expense', Expense), ('total_income', Income)):
+            rows = model.objects.filter(user=user, date__gte=date_from, category__isnull=False)
+            if categories is not None:
+                rows = rows.filter(category__ancestor_links__ancestor__in=[category.id for category in categories])
+            rows = rows.order_by().values('category__ancestor_links__ancestor').annotate(total=Sum('amount'))
+            totals[key] = {row['category__ancestor_links__ancestor']: row['total'] for row in rows}
+        return totals
+
+    def get_category_stats(self, user, categories, totals=None):
+        if totals is None:
+            totals = self.get_category_totals(user, date.today() - timedelta(days=30), categories)
         stats = []
-        date30days = date.today() - timedelta(days=30)
-        for category in categories:
-            total_expense = Expense.objects.filter(
-                user=user,
-                category=category,
-                date__gte=date30days
-            ).aggregate(Sum('amount'))['amount__sum'] or 0
-
-            total_income = Income.objects.filter(
-                user=user,
-                category=category,
-                date__gte=date30days
-            ).aggregate(Sum('amount'))['amount__sum'] or 0
-
+        for category, level in tree_order(categories):
             stats.append({
                 'category': category,
-                'total_expense': round(total_expense, 2),
-                'total_income': round(total_income, 2)
+                'level': level,
+                'total_expense': round(totals['total_expense'].get(category.id, 0), 2),
+                'total_income': round(totals['total_income'].get(category.id, 0), 2)
             })
         return stats
 
 
 class CategoryAddView(LoginRequiredMixin, View):
     def get(self, request):
-        form = CategoryAddForm()
+        form = CategoryAddForm(catalogue=category_catalogue(request.user))
         return render(request, 'add_form.html', {'form': form})
 
     def post(self, request):
-        form = CategoryAddForm(request.POST, user=request.user)
+        form = CategoryAddForm(request.POST, user=request.user, catalogue=category_catalogue(request.user))
         if form.is_valid():
             name = form.cleaned_data['name']
             description = form.cleaned_data['description']
-            Category.objects.create(user=request.user, name=name, description=description, is_built=False)
+            Category.objects.create(user=request.user, name=name, description=description, is_built=False,
+                                    parent=form.cleaned_data['parent'])
             return redirect('category')
         return render(request, 'category.html', {'form': form})
 
 
 class CategoryDeleteView(LoginRequiredMixin, View):
     def get(self, request, category_id):
-        category = get_object_or_404(Category, id=category_id)
+        category = get_object_or_404(Category.objects.owned_by(request.user), id=category_id)
         return render(request, 'delete_confirmation.html', {'category': category})
 
+    # małe drzewo jest usuwane od razu; duże zostaje ukryte i usuwane partiami w tle
     def post(self, request, category_id):
-        category = get_object_or_404(Category, id=category_id)
-        category.delete()
+        category = get_object_or_404(Category.objects.owned_by(request.user), id=category_id)
+        dependants = category_dependants(category)
+        if dependants <= DELETE_CHUNK_SIZE:
+            category.delete()
+            return redirect('category')
+        with atomic():
+            hide_category(category)
+            request_deletion(delete_category, category.id)
+        report_queued('category', category.id, dependants)
+        messages.info(request, 'Kategoria jest usuwana w tle.')
         return redirect('category')
 
 
-class SavingsView(LoginRequiredMixin, View):
+class CategoryDeletionStatusView(LoginRequiredMixin, View):
+    def get(self, request, category_id):
+        progress = deletion_progress('category', category_id)
+        if progress is None:
+            raise Http404
+        return JsonResponse(progress)
+
+
+class SavingsView(LoginRequiredMixin, ConditionalGetMixin, View):
     def get(self, request):
         savings = Savings.objects.filter(user=request.user)
         return render(request, 'savings.html', {'savings': savings})
@@ -406,16 +443,17 @@ class SavingsDeleteView(LoginRequiredMixin, View):
         return redirect('savings')
 
 
-class AddMoneyToSavingsView(LoginRequiredMixin, View):
+class AddMoneyToSavingsView(LoginRequiredMixin, IdempotentMixin, View):
     def post(self, request, saving_id):
         amount = Decimal(request.POST.get('amount'))
-        savings_goal = Savings.objects.get(id=saving_id, user=request.user)
-
-        if amount <= savings_goal.remaining_amount:
-            savings_goal.current_amount += amount
-            savings_goal.remaining_amount -= amount
-            savings_goal.save()
-            return redirect('savings')
+        with atomic():
+            deposited = Savings.objects.filter(id=saving_id, user=request.user).deposit(amount)
+            if deposited:
+                # UPDATE na querysecie nie wysyła sygnałów zapisu
+                bump_data_version(request.user.id)
+        if deposited:
+            return self.succeeded(redirect('savings'))
+        get_object_or_404(Savings, id=saving_id, user=request.user)
 
         error_message = 'Wprowadzona kwota przekracza pozostałą do osiągnięcia sumę.'
         savings_list = Savings.objects.filter(user=request.user)
@@ -435,26 +473,80 @@ class AddMoneyToSavingsView(LoginRequiredMixin, View):
 #         return render(request, 'currency.html', {'currencies': currencies, 'sort_order': sort_order, 'form': form})
 
 
-class AccountsView(LoginRequiredMixin, View):
+class StatementImportView(LoginRequiredMixin, View):
     def get(self, request):
-        accounts = Account.objects.filter(user=request.user)
-        return render(request, 'accounts.html', {'accounts': accounts})
+        return render(request, 'statement_import.html', {'form': StatementImportForm()})
 
-class AccountDetailsView(LoginRequiredMixin, View):
-    def get(self, request, account_id):
-        account = get_object_or_404(Account, id=account_id, user=request.user)
-        transactions = Transaction.objects.filter(user=request.user, currency=account.currency)
-        return render(request, 'account_details.html', {'account': account, 'transactions': transactions})
+    def post(self, request):
+        form = StatementImportForm(request.POST, request.FILES)
+        if not form.is_valid():
+            return render(request, 'statement_import.html', {'form': form})
+        # plik czytany strumieniowo, wiersz po wierszu, bez wczytywania całości do pamięci
+        upload = form.cleaned_data['file']
+        parser, binary = STATEMENT_FORMATS[form.cleaned_data['format'] or detect_format(upload.name)]
+        stream = upload.file if binary else io.TextIOWrapper(upload.file, encoding=form.cleaned_data['encoding'],
+                                                             newline='')
+        errors = []
+        importer = StatementImporter(request.user)
+        try:
+            created = importer.run(parser(stream, errors), errors)
+        except (StatementError, UnicodeDecodeError, ParseError) as exc:
+            form.add_error('file', str(exc))
+            return render(request, 'statement_import.html', {'form': form})
+        return render(request, 'statement_import.html', {'form': StatementImportForm(), 'created': created,
+                                                         'errors': errors[:20], 'error_count': len(errors),
+                                                         'duplicates': importer.duplicates[:20],
+                                                         'duplicate_count': len(importer.duplicates)})
+
+
+class AccountsView(LoginRequiredMixin, ConditionalGetMixin, View):
+    depends_on_rates = True
+
+    def get(self, request):
+        accounts = Account.objects.filter(user=request.user).select_related('currency')
+        default_id = default_currency_id()
+        try:
+            worth = net_worth(request.user, default_id) if default_id is not None else None
+        except RateUnavailable:
+            worth = None
+        return render(request, 'accounts.html', {'accounts': accounts, 'net_worth': worth})
+
+
+class NetWorthView(LoginRequiredMixin, View):
+    def get(self, request):
+        code = request.GET.get('currency', DEFAULT_CURRENCY_CODE).upper()
+        try:
+            currency = currency_registry.get(code)
+        except Currency.DoesNotExist:
+            return JsonResponse({'errors': {'currency': ['Nieznana waluta.']}}, status=400)
+        try:
+            days = int(request.GET.get('days', 90))
+        except ValueError:
+            return JsonResponse({'errors': {'days': ['Nieprawidłowa liczba dni.']}}, status=400)
+
+        try:
+            worth = net_worth(request.user, currency.id)
+        except RateUnavailable as error:
+            return JsonResponse({'errors': {'currency': [str(error)]}}, status=503)
+        return JsonResponse({
+            'currency': worth['currency'],
+            'total': str(worth['total']),
+            'accounts': [dict(account, balance=str(account['balance']), converted=str(account['converted']))
+                         for account in worth['accounts']],
+            'history': [{'day': day, 'total': str(total)}
+                        for day, total in net_worth_history(request.user, currency.id, days)],
+        })
 
 class TransactionEditView(LoginRequiredMixin, View):
     def get(self, request, transaction_id):
         transaction = get_object_or_404(Transaction, id=transaction_id, user=request.user)
-        form = ForIncomeExpenseAddForm(instance=transaction)
+        form = ForIncomeExpenseAddForm(instance=transaction, catalogue=category_catalogue(request.user))
         return render(request, 'add_form.html', {'form': form, 'transaction': transaction})
 
     def post(self, request, transaction_id):
         transaction = get_object_or_404(Transaction, id=transaction_id, user=request.user)
-        form = ForIncomeExpenseAddForm(request.POST, instance=transaction)
+        form = ForIncomeExpenseAddForm(request.POST, instance=transaction,
+                                       catalogue=category_catalogue(request.user))
         if form.is_valid():
             form.save()
             return redirect('account_details', account_id=transaction.currency.account_set.first().id)
@@ -489,106 +581,133 @@ class AccountDeleteView(LoginRequiredMixin, View):
         return redirect('accounts')
 
 
-class AccountDetailsView(LoginRequiredMixin, View):
+class AccountDetailsView(LoginRequiredMixin, ConditionalGetMixin, View):
     def get(self, request, account_id):
-        account = Account.objects.get(id=account_id, user=request.user)
-        transactions = Transaction.objects.filter(currency_id=account.currency_id, user=request.user).order_by('-date')
-        for transaction in transactions:
-            if transaction.transaction_type == 'Income':
-                transaction.transaction_type = 'Wpływ'
-            else:
-                transaction.transaction_type = 'Wydatek'
-        return render(request, 'account_details.html', {"account": account, 'transactions': transactions})
+        account = get_object_or_404(Account.objects.select_related('currency'), id=account_id, user=request.user)
+        transactions = Transaction.objects.filter(currency_id=account.currency_id, user=request.user).annotate(
+            type_label=Case(When(transaction_type='Income', then=Value('Wpływ')), default=Value('Wydatek')))
+        page = KeysetPage(transactions, request.GET.get(CURSOR_PARAM))
+        transfer_form = AccountTransferForm(account=account)
+        return render(request, 'account_details.html', {"account": account, 'transactions': page, 'page': page,
+                                                        'transfer_form': transfer_form})
 
 
 
-class ForIncomeView(LoginRequiredMixin, View):
+class ForIncomeView(LoginRequiredMixin, IdempotentMixin, View):
     def get(self, request, account_id):
         user = request.user
-        built_in_categories = Category.objects.filter(is_built=True)
-        user_categories = Category.objects.filter(user=user, is_built=False)
-        all_categories = built_in_categories | user_categories
-        form = ForIncomeExpenseAddForm(categories=all_categories)
+        form = ForIncomeExpenseAddForm(catalogue=category_catalogue(user))
         return render(request, 'add_form.html', {'form': form})
 
     def post(self, request, account_id):
-        form = ForIncomeExpenseAddForm(request.POST, categories=Category.objects.all())
+        form = ForIncomeExpenseAddForm(request.POST, catalogue=category_catalogue(request.user))
         if form.is_valid():
             user = request.user
             new_amount = form.cleaned_data['amount']
             category = form.cleaned_data['category']
             date = form.cleaned_data['date']
-            account = Account.objects.get(id=account_id)
-            account.balance += int(new_amount)
-            account.save()
-            currency = account.currency
-            Transaction.objects.create(
-                user=user,
-                transaction_type='Income',
-                currency=currency,
-                category=category,
-                date=date,
-                amount=new_amount)
-            return redirect('account_details', account.id)
+            account = get_object_or_404(Account, id=account_id, user=user)
+            with atomic():
+                Account.objects.filter(id=account.id).deposit(new_amount)
+                Transaction.objects.create(
+                    user=user,
+                    transaction_type='Income',
+                    currency_id=account.currency_id,
+                    category=category,
+                    date=date,
+                    amount=new_amount)
+            return self.succeeded(redirect('account_details', account.id))
         return render(request, 'add_form.html', {'form': form})
 
 
-class ForExpenseView(LoginRequiredMixin, View):
+class ForExpenseView(LoginRequiredMixin, IdempotentMixin, View):
     def get(self, request, account_id):
         user = request.user
-        built_in_categories = Category.objects.filter(is_built=True)
-        user_categories = Category.objects.filter(user=user, is_built=False)
-        all_categories = built_in_categories | user_categories
-        form = ForIncomeExpenseAddForm(categories=all_categories)
+        form = ForIncomeExpenseAddForm(catalogue=category_catalogue(user))
         return render(request, 'add_form.html', {'form': form})
 
     def post(self, request, account_id):
-        form = ForIncomeExpenseAddForm(request.POST, categories=Category.objects.all())
+        form = ForIncomeExpenseAddForm(request.POST, catalogue=category_catalogue(request.user))
         if form.is_valid():
             user = request.user
             new_amount = form.cleaned_data['amount']
             category = form.cleaned_data['category']
             date = form.cleaned_data['date']
-            account = Account.objects.get(id=account_id)
-            if new_amount > account.balance:
-                form.add_error('amount', "Nie można dodać wydatku większego niż saldo na koncie.")
-                return render(request, 'add_form.html', {'form': form})
-            account.balance -= int(new_amount)
-            account.save()
-            currency = account.currency
-            Transaction.objects.create(
-                user=user,
-                transaction_type='Expense',
-                currency=currency,
-                category=category,
-                date=date,
-                amount=new_amount)
-            return redirect('account_details', account_id)
+            account = get_object_or_404(Account, id=account_id, user=user)
+            with atomic():
+                if not Account.objects.filter(id=account.id).withdraw(new_amount):
+                    form.add_error('amount', "Nie można dodać wydatku większego niż saldo na koncie.")
+                    return render(request, 'add_form.html', {'form': form})
+                Transaction.objects.create(
+                    user=user,
+                    transaction_type='Expense',
+                    currency_id=account.currency_id,
+                    category=category,
+                    date=date,
+                    amount=new_amount)
+            return self.succeeded(redirect('account_details', account_id))
         return render(request, 'add_form.html', {'form': form})
 
 
-class ChangeToPLNView(LoginRequiredMixin, View):
+class ChangeToPLNView(LoginRequiredMixin, IdempotentMixin, View):
     def post(self, request, account_id):
         amount = Decimal(request.POST.get('amount'))
-        account = Account.objects.get(id=account_id)
-        if amount > account.balance:
-            messages.info(request, "Nie można wymienić więcej niż dostępne saldo na koncie.")
+        account = get_object_or_404(Account, id=account_id, user=request.user)
+        # kurs z macierzy kursów krzyżowych (6 miejsc po przecinku), a nie zaokrąglony Currency.exchange_rate
+        try:
+            real_amount = get_cross_rates().convert_amount(amount, account.currency_id, default_currency_id())
+        except RateUnavailable as error:
+            messages.info(request, str(error))
             return redirect('account_details', account_id)
-
-        real_amount = int(amount) * Decimal(account.currency.exchange_rate)
-        category = Category.objects.get(name='Wymiana')
-        Income.objects.create(user=request.user, amount=real_amount, date=datetime.now(), category=category)
-        Transaction.objects.create(user=request.user, amount=amount, transaction_type='Exchange',
-                                   currency=account.currency, date=datetime.now())
-        account.balance -= int(amount)
-        account.save()
-        return redirect('account_details', account_id)
-
-class CurrenciesView(LoginRequiredMixin, View):
+        with atomic():
+            if not Account.objects.filter(id=account.id).withdraw(amount):
+                messages.info(request, "Nie można wymienić więcej niż dostępne saldo na koncie.")
+                return redirect('account_details', account_id)
+            category = Category.objects.get(name='Wymiana')
+            Income.objects.create(user=request.user, amount=real_amount, date=datetime.now(), category=category)
+            Transaction.objects.create(user=request.user, amount=amount, transaction_type='Exchange',
+                                       currency_id=account.currency_id, date=datetime.now())
+        return self.succeeded(redirect('account_details', account_id))
+
+class AccountTransferView(LoginRequiredMixin, IdempotentMixin, View):
+    def post(self, request, account_id):
+        account = get_object_or_404(Account, id=account_id, user=request.user)
+        form = AccountTransferForm(request.POST, account=account)
+        if not form.is_valid():
+            messages.info(request, 'Nieprawidłowe dane przelewu między kontami.')
+            return redirect('account_details', account_id)
+        amount = form.cleaned_data['amount']
+        target = form.cleaned_data['target']
+        # przeliczenie bezpośrednio między walutami kont, bez zaokrąglania po drodze do PLN
+        try:
+            target_amount = get_cross_rates().convert_amount(amount, account.currency_id, target.currency_id)
+        except RateUnavailable as error:
+            messages.info(request, str(error))
+            return redirect('account_details', account_id)
+        today = date.today()
+        with atomic():
+            if not Account.objects.filter(id=account.id).withdraw(amount):
+                messages.info(request, "Nie można wymienić więcej niż dostępne saldo na koncie.")
+                return redirect('account_details', account_id)
+            Account.objects.filter(id=target.id).deposit(target_amount)
+            Transaction.objects.create(user=request.user, amount=amount, transaction_type='Exchange',
+                                       currency_id=account.currency_id, date=today)
+            Transaction.objects.create(user=request.user, amount=target_amount, transaction_type='Income',
+                                       currency_id=target.currency_id, date=today)
+        return self.succeeded(redirect('account_details', account_id))
+
+
+class CurrenciesView(LoginRequiredMixin, ConditionalGetMixin, View):
     template_name = 'currencies.html'
+    depends_on_rates = True
+
+    def page_etag_parts(self, request):
+        # odświeżenie kursów zlecane także wtedy, gdy strona kończy się odpowiedzią 304
+        request_rates_refresh()
+        return tuple(rates_status().values())
 
     def get(self, request, *args, **kwargs):
-        update_exchange_rates.delay()
+        request_rates_refresh()
 
         sort_order = request.GET.get('sort_order', 'code')
         currencies = Currency.objects.all().order_by(sort_order)
@@ -596,5 +715,5 @@ class CurrenciesView(LoginRequiredMixin, View):
         if form.is_valid():
             name = form.cleaned_data.get('name', '')
             currencies = currencies.filter(name__icontains=name)
-        context = {'currencies': currencies, 'sort_order': sort_order, 'form': form}
+        context = {'currencies': currencies, 'sort_order': sort_order, 'form': form, 'rates': rates_status()}
         return render(request, self.template_name, context)